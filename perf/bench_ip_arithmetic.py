@@ -0,0 +1,146 @@
+#!/usr/bin/python
+
+# Copyright 2018 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+################################################################
+#                                                              #
+# Benchmark of the IP arithmetic of server/allocator.py        #
+#                                                              #
+# Compares the integer helpers of the allocator with the       #
+# earlier string helpers based on netaddr and iptools (run     #
+# "pip install netaddr==0.7.19 iptools==0.6.1" to include      #
+# them), and times the generation of bundles for a pool that   #
+# already has --tenants tenants                                #
+#                                                              #
+# Run "./bench_ip_arithmetic.py -h" to see usage               #
+#                                                              #
+################################################################
+
+import argparse
+import json
+import os
+import socket
+import struct
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "server"))
+import allocator
+from etcd_backend import MemoryEtcd
+
+
+# the helpers of server/allocator.py before the IP addresses were handled
+# as integers
+def legacy_increment_ip(ip, by=1):
+    i = struct.unpack('!I', socket.inet_aton(ip))[0] + by
+    return str(socket.inet_ntoa(struct.pack('!I', i)))
+
+
+def legacy_generate_next_subnet(subnet, network="/24"):
+    from netaddr import IPNetwork
+    ip = legacy_increment_ip(str(IPNetwork(subnet).ip), 2**16)
+    return ip + network
+
+
+def legacy_start_and_end_addresses_for_mcast_range(subnet):
+    import iptools
+    r = iptools.IpRangeList(subnet)
+    s = r.ips[0][0]
+    e = r.ips[0][-1]
+    s = legacy_increment_ip(s, 2**8 + 1)
+    return s, e
+
+
+# function that returns the seconds of one call of stmt (the best of
+# repeat runs of number calls)
+def best(stmt, number, repeat=3):
+    return min(timeit.repeat(stmt, number=number, repeat=repeat)) / number
+
+
+SERVER_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "server")
+
+
+# function that returns the seconds it takes to import module in a new
+# python process
+def import_time(module):
+    started = time.time()
+    os.system(sys.executable + " -c 'import sys; sys.path.insert(0, \"" +
+              SERVER_DIR + "\"); import " + module + "'")
+    return time.time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--number',
+        help='Calls of every helper. Default is 20000',
+        type=int,
+        default=20000)
+    parser.add_argument(
+        '--tenants',
+        help='Tenants in the pool when bundles are generated. Default is 500',
+        type=int,
+        default=500)
+    args = parser.parse_args()
+
+    try:
+        import netaddr
+        import iptools
+        legacy = True
+    except ImportError:
+        print "netaddr or iptools is not installed, skipping the legacy helpers\n"
+        legacy = False
+
+    results = {"helpers_us": {}}
+    helpers = [
+        ("generate_next_subnet",
+         lambda: allocator.generate_next_subnet("10.50.0.1/16", "/16"),
+         lambda: legacy_generate_next_subnet("10.50.0.1/16", "/16")),
+        ("start_and_end_addresses_for_mcast_range",
+         lambda: allocator.start_and_end_addresses_for_mcast_range(
+             "225.32.0.0/16"),
+         lambda: legacy_start_and_end_addresses_for_mcast_range(
+             "225.32.0.0/16")),
+    ]
+    for name, new, old in helpers:
+        result = {"integer": round(best(new, args.number) * 1e6, 3)}
+        if legacy:
+            assert new() == old()
+            result["legacy"] = round(best(old, args.number) * 1e6, 3)
+        results["helpers_us"][name] = result
+
+    # generate bundles for a pool with args.tenants tenants
+    # (the default configs are used if the config file does not exist)
+    a = allocator.Allocator(MemoryEtcd(), "/nonexistent/aci.conf")
+    state = {}
+    for i in range(args.tenants):
+        state["tenant%d" % i] = a._next_bundle(state)
+    results["next_bundle_ms"] = round(
+        best(lambda: a._next_bundle(state), 20) * 1e3, 3)
+    results["usage_ms"] = round(best(lambda: a.usage(state), 20) * 1e3, 3)
+
+    results["import_s"] = {"allocator": round(import_time("allocator"), 3)}
+    if legacy:
+        results["import_s"]["netaddr, iptools"] = round(
+            import_time("netaddr, iptools"), 3)
+
+    print json.dumps(results, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
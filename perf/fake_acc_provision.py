@@ -0,0 +1,229 @@
+#!/usr/bin/python
+
+# Copyright 2018 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+################################################################
+#                                                              #
+# Fake acc-provision tool used to load test the CCP ACI REST   #
+# service without an ACI fabric                                #
+#                                                              #
+# It accepts the same command line as the acc-provision        #
+# commands built by server/server.py, writes the ACI CNI       #
+# output YAML and the user-<system_id>.crt/.key files, and     #
+# pushes a few managed objects to the APIC in apic_hosts       #
+# (use perf/fake_apic.py as the APIC)                          #
+#                                                              #
+# The behavior is configured with these environment variables: #
+#                                                              #
+#   FAKE_ACC_PROVISION_LATENCY       seconds per run, either a #
+#                                    number or a "min-max"     #
+#                                    range (default 0)         #
+#   FAKE_ACC_PROVISION_FAILURE_RATE  probability (0.0 to 1.0)  #
+#                                    that a run fails          #
+#                                    (default 0)               #
+#   FAKE_ACC_PROVISION_OUTPUT_DOCS   number of k8s manifests   #
+#                                    in the output YAML        #
+#                                    (default 20)              #
+#   FAKE_ACC_PROVISION_DOC_SIZE      bytes of padding in each  #
+#                                    k8s manifest (default     #
+#                                    1024)                     #
+#                                                              #
+# To make the CCP ACI REST service use it, put it in PATH as   #
+# "acc-provision":                                             #
+#                                                              #
+#   mkdir -p /tmp/fakebin                                      #
+#   ln -sf $PWD/perf/fake_acc_provision.py \                   #
+#       /tmp/fakebin/acc-provision                             #
+#   PATH=/tmp/fakebin:$PATH ./server/ccp_aci_server.py ...     #
+#                                                              #
+################################################################
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import urllib2
+import yaml
+
+VERSION = "1.8.1-fake"
+
+
+# function to read an int or float setting from the environment
+def _env(name, default, cast=float):
+    value = os.environ.get(name, '')
+    if value == '':
+        return default
+    return cast(value)
+
+
+# function to get the seconds to sleep from FAKE_ACC_PROVISION_LATENCY
+def get_latency():
+    value = os.environ.get("FAKE_ACC_PROVISION_LATENCY", '')
+    if value == '':
+        return 0.0
+    if '-' in value:
+        low, high = value.split('-', 1)
+        return random.uniform(float(low), float(high))
+    return float(value)
+
+
+# function that returns the managed objects acc-provision creates on the
+# APIC for a cluster as a list of (dn, class name, attributes)
+def apic_objects(system_id):
+    return [
+        ("uni/tn-" + system_id, "fvTenant", {
+            "name": system_id
+        }),
+        ("uni/vmmp-Kubernetes/dom-" + system_id, "vmmDomP", {
+            "name": system_id
+        }),
+        ("uni/infra/vlanns-[" + system_id + "-pool]-static",
+         "fvnsVlanInstP", {
+             "name": system_id + "-pool"
+         }),
+        ("uni/userext/user-" + system_id, "aaaUser", {
+            "name": system_id
+        }),
+    ]
+
+
+# function to get the base url of the APIC from apic_hosts
+def apic_url(config):
+    host = config["aci_config"]["apic_hosts"][0]
+    if "://" not in host:
+        host = "http://" + host
+    return host.rstrip('/')
+
+
+# function to send a request to the APIC
+def apic_request(url, method, body=None):
+    data = None
+    if body is not None:
+        data = json.dumps(body)
+    req = urllib2.Request(url, data=data)
+    req.get_method = lambda: method
+    req.add_header("Content-Type", "application/json")
+    return json.loads(urllib2.urlopen(req, timeout=10).read())
+
+
+def push_to_apic(config, delete=False):
+    base = apic_url(config)
+    apic_request(base + "/api/aaaLogin.json", "POST", {"aaaUser": {}})
+    for dn, class_name, attributes in apic_objects(
+            config["aci_config"]["system_id"]):
+        if delete:
+            apic_request(base + "/api/mo/" + dn + ".json", "DELETE")
+        else:
+            apic_request(base + "/api/mo/" + dn + ".json", "POST",
+                         {class_name: {
+                             "attributes": attributes
+                         }})
+
+
+# function to write the ACI CNI output YAML with
+# FAKE_ACC_PROVISION_OUTPUT_DOCS k8s manifests
+def write_output_yaml(config, output):
+    docs = _env("FAKE_ACC_PROVISION_OUTPUT_DOCS", 20, int)
+    doc_size = _env("FAKE_ACC_PROVISION_DOC_SIZE", 1024, int)
+    system_id = config["aci_config"]["system_id"]
+
+    f = open(output, "w")
+    for i in range(docs):
+        manifest = {
+            "apiVersion": "v1",
+            "kind": "ConfigMap",
+            "metadata": {
+                "name": "aci-fake-%s-%d" % (system_id, i),
+                "namespace": "kube-system"
+            },
+            "data": {
+                "net_config": json.dumps(config.get("net_config", {})),
+                "padding": "x" * doc_size
+            }
+        }
+        f.write("---\n")
+        f.write(yaml.safe_dump(manifest, default_flow_style=False))
+    f.close()
+
+
+def write_certs(system_id):
+    for ext in ("crt", "key"):
+        f = open("user-" + system_id + "." + ext, "w")
+        f.write("-----BEGIN FAKE %s-----\n%s\n-----END FAKE %s-----\n" %
+                (ext.upper(), system_id, ext.upper()))
+        f.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--version', action='store_true')
+    parser.add_argument('-a', '--apic', action='store_true')
+    parser.add_argument('-d', '--delete', action='store_true')
+    parser.add_argument('-c', '--config')
+    parser.add_argument('-f', '--flavor')
+    parser.add_argument('-o', '--output')
+    parser.add_argument('-u', '--username')
+    parser.add_argument('-p', '--password')
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+
+    # like acc-provision, the APIC password is read from ACC_PROVISION_PASS
+    # if it is not given with -p
+    password = args.password or os.environ.get("ACC_PROVISION_PASS")
+
+    if args.version:
+        print VERSION
+        return 0
+
+    f = open(args.config, "r")
+    config = yaml.safe_load(f)
+    f.close()
+    system_id = config["aci_config"]["system_id"]
+
+    time.sleep(get_latency())
+
+    if random.random() < _env("FAKE_ACC_PROVISION_FAILURE_RATE", 0.0):
+        sys.stderr.write("ERR: fake acc-provision failure for %s\n" %
+                         system_id)
+        return 1
+
+    if (args.apic or args.delete) and not password:
+        sys.stderr.write("ERR: APIC password is required\n")
+        return 1
+
+    try:
+        if args.apic or args.delete:
+            push_to_apic(config, delete=args.delete)
+    except Exception as e:
+        sys.stderr.write("ERR: APIC request failed: %s\n" % str(e))
+        return 1
+
+    if args.delete:
+        print "INFO: Deleted configs for", system_id
+        return 0
+
+    if args.apic:
+        write_certs(system_id)
+    if args.output:
+        write_output_yaml(config, args.output)
+        print "INFO: Apply infrastructure YAML using:"
+        print "  kubectl apply -f", args.output
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
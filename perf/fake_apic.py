@@ -0,0 +1,215 @@
+#!/usr/bin/python
+
+# Copyright 2018 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+################################################################
+#                                                              #
+# Fake ACI APIC that keeps managed objects in memory and       #
+# implements the subset of the APIC REST API used by the fake  #
+# acc-provision tool (perf/fake_acc_provision.py)              #
+#                                                              #
+# Run "./fake_apic.py -h" to see usage                         #
+#                                                              #
+################################################################
+
+import argparse
+import BaseHTTPServer
+import json
+import SocketServer
+import threading
+import time
+
+
+class FakeApic(object):
+    def __init__(self, ip="127.0.0.1", port=0, latency=0.0):
+        # managed objects keyed by dn, values are (class name, attributes)
+        self.objects = {}
+        self.latency = latency
+        self.request_count = 0
+        self._lock = threading.Lock()
+        self._httpd = _ThreadedHTTPServer((ip, port), _FakeApicHandler)
+        self._httpd.fake_apic = self
+        self._thread = None
+
+    # url of the fake APIC (can be used as apic_hosts in the ACI input json)
+    @property
+    def url(self):
+        return "http://%s:%d" % self._httpd.server_address
+
+    # function to serve the fake APIC in a daemon thread
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    # function to serve the fake APIC in the calling thread
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def get(self, dn):
+        with self._lock:
+            return self.objects.get(dn)
+
+    def put(self, dn, class_name, attributes):
+        with self._lock:
+            attributes = dict(attributes)
+            attributes["dn"] = dn
+            self.objects[dn] = (class_name, attributes)
+
+    # deleting a dn also deletes all its children like the APIC does
+    def delete(self, dn):
+        with self._lock:
+            for k in list(self.objects.keys()):
+                if k == dn or k.startswith(dn + "/"):
+                    del self.objects[k]
+
+    def objects_of_class(self, class_name):
+        with self._lock:
+            return [(dn, v[1]) for dn, v in sorted(self.objects.items())
+                    if v[0] == class_name]
+
+    # count the request and sleep for the configured latency
+    def simulate_latency(self):
+        with self._lock:
+            self.request_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class _ThreadedHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _FakeApicHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # the APIC returns every managed object in this format:
+    # {"totalCount": "1", "imdata": [{"<class>": {"attributes": {...}}}]}
+    def _send_imdata(self, objects, status=200):
+        body = json.dumps({
+            "totalCount":
+            str(len(objects)),
+            "imdata": [{
+                class_name: {
+                    "attributes": attributes
+                }
+            } for class_name, attributes in objects]
+        })
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.getheader("Content-Length") or 0)
+        if length == 0:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    # function to get the dn from /api/mo/<dn>.json
+    def _dn(self):
+        path = self.path.split('?')[0]
+        if not path.startswith("/api/mo/") or not path.endswith(".json"):
+            return None
+        return path[len("/api/mo/"):-len(".json")]
+
+    def do_GET(self):
+        apic = self.server.fake_apic
+        apic.simulate_latency()
+        path = self.path.split('?')[0]
+
+        if path.startswith("/api/node/class/") and path.endswith(".json"):
+            class_name = path[len("/api/node/class/"):-len(".json")]
+            self._send_imdata([(class_name, attributes) for _, attributes in
+                               apic.objects_of_class(class_name)])
+            return
+
+        dn = self._dn()
+        if dn is None:
+            self._send_imdata([], 400)
+            return
+
+        mo = apic.get(dn)
+        self._send_imdata([mo] if mo is not None else [])
+
+    def do_POST(self):
+        apic = self.server.fake_apic
+        apic.simulate_latency()
+
+        if self.path.split('?')[0] in ("/api/aaaLogin.json",
+                                       "/api/aaaRefresh.json"):
+            self._send_imdata([("aaaLogin", {
+                "token": "fake-apic-token"
+            })])
+            return
+
+        dn = self._dn()
+        if dn is None:
+            self._send_imdata([], 400)
+            return
+
+        body = self._read_body()
+        for class_name, mo in body.items():
+            attributes = mo.get("attributes", {})
+            if attributes.get("status") == "deleted":
+                apic.delete(dn)
+            else:
+                apic.put(dn, class_name, attributes)
+        self._send_imdata([])
+
+    def do_DELETE(self):
+        apic = self.server.fake_apic
+        apic.simulate_latency()
+
+        dn = self._dn()
+        if dn is None:
+            self._send_imdata([], 400)
+            return
+
+        apic.delete(dn)
+        self._send_imdata([])
+
+    # no need to print a log line for every request to the fake APIC
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--ip',
+        help='IP address to listen on. Default is 127.0.0.1',
+        default='127.0.0.1')
+    parser.add_argument(
+        '--port',
+        help='Port to listen on. Default is 46880',
+        type=int,
+        default=46880)
+    parser.add_argument(
+        '--latency',
+        help='Seconds to sleep in every APIC request. Default is 0',
+        type=float,
+        default=0.0)
+    args = parser.parse_args()
+
+    apic = FakeApic(args.ip, args.port, args.latency)
+    print "Fake APIC running at", apic.url
+    apic.serve_forever()
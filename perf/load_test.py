@@ -0,0 +1,407 @@
+#!/usr/bin/python
+
+# Copyright 2018 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+################################################################
+#                                                              #
+# Load generator for the CCP ACI REST service                  #
+#                                                              #
+# Drives concurrent creates, statuses and deletes against a    #
+# running CCP ACI REST service (ideally using the fake         #
+# acc-provision tool in perf/fake_acc_provision.py) and        #
+# reports create-to-ready and delete latency distributions,    #
+# throughput, thread counts of the server and etcd load        #
+#                                                              #
+# Run "./load_test.py -h" to see usage                         #
+#                                                              #
+################################################################
+
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+from fake_apic import FakeApic
+
+# the percentiles are the ones of the metrics of the server's scheduler
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "server"))
+from scheduler import percentile
+
+
+# this function returns the ACI input json used for every cluster
+def get_input_json(apic_hosts):
+    return {
+        "aci_config": {
+            "l3out": {
+                "external_networks": ["hx-ext-net"],
+                "name": "hx-l3out"
+            },
+            "aep": "hx-aep",
+            "vrf": {
+                "name": "hx-l3out-vrf",
+                "tenant": "common"
+            },
+            "vmm_domain": {
+                "encap_type": "vxlan",
+                "nested_inside": {
+                    "type": "vmware",
+                    "name": "hx8-vcenter"
+                }
+            },
+            "apic_hosts": apic_hosts
+        },
+        "net_config": {
+            "extern_static": "1.4.0.1/24",
+            "infra_vlan": 4093,
+            "node_subnet": "1.10.58.1/24",
+            "extern_dynamic": "1.3.0.1/24"
+        },
+        "registry": {
+            "image_prefix": "noiro"
+        }
+    }
+
+
+def distribution(values):
+    values = sorted(values)
+    d = {"count": len(values)}
+    if values:
+        d["min"] = values[0]
+        d["max"] = values[-1]
+        d["mean"] = sum(values) / len(values)
+    for p in (50, 90, 95, 99):
+        d["p%d" % p] = percentile(values, p)
+    return d
+
+
+# class Stats collects the measurements of all the worker threads
+class Stats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.latencies.setdefault(name, []).append(seconds)
+
+    def error(self, name):
+        with self._lock:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+
+# class ThreadSampler samples the number of threads of the server process
+# from /proc/<pid>/status while the load test runs
+class ThreadSampler(threading.Thread):
+    def __init__(self, pid, interval=0.5):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                f = open("/proc/%d/status" % self.pid, "r")
+                for line in f:
+                    if line.startswith("Threads:"):
+                        self.samples.append(int(line.split()[1]))
+                f.close()
+            except (IOError, ValueError):
+                pass
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def report(self):
+        if not self.samples:
+            return {}
+        return {
+            "max": max(self.samples),
+            "mean": sum(self.samples) / float(len(self.samples)),
+            "samples": len(self.samples)
+        }
+
+
+# function to read the etcd request counters from etcd's /metrics endpoint
+def get_etcd_counters(metrics_url):
+    r = requests.get(metrics_url, timeout=10)
+    return parse_etcd_counters(r.text)
+
+
+# function to sum the etcd request counters in the prometheus text format
+def parse_etcd_counters(text):
+    counters = {}
+    for line in text.splitlines():
+        m = re.match(r'^(etcd_debugging_mvcc_(?:put|delete|range|txn)_total|'
+                     r'grpc_server_handled_total)(\{[^}]*\})? ([0-9.e+]+)$',
+                     line)
+        if m:
+            name = m.group(1)
+            counters[name] = counters.get(name, 0) + float(m.group(3))
+    return counters
+
+
+# class LoadTest runs the full lifecycle of a cluster in each worker
+class LoadTest(object):
+    def __init__(self, args, apic_hosts):
+        self.args = args
+        self.apic_hosts = apic_hosts
+        self.base_url = "http://%s:%d/api/v1/" % (args.ccp_aci_server_ip,
+                                                  args.ccp_aci_server_port)
+        self.stats = Stats()
+        self._local = threading.local()
+
+    # each worker thread keeps its own http session
+    def session(self):
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def request(self, method, operation, payload):
+        t = time.time()
+        r = self.session().request(
+            method,
+            self.base_url + "acc_provision_" + operation,
+            data=json.dumps(payload),
+            headers={"Content-Type": "application/json"},
+            timeout=60)
+        self.stats.add("http_" + operation, time.time() - t)
+        return r
+
+    def wait_for_status(self, payload, ready, started):
+        while time.time() - started < self.args.timeout:
+            r = self.request("GET", "status", payload)
+            if ready(r):
+                return True
+            time.sleep(self.args.status_interval)
+        return False
+
+    # function to wait for a create, returns "ready", "failed" or "timeout"
+    #
+    # a create that fails for good deletes its in-progress record, so once
+    # the in-progress record has been seen a later 404 means the create
+    # failed and there is no need to wait for the timeout
+    def wait_for_create(self, payload, started):
+        in_progress_seen = False
+        while time.time() - started < self.args.timeout:
+            r = self.request("GET", "status", payload)
+            if r.status_code == 200:
+                if "aci_cni_response" in r.json():
+                    return "ready"
+                in_progress_seen = True
+            elif r.status_code == 404 and in_progress_seen:
+                return "failed"
+            time.sleep(self.args.status_interval)
+        return "timeout"
+
+    # best-effort delete of a cluster whose lifecycle did not complete so
+    # that it does not stay in etcd after the load test
+    def cleanup_cluster(self, payload):
+        try:
+            self.request("DELETE", "delete", payload)
+        except Exception:
+            pass
+
+    def run_cluster(self, i):
+        name = "%s%d" % (self.args.name_prefix, i)
+        payload = {
+            "ccp_cluster_name": name,
+            "aci_username": "admin",
+            "aci_password": "fake",
+        }
+        create_payload = dict(payload)
+        create_payload["k8s_version"] = self.args.k8s_version
+        create_payload["aci_input_json"] = get_input_json(self.apic_hosts)
+
+        completed = False
+        try:
+            started = time.time()
+            r = self.request("POST", "create", create_payload)
+            if r.status_code != 202:
+                self.stats.error("create_rejected")
+                return
+            result = self.wait_for_create(payload, started)
+            if result != "ready":
+                self.stats.error("create_" + result)
+                return
+            self.stats.add("create_to_ready", time.time() - started)
+
+            if self.args.no_delete:
+                completed = True
+                return
+
+            started = time.time()
+            r = self.request("DELETE", "delete", payload)
+            if r.status_code != 202:
+                self.stats.error("delete_rejected")
+                return
+            if not self.wait_for_status(
+                    payload, lambda r: r.status_code == 404, started):
+                self.stats.error("delete_timeout")
+                return
+            self.stats.add("delete_to_gone", time.time() - started)
+            completed = True
+        except Exception as e:
+            print "ERROR: cluster", name, type(e), str(e)
+            self.stats.error("exception")
+        finally:
+            if not completed:
+                self.cleanup_cluster(payload)
+
+    def run(self):
+        pool = ThreadPool(self.args.concurrency)
+        started = time.time()
+        pool.map(self.run_cluster, range(self.args.clusters), chunksize=1)
+        pool.close()
+        pool.join()
+        return time.time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'ccp_aci_server_ip', help='IP address of CCP ACI server')
+    parser.add_argument(
+        '--ccp_aci_server_port',
+        help='Port of CCP ACI server. Default is 46802',
+        type=int,
+        default=46802)
+    parser.add_argument(
+        '--clusters',
+        help='Number of clusters to create. Default is 100',
+        type=int,
+        default=100)
+    parser.add_argument(
+        '--concurrency',
+        help='Number of clusters in flight at once. Default is 20',
+        type=int,
+        default=20)
+    parser.add_argument(
+        '--name_prefix',
+        help='Prefix of the cluster names. Default is '
+        'loadtest-<unix time>- so that every run uses new cluster names',
+        default='loadtest-%d-' % int(time.time()))
+    parser.add_argument(
+        '--k8s_version', help='Kubernetes version. Default is 1.9',
+        default='1.9')
+    parser.add_argument(
+        '--status_interval',
+        help='Seconds between status polls. Default is 1',
+        type=float,
+        default=1.0)
+    parser.add_argument(
+        '--timeout',
+        help='Seconds to wait for a create or delete. Default is 600',
+        type=float,
+        default=600.0)
+    parser.add_argument(
+        '--no_delete',
+        help='Do not delete the clusters after they are ready',
+        action='store_true')
+    parser.add_argument(
+        '--apic_hosts',
+        help='APIC hosts for the ACI input json (comma separated). '
+        'Default is to start a fake APIC in this process',
+        default='')
+    parser.add_argument(
+        '--fake_apic_ip',
+        help='IP address the in-process fake APIC listens on. '
+        'Default is 127.0.0.1',
+        default='127.0.0.1')
+    parser.add_argument(
+        '--server_pid',
+        help='PID of the CCP ACI server to sample its thread count',
+        type=int,
+        default=0)
+    parser.add_argument(
+        '--etcd_metrics_url',
+        help='etcd metrics url to measure the etcd load '
+        '(example: http://127.0.0.1:2379/metrics)',
+        default='')
+    parser.add_argument(
+        '--json_output',
+        help='File to write the report to as json for comparing runs',
+        default='')
+    args = parser.parse_args()
+
+    apic = None
+    if args.apic_hosts:
+        apic_hosts = args.apic_hosts.split(",")
+    else:
+        apic = FakeApic(args.fake_apic_ip).start()
+        apic_hosts = [apic.url]
+        print "Fake APIC running at", apic.url
+
+    etcd_before = {}
+    if args.etcd_metrics_url:
+        etcd_before = get_etcd_counters(args.etcd_metrics_url)
+
+    sampler = None
+    if args.server_pid:
+        sampler = ThreadSampler(args.server_pid)
+        sampler.start()
+
+    load_test = LoadTest(args, apic_hosts)
+    elapsed = load_test.run()
+
+    report = {
+        "clusters": args.clusters,
+        "concurrency": args.concurrency,
+        "elapsed_seconds": elapsed,
+        "clusters_per_second": args.clusters / elapsed if elapsed else 0.0,
+        "latency_seconds": dict((k, distribution(v))
+                                for k, v in load_test.stats.latencies.items()),
+        "errors": load_test.stats.errors,
+    }
+
+    if sampler is not None:
+        sampler.stop()
+        report["server_threads"] = sampler.report()
+
+    if args.etcd_metrics_url:
+        etcd_after = get_etcd_counters(args.etcd_metrics_url)
+        report["etcd_requests"] = dict((k, etcd_after[k] - etcd_before.get(
+            k, 0)) for k in etcd_after)
+
+    if apic is not None:
+        report["fake_apic_requests"] = apic.request_count
+        apic.stop()
+
+    print json.dumps(report, indent=4, sort_keys=True)
+
+    if args.json_output:
+        f = open(args.json_output, "w")
+        f.write(json.dumps(report, indent=4, sort_keys=True))
+        f.close()
+
+    if load_test.stats.errors:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,103 @@
+import os
+import subprocess
+import sys
+
+import pytest
+import yaml
+
+from fake_apic import FakeApic
+from fake_acc_provision import apic_objects
+
+FAKE_ACC_PROVISION = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_acc_provision.py")
+
+# ===== HELPER FUNCTIONS ============================================================================
+
+@pytest.fixture
+def apic():
+    a = FakeApic().start()
+    yield a
+    a.stop()
+
+def write_input_yaml(tmpdir, apic, system_id="c1"):
+    path = str(tmpdir.join("acc_provision_input_" + system_id + ".yaml"))
+    f = open(path, "w")
+    f.write(yaml.safe_dump({
+        "aci_config": {"system_id": system_id, "apic_hosts": [apic.url]},
+        "net_config": {"kubeapi_vlan": 2120},
+    }, default_flow_style=False))
+    f.close()
+    return path
+
+def run_fake_acc_provision(tmpdir, args, env=None):
+    e = dict(os.environ)
+    e.update(env or {})
+    p = subprocess.Popen([sys.executable, FAKE_ACC_PROVISION] + args, cwd=str(tmpdir),
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=e)
+    output, err = p.communicate()
+    return p.returncode, output, err
+
+# ===== TESTS =======================================================================================
+
+def test_version(tmpdir):
+    returncode, output, _ = run_fake_acc_provision(tmpdir, ["-v"])
+    assert returncode == 0
+    assert "fake" in output
+
+def test_create_and_delete_on_apic(tmpdir, apic):
+    config = write_input_yaml(tmpdir, apic)
+    output_yaml = str(tmpdir.join("aci_cni_deployment_c1.yaml"))
+
+    returncode, output, _ = run_fake_acc_provision(
+        tmpdir, ["-a", "-c", config, "-f", "kubernetes-1.9", "-o", output_yaml,
+                 "--debug", "-u", "admin", "-p", "secret"],
+        {"FAKE_ACC_PROVISION_OUTPUT_DOCS": "3"})
+
+    assert returncode == 0
+    assert "kubectl apply -f " + output_yaml in output
+
+    # create pushes the 4 managed objects of the cluster to the APIC
+    assert sorted(apic.objects.keys()) == sorted(dn for dn, _, _ in apic_objects("c1"))
+    assert len(apic.objects) == 4
+
+    assert tmpdir.join("user-c1.crt").check()
+    assert tmpdir.join("user-c1.key").check()
+    assert len(list(yaml.safe_load_all(open(output_yaml)))) == 3
+
+    returncode, output, _ = run_fake_acc_provision(
+        tmpdir, ["-d", "-c", config, "-f", "kubernetes-1.9", "--debug", "-u", "admin", "-p", "secret"])
+
+    # delete removes them
+    assert returncode == 0
+    assert apic.objects == {}
+
+def test_failure_rate(tmpdir, apic):
+    config = write_input_yaml(tmpdir, apic)
+
+    returncode, _, err = run_fake_acc_provision(
+        tmpdir, ["-a", "-c", config, "-f", "kubernetes-1.9", "-o", "out.yaml"],
+        {"FAKE_ACC_PROVISION_FAILURE_RATE": "1"})
+
+    assert returncode != 0
+    assert "ERR:" in err
+    assert apic.objects == {}
+
+def test_password_from_environment(tmpdir, apic):
+    config = write_input_yaml(tmpdir, apic)
+    args = ["-a", "-c", config, "-f", "kubernetes-1.9", "-o", "out.yaml", "-u", "admin"]
+
+    returncode, _, err = run_fake_acc_provision(tmpdir, args, {"ACC_PROVISION_PASS": ""})
+    assert returncode != 0
+    assert "password is required" in err
+
+    returncode, _, _ = run_fake_acc_provision(tmpdir, args, {"ACC_PROVISION_PASS": "secret"})
+    assert returncode == 0
+    assert len(apic.objects) == 4
+
+def test_apic_deletes_children(apic):
+    apic.put("uni/tn-c1", "fvTenant", {"name": "c1"})
+    apic.put("uni/tn-c1/ap-kubernetes", "fvAp", {"name": "kubernetes"})
+    apic.put("uni/tn-c10", "fvTenant", {"name": "c10"})
+
+    apic.delete("uni/tn-c1")
+
+    assert apic.objects.keys() == ["uni/tn-c10"]
@@ -0,0 +1,60 @@
+import pytest
+
+from load_test import *
+
+# ===== TESTS =======================================================================================
+
+# ----- latency distributions -----------------------------------------------------------------------
+
+def test_percentile():
+    assert percentile([], 50) == 0.0
+    assert percentile([1.0], 99) == 1.0
+    assert percentile([1.0, 2.0, 3.0, 4.0, 5.0], 0) == 1.0
+    assert percentile([1.0, 2.0, 3.0, 4.0, 5.0], 50) == 3.0
+    assert percentile([1.0, 2.0, 3.0, 4.0, 5.0], 100) == 5.0
+
+    # interpolates between the two closest values
+    assert percentile([1.0, 2.0], 50) == pytest.approx(1.5)
+    assert percentile([0.0, 10.0, 20.0, 30.0, 40.0], 90) == pytest.approx(36.0)
+
+def test_distribution():
+    d = distribution([3.0, 1.0, 2.0])
+    assert d["count"] == 3
+    assert d["min"] == 1.0
+    assert d["max"] == 3.0
+    assert d["mean"] == pytest.approx(2.0)
+    assert d["p50"] == 2.0
+    assert d["p99"] == pytest.approx(2.98)
+
+def test_distribution_of_no_values():
+    d = distribution([])
+    assert d["count"] == 0
+    assert "mean" not in d
+    assert d["p50"] == 0.0
+
+# ----- etcd counters -------------------------------------------------------------------------------
+
+def test_parse_etcd_counters():
+    text = "\n".join([
+        "# HELP etcd_debugging_mvcc_put_total Total number of puts seen by this member.",
+        "# TYPE etcd_debugging_mvcc_put_total counter",
+        "etcd_debugging_mvcc_put_total 12",
+        "etcd_debugging_mvcc_delete_total 3",
+        "etcd_debugging_mvcc_range_total 1.5e+06",
+        "etcd_debugging_mvcc_txn_total 0",
+        'grpc_server_handled_total{grpc_code="OK",grpc_method="Range",grpc_service="etcdserverpb.KV",grpc_type="unary"} 40',
+        'grpc_server_handled_total{grpc_code="OK",grpc_method="Put",grpc_service="etcdserverpb.KV",grpc_type="unary"} 2',
+        "etcd_debugging_mvcc_keys_total 7",
+        'grpc_server_started_total{grpc_method="Range"} 40',
+    ])
+
+    assert parse_etcd_counters(text) == {
+        "etcd_debugging_mvcc_put_total": 12.0,
+        "etcd_debugging_mvcc_delete_total": 3.0,
+        "etcd_debugging_mvcc_range_total": 1.5e6,
+        "etcd_debugging_mvcc_txn_total": 0.0,
+        "grpc_server_handled_total": 42.0,
+    }
+
+def test_parse_etcd_counters_without_counters():
+    assert parse_etcd_counters("") == {}
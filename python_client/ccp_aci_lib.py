@@ -0,0 +1,399 @@
+#!/usr/bin/python
+
+# Copyright 2018 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+################################################################
+#                                                              #
+# Client library of the CCP ACI service REST APIs              #
+#                                                              #
+# Example:                                                     #
+#                                                              #
+#   client = CcpAciClient("10.10.1.2")                         #
+#   client.create("cluster1", "admin", "password",             #
+#                 aci_input_json, "1.9")                       #
+#   client.wait_until_ready("cluster1", "admin", "password",   #
+#                           manifests=False)                   #
+#   client.download_aci_cni("cluster1", "admin", "password",   #
+#                           "aci_cni_cluster1.yaml")           #
+#                                                              #
+################################################################
+
+from multiprocessing.pool import ThreadPool
+import json
+import time
+import uuid
+
+import requests
+import yaml
+
+# size in bytes of the chunks the streamed ACI CNI is written in
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class CcpAciError(Exception):
+    """
+    CcpAciError is raised for the failed requests to the CCP ACI service.
+    status_code and response are the http status code and json response
+    of the request (None if the request did not get a response).
+    """
+
+    def __init__(self, message, status_code=None, response=None):
+        Exception.__init__(self, message)
+        self.status_code = status_code
+        self.response = response
+
+
+class CcpAciClient(object):
+    """
+    CcpAciClient is a client of the CCP ACI service at host:port.
+
+    All the requests of a client share one requests.Session, whose
+    connection pool keeps up to pool_size connections to the service open
+    (keep-alive), so a client can be shared by many threads, like the
+    threads of the batch_* functions. Creates, updates and deletes are sent
+    with an Idempotency-Key header and are retried with the same key after
+    connection errors and timeouts, so a retry never starts a second job.
+    """
+
+    def __init__(self,
+                 host,
+                 port=46802,
+                 scheme="http",
+                 timeout=60,
+                 retries=3,
+                 pool_size=32):
+        self.base_url = ''.join(
+            [scheme, "://", host, ":", str(port), "/api/v1/"])
+        self.timeout = timeout
+        self.retries = retries
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Content-Type"] = "application/json"
+
+    # function to send a request to the acc_provision_<operation> endpoint,
+    # returns the http status code and json response
+    def request(self,
+                method,
+                operation,
+                payload,
+                params=None,
+                idempotency_key=None,
+                timeout=None):
+        headers = {}
+        if idempotency_key is not None:
+            headers["Idempotency-Key"] = idempotency_key
+        for i in range(1, self.retries + 1):
+            try:
+                r = self.session.request(
+                    method,
+                    self.base_url + "acc_provision_" + operation,
+                    data=json.dumps(payload),
+                    params=params,
+                    headers=headers,
+                    timeout=timeout or self.timeout)
+                return r.status_code, r.json()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # only requests that are safe to send again are retried
+                if (method != "GET" and idempotency_key is None) or \
+                   i == self.retries:
+                    raise CcpAciError("acc_provision_" + operation +
+                                      " failed: " + str(e))
+                time.sleep(i)
+
+    @staticmethod
+    def payload(ccp_cluster_name,
+                aci_username,
+                aci_password,
+                aci_input_json=None,
+                k8s_version=None):
+        data = {
+            "ccp_cluster_name": ccp_cluster_name,
+            "aci_username": aci_username,
+            "aci_password": aci_password,
+        }
+        if aci_input_json is not None:
+            data["aci_input_json"] = aci_input_json
+        if k8s_version is not None:
+            data["k8s_version"] = k8s_version
+        return data
+
+    # function to create configs on ACI for a cluster, returns the json
+    # response with the job_id of the creation
+    def create(self,
+               ccp_cluster_name,
+               aci_username,
+               aci_password,
+               aci_input_json,
+               k8s_version,
+               idempotency_key=None):
+        status_code, response = self.request(
+            "POST", "create",
+            self.payload(ccp_cluster_name, aci_username, aci_password,
+                         aci_input_json, k8s_version),
+            idempotency_key=idempotency_key or uuid.uuid4().hex)
+        if status_code != 202:
+            raise CcpAciError("acc_provision_create failed: " +
+                              json.dumps(response), status_code, response)
+        return response
+
+    # function to update the configs on ACI and the ACI CNI of a created
+    # cluster, returns the json response with the job_id of the update
+    def update(self,
+               ccp_cluster_name,
+               aci_username,
+               aci_password,
+               aci_input_json,
+               k8s_version,
+               idempotency_key=None):
+        status_code, response = self.request(
+            "PUT", "update",
+            self.payload(ccp_cluster_name, aci_username, aci_password,
+                         aci_input_json, k8s_version),
+            idempotency_key=idempotency_key or uuid.uuid4().hex)
+        if status_code != 202:
+            raise CcpAciError("acc_provision_update failed: " +
+                              json.dumps(response), status_code, response)
+        return response
+
+    # function to delete the configs on ACI of a cluster, returns the json
+    # response with the job_id of the deletion
+    def delete(self,
+               ccp_cluster_name,
+               aci_username,
+               aci_password,
+               idempotency_key=None):
+        status_code, response = self.request(
+            "DELETE", "delete",
+            self.payload(ccp_cluster_name, aci_username, aci_password),
+            idempotency_key=idempotency_key or uuid.uuid4().hex)
+        if status_code != 202:
+            raise CcpAciError("acc_provision_delete failed: " +
+                              json.dumps(response), status_code, response)
+        return response
+
+    # function to get the status of a cluster, returns the http status code
+    # (200, or 404 if the cluster does not exist) and the json response
+    #
+    # if wait is given, the service waits up to wait seconds for the
+    # creation, update or deletion of the cluster in progress to finish
+    # before it answers (long-poll)
+    #
+    # with manifests=False the response of a created cluster has the number
+    # of manifests of its ACI CNI instead of the ACI CNI
+    def status(self,
+               ccp_cluster_name,
+               aci_username,
+               aci_password,
+               wait=None,
+               manifests=True):
+        params = {}
+        timeout = None
+        if wait:
+            params["wait"] = wait
+            timeout = self.timeout + wait
+        if not manifests:
+            params["manifests"] = "false"
+        status_code, response = self.request(
+            "GET",
+            "status",
+            self.payload(ccp_cluster_name, aci_username, aci_password),
+            params=params or None,
+            timeout=timeout)
+        if status_code not in [200, 404]:
+            raise CcpAciError("acc_provision_status failed: " +
+                              json.dumps(response), status_code, response)
+        return status_code, response
+
+    # function to wait until the ACI CNI of a created or updated cluster is
+    # ready, returns the json response of acc_provision_status with the
+    # ACI CNI (aci_cni_response). Raises CcpAciError if the creation failed
+    # or does not finish within timeout seconds.
+    #
+    # the status is polled without the ACI CNI, which is only fetched once
+    # it is ready. With manifests=False it is not fetched at all, and the
+    # response has the number of manifests of the ACI CNI instead (use
+    # download_aci_cni() to get it).
+    def wait_until_ready(self,
+                         ccp_cluster_name,
+                         aci_username,
+                         aci_password,
+                         timeout=600,
+                         wait=30,
+                         manifests=True):
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            status_code, response = self.status(
+                ccp_cluster_name, aci_username, aci_password,
+                max(min(wait, remaining), 1), manifests=False)
+            if status_code == 404:
+                raise CcpAciError(
+                    "Creation of ACI configs failed for cluster " +
+                    ccp_cluster_name, status_code, response)
+            if response.get("completed", False) and \
+               not response.get("update_in_progress", False):
+                if not manifests:
+                    return response
+                status_code, response = self.status(
+                    ccp_cluster_name, aci_username, aci_password)
+                if "aci_cni_response" in response and \
+                   not response.get("update_in_progress", False):
+                    return response
+            if time.time() >= deadline:
+                raise CcpAciError(
+                    "Timed out waiting for ACI CNI of cluster " +
+                    ccp_cluster_name, status_code, response)
+
+    # function to write the ACI CNI of a created cluster to the file path in
+    # output_format: "yaml" (multi-document YAML for kubectl apply -f
+    # <path>) or "ndjson" (one json manifest per line). The service streams
+    # the manifests one at a time and they are written as they arrive, so
+    # the ACI CNI is never held in memory. Raises CcpAciError if the
+    # cluster has no ACI CNI (yet).
+    def download_aci_cni(self,
+                         ccp_cluster_name,
+                         aci_username,
+                         aci_password,
+                         path,
+                         output_format="yaml"):
+        r = self.session.request(
+            "GET",
+            self.base_url + "acc_provision_status",
+            data=json.dumps(
+                self.payload(ccp_cluster_name, aci_username, aci_password)),
+            params={"format": output_format},
+            timeout=self.timeout,
+            stream=True)
+        try:
+            # errors and creations in progress are answered with json
+            if r.status_code != 200 or \
+               r.headers.get("Content-Type", "").startswith(
+                   "application/json"):
+                response = r.json()
+                raise CcpAciError(
+                    "ACI CNI not found for cluster " + ccp_cluster_name +
+                    ": " + json.dumps(response), r.status_code, response)
+
+            f = open(path, "wb")
+            try:
+                for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+            finally:
+                f.close()
+        finally:
+            r.close()
+
+    # function to wait until the configs of a deleted cluster are deleted.
+    # Raises CcpAciError if the deletion does not finish within timeout
+    # seconds.
+    def wait_until_deleted(self,
+                           ccp_cluster_name,
+                           aci_username,
+                           aci_password,
+                           timeout=600,
+                           wait=30):
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            status_code, response = self.status(
+                ccp_cluster_name, aci_username, aci_password,
+                max(min(wait, remaining), 1), manifests=False)
+            if status_code == 404:
+                return
+            if time.time() >= deadline:
+                raise CcpAciError(
+                    "Timed out waiting for deletion of cluster " +
+                    ccp_cluster_name, status_code, response)
+
+    # function to call f for every item of items in concurrency threads,
+    # returns the results in the order of items (a CcpAciError instead of
+    # the result for the items that failed)
+    def _batch(self, f, items, concurrency):
+        def call(item):
+            try:
+                return f(item)
+            except CcpAciError as e:
+                return e
+
+        pool = ThreadPool(min(concurrency or self.pool_size, len(items)) or 1)
+        try:
+            return pool.map(call, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    # function to create many clusters concurrently, clusters is a list of
+    # dicts with the arguments of create(). If wait is True, the ACI CNI of
+    # every cluster is waited for and returned instead of the job.
+    def batch_create(self, clusters, concurrency=None, wait=False,
+                     timeout=600):
+        def create(c):
+            response = self.create(**c)
+            if wait:
+                return self.wait_until_ready(
+                    c["ccp_cluster_name"],
+                    c["aci_username"],
+                    c["aci_password"],
+                    timeout=timeout)
+            return response
+
+        return self._batch(create, clusters, concurrency)
+
+    # function to get the status of many clusters concurrently, clusters is
+    # a list of dicts with ccp_cluster_name, aci_username and aci_password.
+    # Returns (http status code, json response) of every cluster.
+    def batch_status(self, clusters, concurrency=None):
+        return self._batch(lambda c: self.status(**c), clusters, concurrency)
+
+    # function to delete many clusters concurrently, clusters is a list of
+    # dicts with ccp_cluster_name, aci_username and aci_password. If wait is
+    # True, the deletion of every cluster is waited for.
+    def batch_delete(self, clusters, concurrency=None, wait=False,
+                     timeout=600):
+        def delete(c):
+            response = self.delete(**c)
+            if wait:
+                self.wait_until_deleted(timeout=timeout, **c)
+            return response
+
+        return self._batch(delete, clusters, concurrency)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+
+# function to write the ACI CNI in the json response of
+# acc_provision_status to the YAML file path (kubectl apply -f <path>)
+#
+# every k8s manifest is dumped straight into the file, so the YAML of the
+# whole ACI CNI is never built in memory
+def write_aci_cni_yaml(response, path):
+    f = open(path, "w")
+    try:
+        for manifest in response["aci_cni_response"]:
+            f.write("\n---\n")
+            yaml.safe_dump(manifest, f)
+    finally:
+        f.close()
@@ -15,14 +15,64 @@
 # limitations under the License.
 
 import configparser
-import etcd3
-import iptools
 import json
-from netaddr import *
 import os
 import socket
 import struct
+import threading
 import time
+import uuid
+
+# IP addresses are handled as integers in this module, they are only
+# converted from and to strings when they are read from aci.conf or the
+# state, and when bundles are handed out
+
+# number of addresses between the subnets of consecutive bundles (each
+# bundle gets the next x.y.0.0/16 block)
+SUBNET_STEP = 2**16
+
+MAX_IP = 2**32 - 1
+
+# allocation modes of a pool (ALLOCATION_MODE in aci.conf):
+#
+# - first_fit hands out the first free vlan ids, service subnet, multicast
+#   range and pod subnet, each of them independently of the others
+# - slot hands out slot i, the i-th vlan id pair, service subnet, multicast
+#   range and pod subnet of the pool, so all the values of a bundle are
+#   found from i and freed bundles leave whole slots free
+FIRST_FIT_MODE = "first_fit"
+SLOT_MODE = "slot"
+ALLOCATION_MODES = [FIRST_FIT_MODE, SLOT_MODE]
+
+
+# function to convert an IP address string (like "10.0.0.1") to an integer
+def ip_to_int(ip):
+    if ip.count('.') != 3:
+        raise InvalidIPError("invalid IP %s" % ip)
+    try:
+        return struct.unpack('!I', socket.inet_aton(ip))[0]
+    except (socket.error, TypeError):
+        raise InvalidIPError("invalid IP %s" % ip)
+
+
+# function to convert an integer to an IP address string
+def int_to_ip(i):
+    return "%d.%d.%d.%d" % (i >> 24, (i >> 16) & 255, (i >> 8) & 255, i & 255)
+
+
+# function to split a subnet string (like "10.50.0.1/16") into the integer
+# of its IP address (host bits are kept) and its prefix length
+def parse_subnet(subnet):
+    ip, _, prefix = subnet.partition('/')
+    prefix = int(prefix) if prefix else 32
+    if not 0 <= prefix <= 32:
+        raise InvalidIPError("invalid prefix length in %s" % subnet)
+    return ip_to_int(ip), prefix
+
+
+# function that returns the netmask of a prefix length as an integer
+def prefix_mask(prefix):
+    return (MAX_IP << (32 - prefix)) & MAX_IP
 
 
 def increment_ip(ip, by=1):
@@ -30,36 +80,41 @@ def increment_ip(ip, by=1):
         raise ValueError("increment value must be >= 0")
 
     try:
-        i = struct.unpack('!I', socket.inet_aton(ip))[0] + by
-        return str(socket.inet_ntoa(struct.pack('!I', i)))
-    except:
+        i = ip_to_int(ip) + by
+    except InvalidIPError:
+        raise InvalidIPError("IP %s can't be incremented by %d" % (ip, by))
+    if i > MAX_IP:
         raise InvalidIPError("IP %s can't be incremented by %d" % (ip, by))
+    return int_to_ip(i)
 
 
 def generate_next_subnet(subnet, network="/24"):
     """
     generate_next_subnet converts '10.0.0.0/24' into '10.1.0.0/24' and '10.255.0.0/24' into '11.0.0.0/24'.
-    network can be specified if the /24 default is not desired
+    network can be specified if the /24 default is not desired. Raises
+    InvalidIPError after 255.255.0.0 (Allocator.validate_ranges() checks at
+    startup that the configured subnets don't get there).
     """
 
-    # TODO: this will fail if 255.255.0.0 is the input and we try to generate the next ip.
-    #       we should check at startup that the specified subnet starting points allow
-    #       for vlan_max - vlan_min subnets to be allocated.
-    ip = increment_ip(str(IPNetwork(subnet).ip), 2**16)
+    ip = parse_subnet(subnet)[0] + SUBNET_STEP
+    if ip > MAX_IP:
+        raise InvalidIPError("no subnet after %s" % subnet)
 
-    return ip + network
+    return int_to_ip(ip) + network
 
 
-def start_and_end_addresses_for_mcast_range(subnet):
-    r = iptools.IpRangeList(subnet)
+# function that returns the integers of the start and end addresses of the
+# multicast range of the IP address ip (an integer) and prefix length
+def mcast_range_bounds(ip, prefix=16):
+    network = ip & prefix_mask(prefix)
+    # use x.y.1.1 instead of x.y.0.0 for start address
+    return network + 2**8 + 1, network | (MAX_IP ^ prefix_mask(prefix))
 
-    s = r.ips[0][0]
-    e = r.ips[0][-1]
 
-    # use x.y.1.1 instead of x.y.0.0 for start address
-    s = increment_ip(s, 2**8 + 1)
+def start_and_end_addresses_for_mcast_range(subnet):
+    s, e = mcast_range_bounds(*parse_subnet(subnet))
 
-    return s, e
+    return int_to_ip(s), int_to_ip(e)
 
 
 class TenantAlreadyExistsError(Exception):
@@ -94,11 +149,202 @@ class NoPodSubnetsAvailableError(Exception):
     pass
 
 
+class UnknownPoolError(Exception):
+    pass
+
+
+class InvalidPoolRangeError(ValueError):
+    pass
+
+
+class CompactionError(Exception):
+    pass
+
+
+# prefix of the aci.conf sections that define named pools
+POOL_SECTION_PREFIX = "pool:"
+
+
+# function that returns the names of the pools defined in aci_config
+def pool_names(aci_config):
+    return [
+        section[len(POOL_SECTION_PREFIX):] for section in aci_config.keys()
+        if section.startswith(POOL_SECTION_PREFIX)
+    ]
+
+
+def select_pool(aci_config, aci_input_json):
+    """
+    select_pool returns the name of the pool whose APIC_HOSTS contain one of
+    the apic_hosts, or whose VMM_DOMAIN is the vmm domain the cluster is
+    nested inside, in the ACI input json. Returns None (the default pool) if
+    no pool matches.
+    """
+
+    aci = aci_input_json.get("aci_config", {})
+    apic_hosts = set(aci.get("apic_hosts", []))
+    vmm_domain = aci.get("vmm_domain", {}).get("nested_inside",
+                                                {}).get("name")
+
+    for pool in sorted(pool_names(aci_config)):
+        section = aci_config[POOL_SECTION_PREFIX + pool]
+        pool_apic_hosts = set(
+            h.strip() for h in section.get('APIC_HOSTS', '').split(',')
+            if h.strip() != '')
+        if apic_hosts & pool_apic_hosts:
+            return pool
+        if vmm_domain and section.get('VMM_DOMAIN', '') == vmm_domain:
+            return pool
+
+    return None
+
+
+# function to read ACI configurations from config_file
+def read_aci_config(config_file):
+    if not os.path.exists(config_file):
+        # set defaults if config_file is not found
+        config = {'DEFAULT': {}}
+        config['DEFAULT']['DEFAULT_VLAN_MIN'] = 2120
+
+        # DEFAULT_VLAN_MAX's maximum value is 4095
+        config['DEFAULT']['DEFAULT_VLAN_MAX'] = 4000
+
+        config['DEFAULT']['DEFAULT_MULTICAST_RANGE'] = "225.32.0.0/16"
+        config['DEFAULT']['DEFAULT_SERVICE_SUBNET'] = "10.5.0.0/24"
+
+        # DEFAULT_POD_SUBNET has to end with .1
+        config['DEFAULT']['DEFAULT_POD_SUBNET'] = "10.50.0.1/16"
+
+        config['DEFAULT']['WARM_POOL_SIZE'] = 0
+
+        config['DEFAULT']['ALLOCATION_MODE'] = FIRST_FIT_MODE
+
+        config['DEFAULT']['MAX_CONCURRENT_ACC_PROVISION_PER_FABRIC'] = 1
+
+        return config
+
+    else:
+        # read ACI configurations from config_file
+        config = configparser.ConfigParser()
+        config.read(config_file)
+        return config
+
+
+class AciConfigManager(object):
+    """
+    AciConfigManager keeps the ACI configurations of every config file
+    read by read_aci_config(), so that the Allocators of the requests don't
+    read the file. reload() reads the file again if it changed (its mtime,
+    size or inode, a ConfigMap volume replaces the file), and the new
+    configurations replace the old ones only if validate accepts them.
+
+    The configurations of a file get the next version every time they are
+    loaded.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # config_file -> {"config", "version", "signature", "loaded",
+        # "error"}
+        self._configs = {}
+
+    # function that returns the signature of config_file, None if it does
+    # not exist
+    @staticmethod
+    def _signature(config_file):
+        try:
+            st = os.stat(config_file)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    # function that returns the configurations of config_file, they are
+    # read the first time
+    def get(self, config_file):
+        entry = self._configs.get(config_file)
+        if entry is None:
+            with self._lock:
+                entry = self._configs.get(config_file)
+                if entry is None:
+                    entry = self._store(config_file,
+                                        self._signature(config_file),
+                                        read_aci_config(config_file), None)
+        return entry["config"]
+
+    def _store(self, config_file, signature, config, previous):
+        entry = {
+            "config": config,
+            "version": previous["version"] + 1 if previous else 1,
+            "signature": signature,
+            "loaded": time.time(),
+            "error": None
+        }
+        self._configs[config_file] = entry
+        return entry
+
+    def reload(self, config_file, validate=None):
+        """
+        reload reads config_file again if it changed since it was read, and
+        replaces its configurations if they can be read and validate
+        (called with the new configurations) does not raise an exception.
+        Returns True if they were replaced. Raises the exception otherwise,
+        the old configurations are kept then and the file is not read
+        again until it changes.
+        """
+
+        with self._lock:
+            previous = self._configs.get(config_file)
+            signature = self._signature(config_file)
+            if previous is not None and signature == previous["signature"]:
+                return False
+
+            try:
+                config = read_aci_config(config_file)
+                if validate is not None:
+                    validate(config)
+            except Exception as e:
+                if previous is not None:
+                    previous["signature"] = signature
+                    previous["error"] = str(e)
+                raise
+            self._store(config_file, signature, config, previous)
+            return True
+
+    # function that returns the version of the configurations of
+    # config_file, when they were loaded, and the error of the last
+    # configurations that were not accepted
+    def info(self, config_file):
+        self.get(config_file)
+        entry = self._configs[config_file]
+        return {
+            "config_file": config_file,
+            "version": entry["version"],
+            "loaded": entry["loaded"],
+            "error": entry["error"]
+        }
+
+
+# the ACI configurations of the server
+aci_configs = AciConfigManager()
+
+
+# function that returns the ACI configurations of config_file (read once,
+# see AciConfigManager)
+def get_aci_config(config_file):
+    return aci_configs.get(config_file)
+
+
 class Allocator:
 
     DB_KEY = "/ccp_aci_service"
     LOCK_NAME = "ccp_aci_service_lock"
 
+    # tenant names of the pre-reserved bundles in the warm pool
+    WARM_POOL_PREFIX = "__warm_pool__"
+
+    # number of events in the state log that are folded into the snapshot
+    LOG_COMPACTION_INTERVAL = 100
+
     KUBEAPI_VLAN_KEY = "net_config.kubeapi_vlan"
     SERVICE_VLAN_KEY = "net_config.service_vlan"
     MULTICAST_RANGE_START_KEY = "aci_config.vmm_domain.mcast_range.start"
@@ -106,18 +352,41 @@ class Allocator:
     SERVICE_SUBNET_KEY = "net_config.node_svc_subnet"
     POD_SUBNET_KEY = "net_config.pod_subnet"
 
-    def __init__(self, etcd_client, config_file="aci.conf", **kwargs):
-        aci_config = self._get_aci_config(config_file)
-
-        self.DEFAULT_VLAN_MIN = int(aci_config['DEFAULT']['DEFAULT_VLAN_MIN'])
+    def __init__(self, etcd_client, config_file="aci.conf", pool=None,
+                 **kwargs):
+        # aci_config can be given to check new configurations before they
+        # are used
+        aci_config = kwargs.get("aci_config")
+        if aci_config is None:
+            aci_config = self._get_aci_config(config_file)
+
+        # a named pool is configured in the [pool:<name>] section of
+        # config_file and has its own state key and lock (settings missing
+        # in the section are inherited from [DEFAULT])
+        self.pool = pool
+        section = 'DEFAULT'
+        if pool is not None:
+            section = POOL_SECTION_PREFIX + pool
+            if section not in aci_config:
+                raise UnknownPoolError("pool " + pool + " is not defined")
+            self.DB_KEY = Allocator.DB_KEY + "/" + pool
+            self.LOCK_NAME = Allocator.LOCK_NAME + "_" + pool
+
+        self.DEFAULT_VLAN_MIN = int(aci_config[section]['DEFAULT_VLAN_MIN'])
         # DEFAULT_VLAN_MAX's maximum value is 4095
-        self.DEFAULT_VLAN_MAX = int(aci_config['DEFAULT']['DEFAULT_VLAN_MAX'])
-        self.DEFAULT_MULTICAST_RANGE = aci_config['DEFAULT'][
+        self.DEFAULT_VLAN_MAX = int(aci_config[section]['DEFAULT_VLAN_MAX'])
+        self.DEFAULT_MULTICAST_RANGE = aci_config[section][
             'DEFAULT_MULTICAST_RANGE']
-        self.DEFAULT_SERVICE_SUBNET = aci_config['DEFAULT'][
+        self.DEFAULT_SERVICE_SUBNET = aci_config[section][
             'DEFAULT_SERVICE_SUBNET']
         # DEFAULT_POD_SUBNET has to end with .1
-        self.DEFAULT_POD_SUBNET = aci_config['DEFAULT']['DEFAULT_POD_SUBNET']
+        self.DEFAULT_POD_SUBNET = aci_config[section]['DEFAULT_POD_SUBNET']
+        # number of bundles to keep pre-reserved in the warm pool
+        # (0 disables the warm pool)
+        self.DEFAULT_WARM_POOL_SIZE = int(aci_config[section].get(
+            'WARM_POOL_SIZE', 0))
+        self.DEFAULT_ALLOCATION_MODE = aci_config[section].get(
+            'ALLOCATION_MODE', FIRST_FIT_MODE)
 
         self.etcd_client = etcd_client
 
@@ -145,43 +414,39 @@ class Allocator:
         self.SERVICE_SUBNET = kwargs.get("service_subnet",
                                          self.DEFAULT_SERVICE_SUBNET)
         self.POD_SUBNET = kwargs.get("pod_subnet", self.DEFAULT_POD_SUBNET)
-
-        # TODO: ensure that there is sufficient distance between multicast range start and 255.255.0.0 to
-        #       allow MAX_VLANS octets to be assigned
-
-        # TODO: ensure that there is sufficient distance between multicast range start and service subnet
-        #       to allow MAX_VLANS octets to be assigned.
-        # TODO: do we need to support both ways? (a > b and b > a)
-        # TODO: another edge case, both set to the same thing (lol)
+        self.WARM_POOL_SIZE = kwargs.get("warm_pool_size",
+                                         self.DEFAULT_WARM_POOL_SIZE)
+        self.LOG_COMPACTION_INTERVAL = kwargs.get(
+            "log_compaction_interval", self.LOG_COMPACTION_INTERVAL)
+        self.ALLOCATION_MODE = kwargs.get("allocation_mode",
+                                          self.DEFAULT_ALLOCATION_MODE)
+        if self.ALLOCATION_MODE not in ALLOCATION_MODES:
+            raise ValueError("allocation_mode must be one of %s (got %s)" %
+                             (", ".join(ALLOCATION_MODES),
+                              self.ALLOCATION_MODE))
+
+        # the first service subnet, multicast range and pod subnet as
+        # integers
+        self._svc_subnet, prefix = parse_subnet(self.SERVICE_SUBNET)
+        self._svc_subnet_prefix = "/" + str(prefix)
+        self._mcast_range = parse_subnet(
+            self.MULTICAST_RANGE)[0] & prefix_mask(16)
+        self._pod_subnet, prefix = parse_subnet(self.POD_SUBNET)
+        self._pod_subnet_prefix = "/" + str(prefix)
+
+        # the ranges of the subnets and multicast ranges are checked by
+        # validate_ranges() when the server starts
 
     # function to read ACI configurations from config_file
     def _get_aci_config(self, config_file):
-        if not os.path.exists(config_file):
-            # set defaults if config_file is not found
-            config = {'DEFAULT': {}}
-            config['DEFAULT']['DEFAULT_VLAN_MIN'] = 2120
-
-            # DEFAULT_VLAN_MAX's maximum value is 4095
-            config['DEFAULT']['DEFAULT_VLAN_MAX'] = 4000
-
-            config['DEFAULT']['DEFAULT_MULTICAST_RANGE'] = "225.32.0.0/16"
-            config['DEFAULT']['DEFAULT_SERVICE_SUBNET'] = "10.5.0.0/24"
-
-            # DEFAULT_POD_SUBNET has to end with .1
-            config['DEFAULT']['DEFAULT_POD_SUBNET'] = "10.50.0.1/16"
-
-            return config
-
-        else:
-            # read ACI configurations from config_file
-            config = configparser.ConfigParser()
-            config.read(config_file)
-            return config
+        return get_aci_config(config_file)
 
     def reserve(self, tenant_name):
         """
-        reserve takes a (hopefully locked) etcd client, generates a unique set of
-        vlan ids and subnets for the named tenant, stores that info into etcd, and
+        reserve generates a unique set of vlan ids and subnets for the named
+        tenant under the allocation lock of the pool, appends it to the state
+        log in etcd with a transaction that fails if a lockless claim() from
+        the warm pool changed the state in between (and re-tries then), and
         returns the generated set.
         """
 
@@ -190,169 +455,873 @@ class Allocator:
 
     def __locked_reserve(self, tenant_name):
 
-        if tenant_name == '' or ' ' in tenant_name:
+        self._validate_tenant_name(tenant_name)
+
+        while True:
+            # 1. load state from db
+            state, head = self._load()
+
+            if tenant_name in state:
+                raise TenantAlreadyExistsError(
+                    "tenant " + tenant_name + " already exists")
+
+            # 2. generate the next unused bundle of vlan ids and subnets
+            bundle = self._next_bundle(state)
+            bundle['aci_config.system_id'] = tenant_name
+
+            # 3. append the new bundle to the state log unless a lockless
+            #    claim from the warm pool changed the state since it was loaded
+            if self._append("reserve", {tenant_name: bundle}, head):
+                # 4. return state object
+                return bundle
+
+    def _validate_tenant_name(self, tenant_name):
+        if tenant_name == '' or ' ' in tenant_name or \
+           tenant_name.startswith(self.WARM_POOL_PREFIX):
             raise InvalidNameError(
                 "name must be one or more characters without spaces")
 
-        # 1. load state from db
-        state = self.load_from_db()
-
-        if tenant_name in state:
-            raise TenantAlreadyExistsError(
-                "tenant " + tenant_name + " already exists")
+    def _next_bundle(self, state):
+        """
+        _next_bundle generates the next set of vlan ids and subnets that are not
+        used by any tenant (or warm pool bundle) in state.
+        """
 
-        # 2. find the next two unused vlan ids
-        existing_vlan_ids = []
+        if self.ALLOCATION_MODE == SLOT_MODE:
+            free_slots = self._free_slots(state)
+            if not free_slots:
+                raise InsufficientVLANsAvailableError(
+                    self._no_free_slot_error())
+            return self.slot_bundle(free_slots[0])
 
-        for key in state:
-            existing_vlan_ids.append(state[key][self.KUBEAPI_VLAN_KEY])
-            existing_vlan_ids.append(state[key][self.SERVICE_VLAN_KEY])
+        indexes = self._indexes(state)
 
-        unused_vlan_ids = set(range(
-            self.VLAN_MIN, self.VLAN_MAX + 1)) - set(existing_vlan_ids)
-        unused_vlan_ids = sorted(list(unused_vlan_ids))
+        # 1. find the next two unused vlan ids
+        candidates, used = indexes["vlans"]
+        unused_vlan_ids = [v for v in candidates if v not in used]
 
         if len(unused_vlan_ids) < 2:
             raise InsufficientVLANsAvailableError(
                 "unable to allocate 2 vlan ids, only %d ids available" %
                 len(unused_vlan_ids))
 
-        # 3. find an unused service subnet
-        existing_svc_subnets = []
+        # 2. find an unused service subnet
+        svc_subnet = self._first_unused(indexes["service_subnets"])
+        if svc_subnet is None:
+            raise NoServiceSubnetsAvailableError(
+                "unable to find a free service subnet, %d are already allocated"
+                % len(indexes["service_subnets"][1]))
 
-        for key in state:
-            existing_svc_subnets.append(state[key][self.SERVICE_SUBNET_KEY])
+        # 3. find an unused multicast range
+        mcast_range = self._first_unused(indexes["multicast_ranges"])
+        if mcast_range is None:
+            raise NoMulticastRangesAvailableError(
+                "unable to find a free multicast range, %d are already allocated"
+                % len(indexes["multicast_ranges"][1]))
+
+        # 4. find an unused pod subnet
+        pod_subnet = self._first_unused(indexes["pod_subnets"])
+        if pod_subnet is None:
+            raise NoPodSubnetsAvailableError(
+                "unable to find a free pod subnet, %d are already allocated"
+                % len(indexes["pod_subnets"][1]))
+
+        return self._bundle(unused_vlan_ids[0], unused_vlan_ids[1],
+                            svc_subnet, mcast_range, pod_subnet)
+
+    @staticmethod
+    def _first_unused(index):
+        candidates, used = index
+        for candidate in candidates:
+            if candidate not in used:
+                return candidate
+        return None
+
+    # function that returns a bundle with the given vlan ids and the
+    # service subnet, multicast range and pod subnet whose IP addresses are
+    # the integers svc_subnet, mcast_range and pod_subnet
+    def _bundle(self, kubeapi_vlan, service_vlan, svc_subnet, mcast_range,
+                pod_subnet):
+        mcast_range_start, mcast_range_end = mcast_range_bounds(mcast_range)
+        svc_subnet = int_to_ip(svc_subnet) + self._svc_subnet_prefix
+        pod_subnet = int_to_ip(pod_subnet) + self._pod_subnet_prefix
+        return {
+            self.KUBEAPI_VLAN_KEY: kubeapi_vlan,
+            self.SERVICE_VLAN_KEY: service_vlan,
+            self.SERVICE_SUBNET_KEY: svc_subnet,
+            self.MULTICAST_RANGE_START_KEY: int_to_ip(mcast_range_start),
+            self.MULTICAST_RANGE_END_KEY: int_to_ip(mcast_range_end),
+            self.POD_SUBNET_KEY: pod_subnet
+        }
 
-        svc_subnet = self.SERVICE_SUBNET
-        svc_subnet_found = False
+    def free(self, tenant_name):
+        with self.etcd_client.lock(self.LOCK_NAME):
+            return self.__locked_free(tenant_name)
 
-        for i in range(0, self.MAX_VLANS):
-            if svc_subnet in existing_svc_subnets:
-                try:
-                    svc_subnet = generate_next_subnet(svc_subnet)
-                except InvalidIPError:
-                    raise NoServiceSubnetsAvailableError()
+    def __locked_free(self, tenant_name):
+        while True:
+            # 1. load state from db
+            state, head = self._load()
 
-                continue
+            # 2. delete the tenant key
+            if tenant_name in state:
+                bundle = state.pop(tenant_name, None)
             else:
-                svc_subnet_found = True
-                break
+                raise TenantDoesNotExistError(
+                    "tenant " + tenant_name + " does not exist")
+            changes = {tenant_name: None}
 
-        if not svc_subnet_found:
-            raise NoServiceSubnetsAvailableError(
-                "unable to find a free service subnet, %d are already allocated"
-                % len(existing_svc_subnets))
+            # 3. return the bundle to the warm pool if the pool is not full
+            if len(self._warm_pool_names(state)) < self.WARM_POOL_SIZE:
+                changes.update(self._add_to_warm_pool(state, bundle))
 
-        # 4. find an unused multicast range
-        existing_mcast_ranges = []
+            # 4. append the changes to the state log
+            if self._append("free", changes, head):
+                return
 
-        for key in state:
-            parts = state[key][self.MULTICAST_RANGE_START_KEY].split('.')
-            r = parts[0] + "." + parts[1] + ".0.0/16"
-            existing_mcast_ranges.append(r)
+    def get(self, tenant_name):
+        with self.etcd_client.lock(self.LOCK_NAME):
+            return self.__locked_get(tenant_name)
 
-        mcast_range = self.MULTICAST_RANGE
-        mcast_range_found = False
+    def __locked_get(self, tenant_name):
+        return self.load_from_db().get(tenant_name, {})
 
-        for i in range(0, self.MAX_VLANS):
-            if mcast_range in existing_mcast_ranges:
+    def fill_warm_pool(self):
+        """
+        fill_warm_pool pre-reserves bundles until the warm pool has
+        WARM_POOL_SIZE bundles. All the new bundles are stored in one event.
+        Returns the number of bundles added to the warm pool.
+        """
+
+        with self.etcd_client.lock(self.LOCK_NAME):
+            while True:
+                state, head = self._load()
+
+                missing = self.WARM_POOL_SIZE - len(
+                    self._warm_pool_names(state))
+                changes = {}
                 try:
-                    mcast_range = generate_next_subnet(mcast_range, "/16")
-                except InvalidIPError:
-                    raise NoMulticastRangesAvailableError()
+                    for i in range(missing):
+                        changes.update(self._add_to_warm_pool(
+                            state, self._next_bundle(state)))
+                except (InsufficientVLANsAvailableError,
+                        NoServiceSubnetsAvailableError,
+                        NoMulticastRangesAvailableError,
+                        NoPodSubnetsAvailableError):
+                    # keep the bundles that could be reserved
+                    pass
+
+                if not changes or self._append("fill_warm_pool", changes,
+                                               head):
+                    return len(changes)
+
+    def claim(self, tenant_name):
+        """
+        claim atomically hands out a bundle from the warm pool to the named
+        tenant without taking the allocation lock. Returns {} if the warm
+        pool is empty.
+        """
 
-                continue
+        self._validate_tenant_name(tenant_name)
+
+        while True:
+            state, head = self._load()
+
+            if tenant_name in state:
+                raise TenantAlreadyExistsError(
+                    "tenant " + tenant_name + " already exists")
+
+            names = self._warm_pool_names(state)
+            if not names:
+                return {}
+
+            # hand out the bundle with the lowest vlan ids first
+            name = min(names, key=lambda n: state[n][self.KUBEAPI_VLAN_KEY])
+            bundle = state.pop(name)
+            bundle['aci_config.system_id'] = tenant_name
+
+            if self._append("claim", {name: None, tenant_name: bundle}, head):
+                return bundle
+
+    def warm_pool_count(self):
+        return len(self._warm_pool_names(self.load_from_db()))
+
+    def _warm_pool_names(self, state):
+        return [k for k in state if k.startswith(self.WARM_POOL_PREFIX)]
+
+    # function to add a bundle to the warm pool in state, returns the change
+    def _add_to_warm_pool(self, state, bundle):
+        name = self.WARM_POOL_PREFIX + uuid.uuid4().hex
+        bundle['aci_config.system_id'] = name
+        state[name] = bundle
+        return {name: bundle}
+
+    # number of clusters the vlan ids of the pool are enough for (and the
+    # number of slots of the pool)
+    def max_clusters(self):
+        return (self.VLAN_MAX - self.VLAN_MIN + 1) // 2
+
+    # function that returns the bundle of slot i: vlan ids VLAN_MIN + 2i and
+    # VLAN_MIN + 2i + 1, and the i-th service subnet, multicast range and
+    # pod subnet
+    def slot_bundle(self, i):
+        if not 0 <= i < self.max_clusters():
+            raise ValueError("slot must be >= 0 and < %d (got %d)" %
+                             (self.max_clusters(), i))
+        offset = i * SUBNET_STEP
+        return self._bundle(self.VLAN_MIN + 2 * i, self.VLAN_MIN + 2 * i + 1,
+                            self._svc_subnet + offset,
+                            self._mcast_range + offset,
+                            self._pod_subnet + offset)
+
+    # function that returns the slot of bundle, or None if the values of
+    # bundle are not all the values of one slot
+    def slot_of(self, bundle):
+        offset = bundle[self.KUBEAPI_VLAN_KEY] - self.VLAN_MIN
+        if offset < 0 or offset % 2 != 0 or \
+           offset // 2 >= self.max_clusters():
+            return None
+        slot = self.slot_bundle(offset // 2)
+        if any(bundle.get(k) != v for k, v in slot.items()):
+            return None
+        return offset // 2
+
+    # function that returns the slots that have one of the vlan ids,
+    # subnets or multicast ranges of bundle
+    def _slots_used_by(self, bundle):
+        slots = set()
+        for key in [self.KUBEAPI_VLAN_KEY, self.SERVICE_VLAN_KEY]:
+            if bundle[key] >= self.VLAN_MIN:
+                slots.add((bundle[key] - self.VLAN_MIN) // 2)
+        for value, start in [
+            (parse_subnet(bundle[self.SERVICE_SUBNET_KEY])[0],
+             self._svc_subnet),
+            (ip_to_int(bundle[self.MULTICAST_RANGE_START_KEY]) &
+             prefix_mask(16), self._mcast_range),
+            (parse_subnet(bundle[self.POD_SUBNET_KEY])[0], self._pod_subnet)
+        ]:
+            if value >= start and (value - start) % SUBNET_STEP == 0:
+                slots.add((value - start) // SUBNET_STEP)
+        return set(i for i in slots if i < self.max_clusters())
+
+    # function that returns the slots none of whose values are used by the
+    # bundles in state, in order (bundles handed out in first_fit mode may
+    # use the values of several slots)
+    def _free_slots(self, state):
+        used = set()
+        for bundle in state.values():
+            slot = self.slot_of(bundle)
+            if slot is not None:
+                used.add(slot)
             else:
-                mcast_range_found = True
-                break
-
-        if not mcast_range_found:
-            raise NoMulticastRangesAvailableError(
-                "unable to find a free multicast range, %d are already allocated"
-                % len(existing_mcast_ranges))
+                used |= self._slots_used_by(bundle)
+        return [i for i in range(self.max_clusters()) if i not in used]
+
+    def _no_free_slot_error(self):
+        return "unable to find a free slot, all %d slots of vlan ids and " \
+               "subnets are used" % self.max_clusters()
+
+    # function that returns the IP addresses (integers) that _next_bundle()
+    # tries in order for the subnets (or multicast ranges) starting at the
+    # integer start: start and the next MAX_VLANS - 1 /16 blocks, or less if
+    # the IP addresses run out
+    def _candidates(self, start):
+        return range(start, min(start + self.MAX_VLANS * SUBNET_STEP,
+                                MAX_IP + 1), SUBNET_STEP)
+
+    # function that returns the indexes of the allocations in state: for the
+    # vlan ids, service subnets, multicast ranges and pod subnets, the values
+    # _next_bundle() can hand out in the order it tries them, and the set of
+    # the values used by the tenants and the warm pool (subnets and
+    # multicast ranges are the integers of their IP addresses)
+    def _indexes(self, state):
+        used_vlans = set()
+        used_svc_subnets = set()
+        used_mcast_ranges = set()
+        used_pod_subnets = set()
+        mcast_mask = prefix_mask(16)
+        for key in state:
+            bundle = state[key]
+            used_vlans.add(bundle[self.KUBEAPI_VLAN_KEY])
+            used_vlans.add(bundle[self.SERVICE_VLAN_KEY])
+            used_svc_subnets.add(
+                parse_subnet(bundle[self.SERVICE_SUBNET_KEY])[0])
+            used_mcast_ranges.add(
+                ip_to_int(bundle[self.MULTICAST_RANGE_START_KEY]) & mcast_mask)
+            used_pod_subnets.add(parse_subnet(bundle[self.POD_SUBNET_KEY])[0])
+
+        return {
+            "vlans": (range(self.VLAN_MIN, self.VLAN_MAX + 1), used_vlans),
+            "service_subnets": (self._candidates(self._svc_subnet),
+                                used_svc_subnets),
+            "multicast_ranges": (self._candidates(self._mcast_range),
+                                 used_mcast_ranges),
+            "pod_subnets": (self._candidates(self._pod_subnet),
+                            used_pod_subnets)
+        }
 
-        mcast_range_start, mcast_range_end = start_and_end_addresses_for_mcast_range(
-            mcast_range)
+    # function that returns the capacity, use and fragmentation of one
+    # index: free_runs is the number of runs of consecutive free values,
+    # holes the free values before the last used one, and fragmentation
+    # the share of the free values outside the largest free run
+    @staticmethod
+    def _index_stats(candidates, used):
+        free = 0
+        free_runs = 0
+        largest_free_run = 0
+        run = 0
+        last_used = -1
+        for i, candidate in enumerate(candidates):
+            if candidate in used:
+                last_used = i
+                run = 0
+                continue
+            free += 1
+            if run == 0:
+                free_runs += 1
+            run += 1
+            largest_free_run = max(largest_free_run, run)
+
+        holes = sum(1 for c in candidates[:last_used + 1] if c not in used)
+        return {
+            "capacity": len(candidates),
+            "used": len(candidates) - free,
+            "free": free,
+            "free_runs": free_runs,
+            "largest_free_run": largest_free_run,
+            "holes": holes,
+            "fragmentation":
+            0.0 if free == 0 else
+            round(1 - float(largest_free_run) / free, 3)
+        }
 
-        # 5. find an unused pod subnet
-        existing_pod_subnets = []
+    def usage(self, state=None):
+        """
+        usage returns the use of the pool's vlan ids, service subnets,
+        multicast ranges and pod subnets (with fragmentation stats), the
+        number of tenants and warm pool bundles, and the number of new
+        clusters the pool still has room for (clusters_remaining).
+        Nothing is written to etcd.
+        """
 
-        for key in state:
-            existing_pod_subnets.append(state[key][self.POD_SUBNET_KEY])
+        if state is None:
+            state = self.load_from_db()
+        indexes = self._indexes(state)
+        stats = dict((name, self._index_stats(*index))
+                     for name, index in indexes.items())
+
+        warm_pool = len(self._warm_pool_names(state))
+        free_slots = len(self._free_slots(state))
+        usage = {
+            "pool": self.pool or "default",
+            "allocation_mode": self.ALLOCATION_MODE,
+            "clusters": len(state) - warm_pool,
+            "warm_pool": warm_pool,
+            # new clusters claim the warm pool bundles first, and every new
+            # bundle needs 2 vlan ids and one of each of the others (or a
+            # free slot)
+            "clusters_remaining": warm_pool + (
+                free_slots if self.ALLOCATION_MODE == SLOT_MODE else min(
+                    stats["vlans"]["free"] // 2,
+                    stats["service_subnets"]["free"],
+                    stats["multicast_ranges"]["free"],
+                    stats["pod_subnets"]["free"])),
+            # bundles that are not on a slot are moved by compaction
+            "slots": {
+                "capacity": self.max_clusters(),
+                "free": free_slots,
+                "misaligned": sum(1 for b in state.values()
+                                  if self.slot_of(b) is None)
+            }
+        }
+        usage.update(stats)
+        return usage
 
-        pod_subnet = self.POD_SUBNET
-        pod_subnet_found = False
+    def plan(self, count):
+        """
+        plan returns the bundles that the next count new clusters would get
+        (from the warm pool first, then new bundles as reserve() generates
+        them), whether the pool has room for all of them (feasible), the
+        error the first cluster that does not fit would get, and the usage
+        of the pool after them. Nothing is written to etcd.
+        """
 
-        for i in range(0, self.MAX_VLANS):
-            if pod_subnet in existing_pod_subnets:
-                try:
-                    pod_subnet = generate_next_subnet(pod_subnet, "/16")
-                except InvalidIPError:
-                    raise NoPodSubnetsAvailableError()
+        if count < 0:
+            raise ValueError("count must be >= 0 (got %d)" % count)
 
+        state = self.load_from_db()
+        plan = {"pool": self.pool or "default", "count": count, "error": None}
+        bundles = []
+
+        # the warm pool bundles with the lowest vlan ids are claimed first
+        warm_pool = sorted(self._warm_pool_names(state),
+                           key=lambda n: state[n][self.KUBEAPI_VLAN_KEY])
+        for name in warm_pool[:count]:
+            bundle = dict(state[name])
+            bundle.pop('aci_config.system_id', None)
+            bundles.append({"source": "warm_pool", "bundle": bundle})
+
+        # new bundles take the first free slots, or the first free values of
+        # every index in order, like _next_bundle() does
+        indexes = self._indexes(state)
+        free = dict((name, [c for c in candidates if c not in used])
+                    for name, (candidates, used) in indexes.items())
+        free_slots = self._free_slots(state)
+        planned_state = dict(state)
+        while len(bundles) < count:
+            if self.ALLOCATION_MODE == SLOT_MODE:
+                if not free_slots:
+                    plan["error"] = self._no_free_slot_error()
+                    break
+                bundle = self.slot_bundle(free_slots.pop(0))
+                planned_state["__plan__%d" % len(bundles)] = bundle
+                bundles.append({"source": "new", "bundle": bundle})
                 continue
-            else:
-                pod_subnet_found = True
+
+            if len(free["vlans"]) < 2:
+                plan["error"] = "unable to allocate 2 vlan ids, only %d " \
+                                "ids available" % len(free["vlans"])
+                break
+            if not free["service_subnets"]:
+                plan["error"] = "unable to find a free service subnet"
+                break
+            if not free["multicast_ranges"]:
+                plan["error"] = "unable to find a free multicast range"
+                break
+            if not free["pod_subnets"]:
+                plan["error"] = "unable to find a free pod subnet"
                 break
 
-        if not pod_subnet_found:
-            raise NoServiceSubnetsAvailableError(
-                "unable to find a free service subnet, %d are already allocated"
-                % len(existing_svc_subnets))
+            bundle = self._bundle(free["vlans"].pop(0),
+                                  free["vlans"].pop(0),
+                                  free["service_subnets"].pop(0),
+                                  free["multicast_ranges"].pop(0),
+                                  free["pod_subnets"].pop(0))
+            planned_state["__plan__%d" % len(bundles)] = bundle
+            bundles.append({"source": "new", "bundle": bundle})
+
+        for name in warm_pool[:count]:
+            # claimed warm pool bundles belong to tenants
+            planned_state["__plan__" + name] = planned_state.pop(name)
+
+        plan["feasible"] = plan["error"] is None
+        plan["planned"] = len(bundles)
+        plan["bundles"] = bundles
+        plan["usage_after"] = self.usage(planned_state)
+        return plan
+
+    def plan_compaction(self, tenants=True, state=None):
+        """
+        plan_compaction returns the moves that put the bundles of the pool
+        on slots, and the usage of the pool after them. Nothing is written
+        to etcd.
+
+        The bundles that are on a slot stay, so the fewest bundles move,
+        and a bundle that moves goes to the free slot that keeps most of
+        its values (the lowest free slot if none of them is free). Only the
+        warm pool bundles move unless tenants is True, the bundles of the
+        clusters then block the slots of their values. error is set if
+        there are not enough free slots for the bundles.
+        """
 
-        # 6. update the state object, convert to json, store in db
-        state[tenant_name] = {
-            'aci_config.system_id': tenant_name,
-            self.KUBEAPI_VLAN_KEY: unused_vlan_ids.pop(0),
-            self.SERVICE_VLAN_KEY: unused_vlan_ids.pop(0),
-            self.SERVICE_SUBNET_KEY: svc_subnet,
-            self.MULTICAST_RANGE_START_KEY: mcast_range_start,
-            self.MULTICAST_RANGE_END_KEY: mcast_range_end,
-            self.POD_SUBNET_KEY: pod_subnet
+        if state is None:
+            state = self.load_from_db()
+        warm_pool = set(self._warm_pool_names(state))
+
+        taken = set()
+        aligned = 0
+        to_move = []
+        for name in sorted(state):
+            slot = self.slot_of(state[name])
+            if slot is not None and slot not in taken:
+                taken.add(slot)
+                aligned += 1
+            elif tenants or name in warm_pool:
+                to_move.append(name)
+            else:
+                taken |= self._slots_used_by(state[name])
+
+        # the clusters get the slots they prefer before the warm pool
+        to_move.sort(key=lambda n: (n in warm_pool, n))
+        free_slots = [i for i in range(self.max_clusters()) if i not in taken]
+        moves = []
+        planned_state = dict(state)
+        changed_fields = 0
+        for name in to_move:
+            if not free_slots:
+                break
+            bundle = state[name]
+            best = None
+            for i in sorted(self._slots_used_by(bundle) - taken):
+                kept = sum(1 for k, v in self.slot_bundle(i).items()
+                           if bundle.get(k) == v)
+                if best is None or kept > best[1]:
+                    best = (i, kept)
+            slot = best[0] if best is not None else free_slots[0]
+            taken.add(slot)
+            free_slots.remove(slot)
+
+            new_bundle = self.slot_bundle(slot)
+            new_bundle['aci_config.system_id'] = name
+            changes = dict((k, [bundle.get(k), v])
+                           for k, v in new_bundle.items()
+                           if bundle.get(k) != v)
+            changed_fields += len(changes)
+            planned_state[name] = new_bundle
+            moves.append({
+                "name": name,
+                "warm_pool": name in warm_pool,
+                "slot": slot,
+                "changes": changes
+            })
+
+        error = None
+        if len(moves) < len(to_move):
+            error = "%d bundles don't fit in the free slots: %s" % (
+                len(to_move) - len(moves), self._no_free_slot_error())
+
+        return {
+            "pool": self.pool or "default",
+            "tenants": tenants,
+            "bundles": len(state),
+            "aligned": aligned,
+            "error": error,
+            "feasible": error is None,
+            "changed_fields": changed_fields,
+            "moves": moves,
+            "usage_after": self.usage(planned_state)
         }
 
-        self.store_in_db(state)  # TODO: check result or just let it raise?
+    def apply_compaction(self, tenants=False):
+        """
+        apply_compaction moves the bundles of plan_compaction() to their
+        slots under the allocation lock, in one event of the state log.
+        Returns the plan that was applied. Raises CompactionError if the
+        bundles don't fit in the free slots.
+
+        The values of the bundle of a cluster are configured on ACI and in
+        its ACI CNI, so the bundles of the clusters are only moved if
+        tenants is True, and every moved cluster needs an update
+        (/api/v1/acc_provision_update) to push its new bundle to ACI.
+        """
 
-        # 6. return state object
-        return state[tenant_name]
+        applied = {}
 
-    def free(self, tenant_name):
-        with self.etcd_client.lock(self.LOCK_NAME):
-            return self.__locked_free(tenant_name)
+        def update(state):
+            plan = self.plan_compaction(tenants, state)
+            if plan["error"] is not None:
+                raise CompactionError(plan["error"])
+            applied["plan"] = plan
+            changes = {}
+            for move in plan["moves"]:
+                bundle = self.slot_bundle(move["slot"])
+                bundle['aci_config.system_id'] = move["name"]
+                changes[move["name"]] = bundle
+            return changes
 
-    def __locked_free(self, tenant_name):
-        # 1. load state from db
-        state = self.load_from_db()
+        self.modify("compact_slots", update)
+        return applied["plan"]
 
-        # 2. delete the tenant key
-        if tenant_name in state:
-            state.pop(tenant_name, None)
-        else:
-            raise TenantDoesNotExistError(
-                "tenant " + tenant_name + " does not exist")
+    def validate_ranges(self):
+        """
+        validate_ranges checks that the service subnets, multicast ranges and
+        pod subnets of the pool are enough for max_clusters() clusters.
+        Raises InvalidPoolRangeError if the allocator would run out of IP
+        addresses, or hand out multicast ranges outside 224.0.0.0/4, before
+        it runs out of vlan ids. Returns warnings about the ranges that
+        overlap each other after some clusters.
+        """
 
-        # 3. store in db
-        self.store_in_db(state)  # TODO: check result
+        max_clusters = self.max_clusters()
+        name = self.pool or "default"
+        sequences = [
+            ("service subnets", self._candidates(self._svc_subnet)),
+            ("multicast ranges", self._candidates(self._mcast_range)),
+            ("pod subnets", self._candidates(self._pod_subnet))
+        ]
+
+        for what, candidates in sequences:
+            if len(candidates) < max_clusters:
+                raise InvalidPoolRangeError(
+                    "pool %s: only %d %s fit before 255.255.0.0, but the "
+                    "vlan ids are enough for %d clusters" %
+                    (name, len(candidates), what, max_clusters))
+
+        mcast_ranges = sequences[1][1][:max_clusters]
+        # 224.0.0.0/4 is contiguous, so checking the first and last is enough
+        for mcast_range in [mcast_ranges[0], mcast_ranges[-1]]:
+            if mcast_range >> 28 != 0xE:
+                raise InvalidPoolRangeError(
+                    "pool %s: multicast range %s/16 of the %d clusters is "
+                    "not a multicast range" %
+                    (name, int_to_ip(mcast_range), max_clusters))
+
+        if self._pod_subnet & 255 != 1:
+            raise InvalidPoolRangeError(
+                "pool %s: DEFAULT_POD_SUBNET %s has to end with .1" %
+                (name, self.POD_SUBNET))
+
+        # every subnet of a cluster takes a /16 block (or a /24 inside it),
+        # find the number of clusters after which two sequences share a block
+        warnings = []
+        for i in range(len(sequences)):
+            for j in range(i + 1, len(sequences)):
+                blocks_i = set()
+                blocks_j = set()
+                for n in range(max_clusters):
+                    blocks_i.add(sequences[i][1][n] >> 16)
+                    blocks_j.add(sequences[j][1][n] >> 16)
+                    if blocks_i & blocks_j:
+                        warnings.append(
+                            "pool %s: %s and %s overlap after %d clusters "
+                            "(the vlan ids are enough for %d clusters)" %
+                            (name, sequences[i][0], sequences[j][0], n,
+                             max_clusters))
+                        break
+        return warnings
+
+    def out_of_range(self, state=None):
+        """
+        out_of_range returns the names of the bundles in state (the state
+        of the pool if it is not given) with a vlan id, service subnet,
+        multicast range or pod subnet that the pool can't hand out, like
+        after the ranges of the pool are changed in config_file.
+        """
+
+        if state is None:
+            state = self.load_from_db()
+        svc_subnets = set(self._candidates(self._svc_subnet))
+        mcast_ranges = set(self._candidates(self._mcast_range))
+        pod_subnets = set(self._candidates(self._pod_subnet))
+
+        names = []
+        for name in sorted(state):
+            bundle = state[name]
+            if not self.VLAN_MIN <= bundle[self.KUBEAPI_VLAN_KEY] <= \
+               self.VLAN_MAX or \
+               not self.VLAN_MIN <= bundle[self.SERVICE_VLAN_KEY] <= \
+               self.VLAN_MAX or \
+               parse_subnet(bundle[self.SERVICE_SUBNET_KEY])[0] not in \
+               svc_subnets or \
+               ip_to_int(bundle[self.MULTICAST_RANGE_START_KEY]) & \
+               prefix_mask(16) not in mcast_ranges or \
+               parse_subnet(bundle[self.POD_SUBNET_KEY])[0] not in \
+               pod_subnets:
+                names.append(name)
+        return names
+
+    def modify(self, op, update):
+        """
+        modify changes the state under the allocation lock: update is called
+        with the state and returns the changes (a dict of tenant name to
+        bundle, None for a tenant to free), which are appended to the state
+        log as one event. Returns the changes.
+        """
 
-    def get(self, tenant_name):
         with self.etcd_client.lock(self.LOCK_NAME):
-            return self.__locked_get(tenant_name)
+            while True:
+                state, head = self._load()
+                changes = update(state)
+                if not changes or self._append(op, changes, head):
+                    return changes
 
-    def __locked_get(self, tenant_name):
-        return self.load_from_db().get(tenant_name, {})
+    def history(self):
+        """
+        history returns the events in the state log that are not compacted
+        into the snapshot yet, oldest first. Each event has its sequence
+        number (seq), time, operation (op) and changes, a dict of tenant
+        name to bundle (None for a freed tenant).
+        """
+
+        return self._read_log()[1]
 
     def load_from_db(self):
-        val = self.etcd_client.get(self.DB_KEY)[0]
+        return self._load()[0]
+
+    # The state is stored as a snapshot in DB_KEY plus an append-only log of
+    # the changes since the snapshot. Every reserve, free and claim appends
+    # one small event (DB_KEY + "__log/<seq>") and moves the log head
+    # (DB_KEY + "__log_head") to it in the same transaction, so the size of a
+    # write does not depend on the number of tenants. Every
+    # LOG_COMPACTION_INTERVAL events the log is folded into the snapshot.
+    def _log_key(self, seq):
+        return self.DB_KEY + "__log/%020d" % seq
+
+    def _head_key(self):
+        return self.DB_KEY + "__log_head"
+
+    def _snapshot_seq_key(self):
+        return self.DB_KEY + "__snapshot_seq"
+
+    # function to rebuild the state from the snapshot and the tail of the
+    # log, returns the state and the head the state was loaded at
+    def _load(self):
+        snapshot, events, head = self._read_log()
+        for event in events:
+            self._apply(snapshot, event["changes"])
+        return snapshot, head
+
+    # function to rebuild the state from values, a dict of the keys of the
+    # state to their values (like the result of one range read of the
+    # prefix DB_KEY), so that the states of many pools can be read at once
+    def state_from_values(self, values):
+        seq = int(values.get(self._head_key()) or 0)
+        snapshot_seq = int(values.get(self._snapshot_seq_key()) or 0)
+        state = json.loads(values[self.DB_KEY]) if values.get(self.DB_KEY) \
+            else {}
+        log_prefix = self.DB_KEY + "__log/"
+        events = [json.loads(v) for k, v in values.items()
+                  if k.startswith(log_prefix)]
+        for event in sorted(events, key=lambda e: e["seq"]):
+            if snapshot_seq < event["seq"] <= seq:
+                self._apply(state, event["changes"])
+        return state
+
+    # function to read a consistent snapshot and the events after it
+    def _read_log(self):
+        t = self.etcd_client.transactions
+        while True:
+            _, responses = self.etcd_client.transaction(
+                compare=[],
+                success=[
+                    t.get(self._head_key()),
+                    t.get(self.DB_KEY),
+                    t.get(self._snapshot_seq_key())
+                ],
+                failure=[])
+            head_kv, snapshot_kv, snapshot_seq_kv = [
+                r[0] if r else (None, None) for r in responses
+            ]
+
+            seq = int(head_kv[0]) if head_kv[0] else 0
+            revision = head_kv[1].mod_revision if head_kv[1] else 0
+            snapshot = json.loads(snapshot_kv[0]) if snapshot_kv[0] else {}
+            snapshot_seq = int(snapshot_seq_kv[0]) if snapshot_seq_kv[0] \
+                else 0
+
+            events = {}
+            for value, _ in self.etcd_client.get_prefix(
+                    self.DB_KEY + "__log/"):
+                event = json.loads(value)
+                if snapshot_seq < event["seq"] <= seq:
+                    events[event["seq"]] = event
+
+            # events are immutable, so the state at seq is complete unless a
+            # compaction deleted some of them after the snapshot was read
+            if len(events) == seq - snapshot_seq:
+                head = {
+                    "seq": seq,
+                    "revision": revision,
+                    "snapshot_seq": snapshot_seq
+                }
+                return snapshot, [events[k] for k in sorted(events)], head
+
+    @staticmethod
+    def _apply(state, changes):
+        for name, bundle in changes.items():
+            if bundle is None:
+                state.pop(name, None)
+            else:
+                state[name] = bundle
+
+    # function to append an event with changes to the log only if no other
+    # event was appended since the state was loaded at head
+    def _append(self, op, changes, head):
+        seq = head["seq"] + 1
+        event = {
+            "seq": seq,
+            "time": time.time(),
+            "op": op,
+            "changes": changes
+        }
+
+        t = self.etcd_client.transactions
+        succeeded, _ = self.etcd_client.transaction(
+            compare=[t.mod(self._head_key()) == head["revision"]],
+            success=[
+                t.put(self._head_key(), str(seq)),
+                t.put(self._log_key(seq), json.dumps(event))
+            ],
+            failure=[])
+
+        if succeeded and \
+           seq - head["snapshot_seq"] >= self.LOG_COMPACTION_INTERVAL:
+            self.compact()
+        return succeeded
+
+    def compact(self):
+        """
+        compact folds the events of the log into the snapshot and deletes
+        them. Returns the number of events folded.
+        """
 
-        if val:
-            return json.loads(val)
-        else:
-            return {}
+        while True:
+            snapshot, events, head = self._read_log()
+            if not events:
+                return 0
+
+            for event in events:
+                self._apply(snapshot, event["changes"])
+
+            t = self.etcd_client.transactions
+            succeeded, _ = self.etcd_client.transaction(
+                compare=[t.mod(self._head_key()) == head["revision"]],
+                success=[
+                    t.put(self.DB_KEY, json.dumps(snapshot)),
+                    t.put(self._snapshot_seq_key(), str(head["seq"]))
+                ],
+                failure=[])
+
+            if succeeded:
+                # the folded events are not read anymore
+                for event in events:
+                    self.etcd_client.delete(self._log_key(event["seq"]))
+                return len(events)
 
     def store_in_db(self, state):
-        # TODO: check that this was successful and raise if not
-        self.etcd_client.put(self.DB_KEY, json.dumps(state))
+        """
+        store_in_db replaces the whole state, the differences to the stored
+        state are appended to the log as one event.
+        """
 
+        while True:
+            stored, head = self._load()
+            changes = dict((k, None) for k in stored if k not in state)
+            changes.update((k, v) for k, v in state.items()
+                           if stored.get(k) != v)
+            if not changes or self._append("store", changes, head):
+                return
+
+
+# function to validate new ACI configurations aci_config of config_file
+# against the bundles handed out: the ranges of every pool must be valid
+# (see Allocator.validate_ranges()), the bundles of every pool must still be
+# in its ranges, and the pools of the old configurations old_aci_config
+# that have bundles can't be removed. Raises InvalidPoolRangeError (or the
+# ValueError of an invalid range), returns the warnings about the ranges.
+def validate_aci_config(etcd_client, aci_config, old_aci_config=None):
+    warnings = []
+    pools = [None] + pool_names(aci_config)
+    for pool in pools:
+        a = Allocator(etcd_client, aci_config=aci_config, pool=pool)
+        warnings += a.validate_ranges()
+        names = a.out_of_range()
+        if names:
+            raise InvalidPoolRangeError(
+                "pool %s: %d bundles are outside the new ranges (%s)" %
+                (pool or "default", len(names), ", ".join(names[:5])))
+
+    if old_aci_config is not None:
+        for pool in pool_names(old_aci_config):
+            if pool in pools:
+                continue
+            state = Allocator(etcd_client, aci_config=old_aci_config,
+                              pool=pool).load_from_db()
+            if state:
+                raise InvalidPoolRangeError(
+                    "pool %s has %d bundles and can't be removed" %
+                    (pool, len(state)))
+    return warnings
 
 # if __name__ == "__main__":
 #    etcd = etcd3.client()
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+# Copyright 2018 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# function that returns the dns of the managed objects acc-provision
+# creates on the APIC for a cluster with the given system_id
+#
+# these objects are the fingerprint of the cluster's fabric state: if they
+# exist, the configs created by acc-provision for the cluster exist
+def apic_object_dns(system_id):
+    return [
+        "uni/tn-" + system_id,
+        "uni/vmmp-Kubernetes/dom-" + system_id,
+        "uni/userext/user-" + system_id,
+    ]
+
+
+# classes of the managed objects in apic_object_dns()
+APIC_OBJECT_CLASSES = ["fvTenant", "vmmDomP", "aaaUser"]
+
+
+class ApicClient(object):
+    """
+    ApicClient is a minimal client of the APIC REST API. apic_host is an
+    entry of apic_hosts in the ACI input json (https is used unless the
+    entry has a scheme).
+    """
+
+    def __init__(self, apic_host, username, password, timeout=10):
+        if "://" not in apic_host:
+            apic_host = "https://" + apic_host
+        self.base_url = apic_host.rstrip('/')
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        # requests is only imported once an APIC is needed
+        import requests
+        # APICs usually have self-signed certificates, don't warn about
+        # every request that does not verify them
+        requests.packages.urllib3.disable_warnings()
+        self.session = requests.Session()
+        # acc-provision does not verify the APIC certificate either
+        self.session.verify = False
+
+    def login(self):
+        r = self.session.post(
+            self.base_url + "/api/aaaLogin.json",
+            json={
+                "aaaUser": {
+                    "attributes": {
+                        "name": self.username,
+                        "pwd": self.password
+                    }
+                }
+            },
+            timeout=self.timeout)
+        r.raise_for_status()
+        return self
+
+    # function to check if the managed object dn exists on the APIC
+    def exists(self, dn):
+        r = self.session.get(
+            self.base_url + "/api/mo/" + dn + ".json", timeout=self.timeout)
+        r.raise_for_status()
+        return int(r.json().get("totalCount", 0)) > 0
+
+    # function to check if all the managed objects in dns exist on the APIC
+    def all_exist(self, dns):
+        for dn in dns:
+            if not self.exists(dn):
+                return False
+        return True
+
+    # function that returns the dns of all the managed objects of
+    # class_name on the APIC (one request for any number of objects)
+    def class_dns(self, class_name):
+        r = self.session.get(
+            self.base_url + "/api/node/class/" + class_name + ".json",
+            timeout=self.timeout)
+        r.raise_for_status()
+        return set(mo.values()[0]["attributes"]["dn"]
+                   for mo in r.json().get("imdata", []))
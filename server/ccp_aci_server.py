@@ -24,17 +24,53 @@
 #                                                              #
 ################################################################
 
+import time
+
+# the startup of the server is timed from here, before the imports
+STARTED = time.time()
+
 import argparse
-import etcd3
+import functools
 import json
 import logging
+import os
 import sys
+import threading
+from certs import CertsEncryptionError, get_cipher
+from credentials import ADMIN_TOKEN_ENV, is_admin, redact_json
 from datetime import datetime
-from flask import Flask, jsonify
+from etcd_backend import ConnectionFailedError, MEMORY_BACKEND, new_etcd_client
+from flask import Flask, Response, jsonify
 from flask import request
+from idempotency import IDEMPOTENCY_HEADER, IdempotencyKeyMismatchError, \
+    IdempotencyRecord, request_hash
+from jobs import new_job_id
+from profiler import ProfilerBusyError, profile
+from scheduler import CALLER_HEADER
+from snapshot import SnapshotConflictError, SnapshotError, import_snapshot, \
+    iter_snapshot
 from server import *
+from startup import PREFLIGHT_TIMEOUT, StartupTimer, run_checks
 
 app = Flask(__name__)
+
+# phases of the startup of the server, and if it is ready
+startup = StartupTimer(STARTED)
+startup.mark("imports")
+
+# maximum seconds /api/v1/acc_provision_status waits for a job to finish
+MAX_STATUS_WAIT = 60
+
+# formats of the ACI CNI in the responses of /api/v1/acc_provision_status
+# and their content types: a json document with the ACI CNI in
+# aci_cni_response, or only the Kubernetes manifests of the ACI CNI as
+# multi-document YAML or one json document per line (NDJSON)
+STATUS_FORMATS = {
+    "json": "application/json",
+    "yaml": "application/yaml",
+    "ndjson": "application/x-ndjson"
+}
+
 parser = argparse.ArgumentParser()
 parser.add_argument(
     '--ip',
@@ -49,59 +85,178 @@ parser.add_argument(
     '--config_file',
     help='Path to config file. Default is aci.conf',
     default='aci.conf')
+parser.add_argument(
+    '--log_request_bodies',
+    help='Log the bodies of the http requests (without the ACI username '
+    'and password) in the debug logs',
+    action='store_true')
+parser.add_argument(
+    '--preflight_timeout',
+    help='Seconds the checks of etcd and acc-provision at startup may take. '
+    'Default is ' + str(PREFLIGHT_TIMEOUT),
+    type=int,
+    default=PREFLIGHT_TIMEOUT)
+parser.add_argument(
+    '--config_reload_interval',
+    help='Seconds between the checks of changes of config_file, 0 to not '
+    'reload it. Default is 5',
+    type=int,
+    default=5)
 parser.add_argument(
     'etcd_ip_port',
     help="etcd server's IP address or DNS name and port in the " \
-         "format <etcd's IP or DNS name>:<etcd port>")
+         "format <etcd's IP or DNS name>:<etcd port>, or \"memory\" " \
+         "to store the state in this process without an etcd server " \
+         "(the state is lost when the process exits)")
 args = parser.parse_args()
 
 # validate etcd_ip_port
-if ':' not in args.etcd_ip_port or \
-    not args.etcd_ip_port.split(':')[1].isdigit():
+if args.etcd_ip_port != MEMORY_BACKEND and \
+   (':' not in args.etcd_ip_port or \
+    not args.etcd_ip_port.split(':')[1].isdigit()):
     print "\nERROR: Invalid etcd_ip_port. etcd_ip_port's format is \
-           \n<IP address or DNS name of etcd server>:<port of etcd server>\n"
+           \n<IP address or DNS name of etcd server>:<port of etcd server> \
+           \nor \"memory\"\n"
 
     sys.exit(1)
 
-# validate if etcd server is up
-etcd_client = etcd3.client(
-    host=args.etcd_ip_port.split(':')[0], port=args.etcd_ip_port.split(':')[1])
-try:
-    etcd_client.get('foo')
-except Exception as e:
-    print type(e), str(e), "\n"
-    logging.exception(e)
-    print "\nERROR: etcd server not up at", args.etcd_ip_port, "\n"
-    import os
+etcd_client = new_etcd_client(args.etcd_ip_port)
+
+
+# function to print the error and exit the process when the server can't
+# start (from any thread)
+def exit_on_startup_error(*error):
+    print "\nERROR:", ' '.join(str(e) for e in error), "\n"
+    sys.stdout.flush()
     os._exit(1)
 
-# validate if "acc-provision" command works as CCP ACI service needs
-# the "acc-provision" command to work
-result = CcpAciServer.run_command("acc-provision -v")
-if result is None:
-    print "\nERROR: The command \"acc-provision -v\" did not work. " \
-           "CCP ACI service needs the \"acc-provision\" command to work.\n" \
-           "Install acc-provision and make sure that "\
-           "\"acc-provision -v\" works before starting this service.\n"
-    sys.exit(1)
 
-# at this point, it is safe to start the server as both etcd and acc-provision
-# are working
+# function to validate if etcd server is up
+def check_etcd():
+    etcd_client.get('foo')
+    return args.etcd_ip_port
+
+
+# function to validate if "acc-provision" command works as CCP ACI service
+# needs the "acc-provision" command to work, returns its version
+def check_acc_provision():
+    result = CcpAciServer.run_command(["acc-provision", "-v"])
+    if result is None:
+        raise Exception("it returned an error")
+    return result.replace('\n', '')
+
+
+# function to start the server: validate etcd and acc-provision (at the
+# same time, as acc-provision takes seconds to start), then the configs,
+# and start the background threads. The process exits if any of them
+# fails.
+def start_server():
+    checks = run_checks([("etcd", check_etcd),
+                         ("acc-provision", check_acc_provision)],
+                        args.preflight_timeout)
+    startup.checks.update(checks)
+    startup.mark("preflight")
+    if not checks["etcd"]["ok"]:
+        exit_on_startup_error("etcd server not up at", args.etcd_ip_port,
+                              "\n", checks["etcd"]["error"])
+    if not checks["acc-provision"]["ok"]:
+        exit_on_startup_error(
+            "The command \"acc-provision -v\" did not work "
+            "(" + checks["acc-provision"]["error"] + "). "
+            "CCP ACI service needs the \"acc-provision\" command to work.\n"
+            "Install acc-provision and make sure that "
+            "\"acc-provision -v\" works before starting this service.")
+
+    # validate that the subnets and multicast ranges of the allocator pools
+    # in config_file are enough for the vlan ids of the pools
+    pools = [None] + allocator.pool_names(
+        allocator.get_aci_config(args.config_file))
+    for pool in pools:
+        try:
+            for warning in allocator.Allocator(
+                    etcd_client, args.config_file,
+                    pool=pool).validate_ranges():
+                print "\nWARNING:", warning, "\n"
+        except ValueError as e:
+            exit_on_startup_error("Invalid allocator pool in",
+                                  args.config_file, "\n", str(e))
+
+    # validate the keys the ACI certificates and keys are encrypted with
+    try:
+        if get_cipher() is not None:
+            print "\nACI certificates and keys are encrypted in etcd\n"
+    except CertsEncryptionError as e:
+        exit_on_startup_error(str(e))
+    startup.mark("validation")
+
+    # use the changes of config_file (like new pools and larger ranges)
+    # without a restart
+    if args.config_reload_interval > 0:
+        AciConfigWatcher(etcd_client, args.config_file,
+                         args.config_reload_interval).start()
+
+    # at this point, it is safe to start the jobs as both etcd and
+    # acc-provision are working
+
+    # resume the jobs that did not finish before the last restart, or that
+    # were running on a replica that died
+    OrphanJobScanner(etcd_client, args.config_file).start()
+
+    # keep the warm pools of pre-reserved bundles full if they are enabled
+    # in config_file for the default pool or for any named pool
+    if any(allocator.Allocator(etcd_client, args.config_file, pool=pool).
+           WARM_POOL_SIZE > 0 for pool in pools):
+        WarmPoolFiller(etcd_client, args.config_file).start()
+    startup.mark("background_threads")
+
+    startup.ready = True
+    print "\nCCP ACI service is ready after", startup.report()["seconds"], \
+          "seconds", json.dumps(startup.phases), "\n"
+    sys.stdout.flush()
+
+
+# function to run start_server() in the startup thread
+def run_startup():
+    try:
+        start_server()
+    except Exception as e:
+        logging.exception(e)
+        exit_on_startup_error("Failed to start CCP ACI service:", type(e),
+                              str(e))
+
+
+# function to start the server in the background while the http server
+# starts listening, so that /healthz answers right away, and /readyz and
+# the APIs answer once the server is ready
+def start_in_background():
+    startup_thread = threading.Thread(target=run_startup, name="startup")
+    startup_thread.daemon = True
+    startup_thread.start()
+    return startup_thread
 
 
+# the request bodies are only read for the logs if --log_request_bodies is
+# given and debug logs are enabled, and they are not parsed (the ACI
+# username and password are blanked in the raw json)
 @app.before_request
 def log_request_info():
-    try:
-        req = json.loads(request.get_data())
-        # don't print ACI username and password in logs
-        req["aci_username"] = ""
-        req["aci_password"] = ""
+    if not args.log_request_bodies or \
+       not app.logger.isEnabledFor(logging.DEBUG):
+        return
+    body = request.get_data()
+    if body:
         app.logger.debug(
-            datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f') + ' Body: %s',
-            json.dumps(req))
-    except Exception:
-        # no need print debugs for invalid non-json payload
-        pass
+            datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f') + ' %s %s Body: %s',
+            request.method, request.path, redact_json(body))
+
+
+# the APIs are only served once the server is ready
+@app.before_request
+def check_ready():
+    if not startup.ready and request.path.startswith("/api/"):
+        return jsonify({
+            "error": "CCP ACI service is starting, re-try after few seconds"
+        }), 503
 
 
 # function to validate http request
@@ -122,9 +277,93 @@ def validate_http_request(request, create=False):
         return ''
 
 
+# function to set the tenant the acc-provision runs of the request's job
+# are scheduled for from the X-Ccp-Tenant header of the request (the ACI
+# username of the request if the header is missing)
+def set_caller(ccp_aci_server):
+    if request.headers.get(CALLER_HEADER):
+        ccp_aci_server.caller = request.headers.get(CALLER_HEADER)
+
+
+# decorator that only lets the requests with the admin token in
+# $CCP_ACI_ADMIN_TOKEN ("Authorization: Bearer <token>" header) call an
+# http endpoint, the admin endpoints answer 404 if the token is not set
+def admin_only(f):
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        if not os.environ.get(ADMIN_TOKEN_ENV):
+            return jsonify({
+                "error": "Admin endpoints are disabled, set " +
+                ADMIN_TOKEN_ENV + " to enable them"
+            }), 404
+        if not is_admin(request.headers.get("Authorization")):
+            return jsonify({"error": "Invalid admin token"}), 401
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
+# decorator that makes an http endpoint idempotent for the requests with an
+# Idempotency-Key header
+#
+# the first request with a key is handled and its response is stored in
+# etcd, retries and concurrent duplicates of the request with the same key
+# get the same response (and job_id) without starting another job. A key
+# that is used again for a different request gets 422.
+def idempotent(operation):
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+            if not idempotency_key or request.json is None:
+                return f(*args, **kwargs)
+
+            global etcd_client
+            record = IdempotencyRecord(etcd_client, idempotency_key)
+            try:
+                existing = record.reserve(
+                    operation, request_hash(operation, request.json))
+            except IdempotencyKeyMismatchError as e:
+                return jsonify({"error": str(e)}), 422
+
+            if existing is not None:
+                if existing["state"] != "completed":
+                    # the same request is being handled concurrently
+                    existing = record.wait()
+                if existing is None or existing["state"] != "completed":
+                    return jsonify({
+                        "error": "Request with the same " \
+                                 "Idempotency-Key still in progress... " \
+                                 "Re-try after few seconds."
+                    }), 409
+                response = app.response_class(
+                    existing["body"],
+                    status=existing["status_code"],
+                    mimetype="application/json")
+                response.headers["Idempotent-Replayed"] = "true"
+                return response
+
+            try:
+                response, status_code = f(*args, **kwargs)
+            except Exception:
+                record.discard()
+                raise
+            if status_code >= 500:
+                # let the client retry a failed request with the same key
+                record.discard()
+            else:
+                record.complete(status_code, response.get_data())
+            return response, status_code
+
+        return wrapper
+
+    return decorator
+
+
 # HTTP POST to create configs on ACI fabric asynchronously using acc-provision
 # and per-tenant input json for each CCP tenant cluster
 @app.route('/api/v1/acc_provision_create', methods=['POST'])
+@idempotent("create")
 def acc_provision_create():
     ccp_aci_server = None
 
@@ -137,15 +376,19 @@ def acc_provision_create():
 
         ccp_aci_server = CcpAciServer(request.json, etcd_client,
                                       args.config_file)
+        set_caller(ccp_aci_server)
+        ccp_aci_server.job_id = new_job_id()
 
-        # block duplicate cluster name in etcd
-        if ccp_aci_server.cluster_name_is_duplicate():
+        # block duplicate cluster name in etcd (the creation in progress is
+        # stored only if the cluster name does not exist yet, so concurrent
+        # creates of a cluster can't both start)
+        if not ccp_aci_server.begin_creation_in_etcd():
             return jsonify({
                 "error": "Duplicate cluster name " + request.json["ccp_cluster_name"] + \
                          ". Use a different cluster name."
             }), 400
 
-        async_task = CcpAciAsyncCreate(ccp_aci_server)
+        async_task = CcpAciAsyncCreate(ccp_aci_server, reserved=True)
 
         # configure ACI asynchronously in a different thread
         # (async_task.start() calls run() in CcpAciAsyncCreate class in a different thread)
@@ -155,7 +398,8 @@ def acc_provision_create():
         return jsonify({
             "response": "Request accepted to create ACI configs. "\
                         "Use http endpoint /api/v1/acc_provision_status "\
-                        "to get the ACI CNI for the cluster."
+                        "to get the ACI CNI for the cluster.",
+            "job_id": ccp_aci_server.job_id
         }), 202
 
     except Exception as e:
@@ -167,6 +411,31 @@ def acc_provision_create():
         return jsonify({"error": "Failed to configure ACI"}), 500
 
 
+# function that returns a response with the manifests of the ACI CNI (an
+# iterator over their json texts as stored in etcd) in output_format of
+# STATUS_FORMATS, and in "json" format with the fields too. The manifests
+# are streamed one at a time, json and NDJSON as they are stored without
+# decoding and encoding them again.
+def stream_aci_cni_response(fields, manifests, output_format="json"):
+    def generate():
+        if output_format == "json":
+            yield json.dumps(fields)[:-1] + ', "aci_cni_response": ['
+            for i, manifest in enumerate(manifests):
+                yield manifest if i == 0 else ", " + manifest
+            yield ']}'
+        elif output_format == "yaml":
+            import yaml
+            for manifest in manifests:
+                yield "---\n" + yaml.safe_dump(json.loads(manifest),
+                                               default_flow_style=False)
+        else:
+            for manifest in manifests:
+                yield manifest + "\n"
+
+    return Response(generate(), status=200,
+                    mimetype=STATUS_FORMATS[output_format])
+
+
 # HTTP GET that returns the per-cluster ACI CNI as json if it exists
 # in etcd
 #
@@ -178,6 +447,13 @@ def acc_provision_create():
 # after deleting using /api/v1/acc_provision_delete, if this function
 # returns 404 as the http status code, then it means the deletion succeeded
 #
+# the optional query parameter wait=<seconds> (up to MAX_STATUS_WAIT) makes
+# this function wait for the creation, update or deletion of the cluster in
+# progress to finish before returning (long-poll), instead of the client
+# polling it
+#
+# the optional query parameter format (one of STATUS_FORMATS, json by
+# default) returns the ACI CNI as YAML or NDJSON instead
 @app.route('/api/v1/acc_provision_status', methods=['GET'])
 def acc_provision_status():
     try:
@@ -185,13 +461,28 @@ def acc_provision_status():
         if err != '':
             return jsonify({"error": err}), 400
 
+        try:
+            wait = float(request.args.get("wait", 0))
+        except ValueError:
+            return jsonify({"error": "wait must be a number of seconds"}), 400
+
         global etcd_client
 
         ccp_aci_server = CcpAciServer(request.json, etcd_client,
                                       args.config_file)
 
+        # the ACI CNI is only read and sent if the client asks for it
+        manifests = request.args.get("manifests", "true").lower() != "false"
+        output_format = request.args.get("format", "json")
+        if output_format not in STATUS_FORMATS:
+            return jsonify({"error": "format must be one of " +
+                            ", ".join(sorted(STATUS_FORMATS))}), 400
+
+        if wait > 0:
+            ccp_aci_server.wait_for_job(min(wait, MAX_STATUS_WAIT))
+
         allocator_state, aci_cni = ccp_aci_server.get_aci_cni_for_cluster_from_etcd(
-        )
+            manifests, as_json=True)
 
         if not aci_cni:
             msg =  "ERROR: ACI CNI not found for cluster. "\
@@ -203,20 +494,37 @@ def acc_provision_status():
                    "means the deletion was successful."
             return jsonify({"error": msg}), 404
 
-        elif 'in progress' in aci_cni:
+        elif allocator_state == "":
+            # creation in progress
             return jsonify({"message": aci_cni}), 200
 
-        else:
-            # send allocator state and ACI CNI as json in response
+        elif not manifests:
+            # send allocator state and the number of manifests of the ACI
+            # CNI as json in response
             return jsonify({
                 "ccp_cluster_name":
                 request.json["ccp_cluster_name"],
                 "allocator_state":
                 allocator_state,
-                "aci_cni_response":
-                aci_cni
+                "completed":
+                True,
+                "manifests":
+                aci_cni.get("manifests"),
+                "update_in_progress":
+                aci_cni.get("update_in_progress", False)
             }), 200
 
+        else:
+            # send allocator state and ACI CNI as json in response
+            return stream_aci_cni_response({
+                "ccp_cluster_name":
+                request.json["ccp_cluster_name"],
+                "allocator_state":
+                allocator_state,
+                "update_in_progress":
+                ccp_aci_server.update_in_progress()
+            }, aci_cni, output_format)
+
     except Exception as e:
         print "\nERROR: acc_provision_status failed\n"
         print type(e), str(e), "\n"
@@ -227,6 +535,7 @@ def acc_provision_status():
 # HTTP DELETE to delete configs on ACI fabric asynchronously using acc-provision
 # and per-tenant input json for each CCP tenant cluster
 @app.route('/api/v1/acc_provision_delete', methods=['DELETE'])
+@idempotent("delete")
 def acc_provision_delete():
     ccp_aci_server = None
 
@@ -240,6 +549,18 @@ def acc_provision_delete():
         ccp_aci_server = CcpAciServer(request.json, etcd_client,
                                       args.config_file)
 
+        # coalesce with the deletion of the cluster that is running already
+        job = ccp_aci_server.journal.get()
+        if job is not None and job["operation"] == "delete":
+            return jsonify({
+                "response": "Deletion of ACI configs already in progress. "\
+                            "Use http endpoint /api/v1/acc_provision_status "\
+                            "to get the status.",
+                "job_id": job.get("job_id")
+            }), 202
+
+        set_caller(ccp_aci_server)
+        ccp_aci_server.job_id = new_job_id()
         async_task = CcpAciAsyncDelete(ccp_aci_server)
 
         # delete ACI configs asynchronously in a different thread
@@ -250,7 +571,8 @@ def acc_provision_delete():
         return jsonify({
             "response": "Request accepted to delete ACI configs. "\
                         "Use http endpoint /api/v1/acc_provision_status "\
-                        "to get the status."
+                        "to get the status.",
+            "job_id": ccp_aci_server.job_id
         }), 202
 
     except Exception as e:
@@ -262,19 +584,289 @@ def acc_provision_delete():
         return jsonify({"error": "Failed to delete ACI configs"}), 500
 
 
+# HTTP PUT to update configs on ACI fabric and the ACI CNI of a created
+# cluster asynchronously using acc-provision and the new input json
+#
+# the cluster keeps its allocator state, so this can be used to change the
+# input json of a cluster without deleting and creating it again
+@app.route('/api/v1/acc_provision_update', methods=['PUT'])
+@idempotent("update")
+def acc_provision_update():
+    ccp_aci_server = None
+
+    try:
+        err = validate_http_request(request.json, create=True)
+        if err != '':
+            return jsonify({"error": err}), 400
+
+        global etcd_client
+
+        ccp_aci_server = CcpAciServer(request.json, etcd_client,
+                                      args.config_file)
+
+        # only one update of a created cluster at a time
+        status_code, err = ccp_aci_server.begin_update_in_etcd()
+        if err != '':
+            return jsonify({"error": err}), status_code
+
+        set_caller(ccp_aci_server)
+        ccp_aci_server.job_id = new_job_id()
+        async_task = CcpAciAsyncUpdate(ccp_aci_server)
+
+        # update ACI asynchronously in a different thread
+        # (async_task.start() calls run() in CcpAciAsyncUpdate class in a different thread)
+        async_task.start()
+
+        # send json response back
+        return jsonify({
+            "response": "Request accepted to update ACI configs. "\
+                        "Use http endpoint /api/v1/acc_provision_status "\
+                        "to get the updated ACI CNI for the cluster "\
+                        "after update_in_progress is false.",
+            "job_id": ccp_aci_server.job_id
+        }), 202
+
+    except Exception as e:
+        print "\nERROR: acc_provision_update failed\n"
+        print type(e), str(e), "\n"
+        logging.exception(e)
+        if ccp_aci_server is not None:
+            ccp_aci_server.cleanup_files()
+        return jsonify({"error": "Failed to update ACI configs"}), 500
+
+
+# HTTP GET that returns the metrics of the scheduler of the acc-provision
+# runs of this server replica: the running and queued runs, and the queue
+# wait of every priority class
+@app.route('/api/v1/metrics', methods=['GET'])
+def metrics():
+    return jsonify({"scheduler": scheduler.metrics()}), 200
+
+
+# HTTP POST (admin) that profiles the threads of this server replica for
+# the seconds in the query parameter "seconds" (10 by default) and returns
+# their stacks in the folded format of flame graphs (or as json with the
+# samples and lock waits of every thread with format=json)
+#
+# the query parameter "threads" has comma separated prefixes of the names
+# of the threads to profile, like "create-,delete-" for the create and
+# delete jobs (all the threads by default)
+@app.route('/api/v1/admin/profile', methods=['POST'])
+@admin_only
+def admin_profile():
+    try:
+        output_format = request.args.get("format", "folded")
+        if output_format not in ["folded", "json"]:
+            return jsonify({"error": "format must be folded or json"}), 400
+        try:
+            seconds = float(request.args.get("seconds", 10))
+            interval = float(request.args.get("interval", 0.01))
+            prefixes = request.args.get("threads", "").split(",")
+            sampler = profile(seconds, interval, prefixes)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except ProfilerBusyError as e:
+            return jsonify({"error": str(e)}), 409
+
+        if output_format == "json":
+            return jsonify(sampler.report()), 200
+        return Response(sampler.folded(), mimetype="text/plain"), 200
+
+    except Exception as e:
+        print "\nERROR: admin_profile failed\n"
+        print type(e), str(e), "\n"
+        logging.exception(e)
+        return jsonify({"error": "Failed to profile the threads"}), 500
+
+
+# function that returns the allocator of the pool in the query parameter
+# "pool" of the request (the default pool if it is not given)
+def get_allocator_for_request():
+    global etcd_client
+    return allocator.Allocator(
+        etcd_client, args.config_file, pool=request.args.get("pool"))
+
+
+# HTTP GET that returns the use of the vlan ids, service subnets, multicast
+# ranges and pod subnets of every allocator pool (or of the pool in the
+# query parameter "pool"), the number of clusters each pool still has room
+# for, and fragmentation stats
+@app.route('/api/v1/allocator/usage', methods=['GET'])
+def allocator_usage():
+    try:
+        if request.args.get("pool") is not None:
+            pools = [request.args.get("pool")]
+        else:
+            pools = [None] + allocator.pool_names(
+                allocator.get_aci_config(args.config_file))
+
+        global etcd_client
+        return jsonify({
+            "config": allocator.aci_configs.info(args.config_file),
+            "pools": [
+                allocator.Allocator(
+                    etcd_client, args.config_file, pool=pool).usage()
+                for pool in pools
+            ]
+        }), 200
+
+    except allocator.UnknownPoolError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        print "\nERROR: allocator_usage failed\n"
+        print type(e), str(e), "\n"
+        logging.exception(e)
+        return jsonify({"error": "Failed to get allocator usage"}), 500
+
+
+# HTTP GET that returns the bundles of vlan ids and subnets the next count
+# (query parameter) new clusters of the default allocator pool (or of the
+# pool in the query parameter "pool") would get, and whether the pool has
+# room for all of them. Nothing is reserved.
+@app.route('/api/v1/allocator/plan', methods=['GET'])
+def allocator_plan():
+    try:
+        try:
+            count = int(request.args.get("count", ""))
+            if count < 0:
+                raise ValueError()
+        except ValueError:
+            return jsonify({
+                "error": "count must be a number of clusters >= 0"
+            }), 400
+
+        return jsonify(get_allocator_for_request().plan(count)), 200
+
+    except allocator.UnknownPoolError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        print "\nERROR: allocator_plan failed\n"
+        print type(e), str(e), "\n"
+        logging.exception(e)
+        return jsonify({"error": "Failed to plan allocations"}), 500
+
+
+# HTTP GET that returns the moves that would put the bundles of the
+# default allocator pool (or of the pool in the query parameter "pool") on
+# slots, see Allocator.plan_compaction(). The bundles of the clusters only
+# move with tenants=true. Nothing is written.
+@app.route('/api/v1/allocator/compaction', methods=['GET'])
+def allocator_compaction():
+    try:
+        tenants = request.args.get("tenants", "false").lower() == "true"
+        return jsonify(
+            get_allocator_for_request().plan_compaction(tenants)), 200
+
+    except allocator.UnknownPoolError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        print "\nERROR: allocator_compaction failed\n"
+        print type(e), str(e), "\n"
+        logging.exception(e)
+        return jsonify({"error": "Failed to plan the compaction"}), 500
+
+
+# HTTP POST (admin) that moves the bundles of the default allocator pool
+# (or of the pool in the query parameter "pool") to slots and returns the
+# moves, see Allocator.apply_compaction()
+@app.route('/api/v1/admin/allocator/compaction', methods=['POST'])
+@admin_only
+def admin_allocator_compaction():
+    try:
+        tenants = request.args.get("tenants", "false").lower() == "true"
+        return jsonify(
+            get_allocator_for_request().apply_compaction(tenants)), 200
+
+    except allocator.UnknownPoolError as e:
+        return jsonify({"error": str(e)}), 404
+    except allocator.CompactionError as e:
+        return jsonify({"error": str(e)}), 409
+    except Exception as e:
+        print "\nERROR: admin_allocator_compaction failed\n"
+        print type(e), str(e), "\n"
+        logging.exception(e)
+        return jsonify({"error": "Failed to compact the allocator pool"}), 500
+
+
+# HTTP GET (admin) that streams a snapshot of the allocator state of every
+# pool and of the status of the clusters, see snapshot.iter_snapshot(). The
+# ACI input json, manifests and certs of the clusters are left out with
+# blobs=false.
+@app.route('/api/v1/admin/snapshot', methods=['GET'])
+@admin_only
+def admin_snapshot_export():
+    global etcd_client
+    blobs = request.args.get("blobs", "true").lower() == "true"
+    return Response(
+        iter_snapshot(etcd_client, args.config_file, blobs),
+        status=200,
+        mimetype="application/octet-stream",
+        headers={
+            "Content-Disposition": "attachment; filename=ccp_aci.snapshot"
+        })
+
+
+# HTTP POST (admin) that imports the snapshot in the body of the request,
+# see snapshot.import_snapshot(). The state in etcd is only replaced with
+# replace=true.
+@app.route('/api/v1/admin/snapshot', methods=['POST'])
+@admin_only
+def admin_snapshot_import():
+    try:
+        global etcd_client
+        replace = request.args.get("replace", "false").lower() == "true"
+        return jsonify(
+            import_snapshot(etcd_client, request.stream, args.config_file,
+                            replace)), 200
+
+    except SnapshotConflictError as e:
+        return jsonify({"error": str(e)}), 409
+    except SnapshotError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print "\nERROR: admin_snapshot_import failed\n"
+        print type(e), str(e), "\n"
+        logging.exception(e)
+        return jsonify({"error": "Failed to import the snapshot"}), 500
+
+
+# HTTP GET for httpGet of kubernetes' livenessProbe: the server answers,
+# without checking etcd or acc-provision, so that the server is not
+# restarted when they are down
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return jsonify({"status": "ok"}), 200
+
+
+# HTTP GET for httpGet of kubernetes' readinessProbe: the server is ready
+# (the checks at startup passed) and etcd is up. Returns the startup
+# timings of the server.
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    report = startup.report()
+    if not startup.ready:
+        return jsonify(report), 503
+    try:
+        global etcd_client
+        etcd_client.get('foo')
+    except Exception as e:
+        print type(e), str(e), "\n"
+        report["error"] = "etcd server not up at " + args.etcd_ip_port
+        return jsonify(report), 503
+    return jsonify(report), 200
+
+
 # HTTP GET that checks if etcd is healthy and returns the supported APIs
 # and version of acc-provision tool
 #
-# this url can be used for httpGet of kubernetes' livenessProbe
-# to probe the health of this service in k8s
+# /healthz and /readyz are cheaper probes of the health of this service in
+# k8s, as this url runs acc-provision
 #
 @app.route('/', methods=['GET'])
 def acc_provision_get():
     try:
-        e = etcd3.client(
-            host=args.etcd_ip_port.split(':')[0],
-            port=args.etcd_ip_port.split(':')[1])
-        e.get('foo')
+        global etcd_client
+        etcd_client.get('foo')
         result = CcpAciServer.run_command("acc-provision -v")
         if result is None:
             raise Exception("Failed to run the command \"acc-provision -v\"")
@@ -284,14 +876,26 @@ def acc_provision_get():
                 result.replace('\n', ''),
                 'url': [
                     'HTTP POST   /api/v1/acc_provision_create',
+                    'HTTP PUT    /api/v1/acc_provision_update',
                     'HTTP DELETE /api/v1/acc_provision_delete',
-                    'HTTP GET    /api/v1/acc_provision_status', 'HTTP GET    /'
+                    'HTTP GET    /api/v1/acc_provision_status',
+                    'HTTP GET    /api/v1/allocator/usage',
+                    'HTTP GET    /api/v1/allocator/plan?count=<clusters>',
+                    'HTTP GET    /api/v1/allocator/compaction',
+                    'HTTP GET    /api/v1/metrics',
+                    'HTTP POST   /api/v1/admin/profile?seconds=<seconds>',
+                    'HTTP POST   /api/v1/admin/allocator/compaction',
+                    'HTTP GET    /api/v1/admin/snapshot',
+                    'HTTP POST   /api/v1/admin/snapshot',
+                    'HTTP GET    /healthz',
+                    'HTTP GET    /readyz',
+                    'HTTP GET    /'
                 ],
                 'git_sha1':
                 CcpAciServer.get_version().replace('\n', '')
             }
         }), 200
-    except etcd3.exceptions.ConnectionFailedError as e:
+    except ConnectionFailedError as e:
         err = "ERROR: etcd server not up at " + args.etcd_ip_port
         print "\n", err, "\n"
         print type(e), str(e), "\n"
@@ -305,4 +909,14 @@ def acc_provision_get():
 
 
 if __name__ == '__main__':
-    app.run(host=args.ip, port=args.port, debug=True, threaded=True)
+    # the reloader of flask's debug mode serves the requests in a child
+    # process (WERKZEUG_RUN_MAIN is set in the child), so the server is only
+    # started in the child then
+    use_reloader = True
+    if not use_reloader or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_in_background()
+    app.run(host=args.ip, port=args.port, debug=True,
+            use_reloader=use_reloader, threaded=True)
+else:
+    # served by another WSGI server
+    start_in_background()
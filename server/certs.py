@@ -0,0 +1,116 @@
+#!/usr/bin/python
+
+# Copyright 2018 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+
+# prefix of the etcd keys of the ACI certificates and keys of the clusters
+CERTS_KEY_PREFIX = "/acc_provision_certs__"
+
+# environment variable with the keys the ACI certificates and keys are
+# encrypted with in etcd: comma separated Fernet keys (generated with
+# cryptography.fernet.Fernet.generate_key()), the first key encrypts and
+# all of them decrypt, so that a new key can be added in front of the old
+# one to rotate keys. The certificates and keys are not encrypted if it is
+# not set.
+ENCRYPTION_KEY_ENV = "CCP_ACI_CERTS_ENCRYPTION_KEY"
+
+
+class CertsEncryptionError(Exception):
+    pass
+
+
+# function that returns the cipher for the comma separated Fernet keys in
+# $CCP_ACI_CERTS_ENCRYPTION_KEY (or in encryption_keys if it is given), or
+# None if there are no keys
+def get_cipher(encryption_keys=None):
+    if encryption_keys is None:
+        encryption_keys = os.environ.get(ENCRYPTION_KEY_ENV, "")
+    keys = [k.strip() for k in encryption_keys.split(",") if k.strip()]
+    if not keys:
+        return None
+
+    # cryptography is installed in the image (see the Dockerfile and
+    # requirements.txt), it is only imported when encryption is used
+    try:
+        from cryptography.fernet import Fernet, MultiFernet
+    except ImportError:
+        raise CertsEncryptionError(
+            "the cryptography package is needed to encrypt the ACI "
+            "certificates and keys")
+    try:
+        return MultiFernet([Fernet(k) for k in keys])
+    except (TypeError, ValueError) as e:
+        raise CertsEncryptionError("invalid " + ENCRYPTION_KEY_ENV + ": " +
+                                   str(e))
+
+
+class CertStore(object):
+    """
+    CertStore keeps the ACI certificate and key file of every cluster in
+    /acc_provision_certs__<cluster name>__ccp, apart from the status record
+    of the cluster with its large ACI CNI, so that they are only read when
+    they are needed (to delete or update the configs on ACI) and status
+    reads don't carry key material.
+
+    If a cipher is given, the certificate and key are stored encrypted.
+    """
+
+    def __init__(self, etcd_client, cipher=None):
+        self.etcd_client = etcd_client
+        self.cipher = cipher
+
+    @staticmethod
+    def key(ccp_cluster_name):
+        # key format in etcd is:
+        # /acc_provision_certs__<cluster name>__ccp
+        return CERTS_KEY_PREFIX + ccp_cluster_name + "__ccp"
+
+    def put(self, ccp_cluster_name, crt_file, key_file):
+        certs = json.dumps({"crt_file": crt_file, "key_file": key_file})
+        if self.cipher is not None:
+            record = {"encrypted": True, "certs": self.cipher.encrypt(certs)}
+        else:
+            record = {"encrypted": False, "certs": certs}
+        self.etcd_client.put(self.key(ccp_cluster_name), json.dumps(record))
+
+    # function that returns the certificate and key file of the cluster, or
+    # None if they are not stored
+    def get(self, ccp_cluster_name):
+        value = self.etcd_client.get(self.key(ccp_cluster_name))[0]
+        if value is None:
+            return None
+
+        record = json.loads(value)
+        certs = record["certs"]
+        if record["encrypted"]:
+            if self.cipher is None:
+                raise CertsEncryptionError(
+                    "the ACI certificate and key of cluster " +
+                    ccp_cluster_name + " are encrypted, but " +
+                    ENCRYPTION_KEY_ENV + " is not set")
+            try:
+                certs = self.cipher.decrypt(str(certs))
+            except Exception:
+                raise CertsEncryptionError(
+                    "the ACI certificate and key of cluster " +
+                    ccp_cluster_name + " can't be decrypted with the keys "
+                    "in " + ENCRYPTION_KEY_ENV)
+        certs = json.loads(certs)
+        return certs["crt_file"], certs["key_file"]
+
+    def delete(self, ccp_cluster_name):
+        self.etcd_client.delete(self.key(ccp_cluster_name))
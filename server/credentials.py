@@ -0,0 +1,83 @@
+#!/usr/bin/python
+
+# Copyright 2018 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hmac
+import os
+import re
+
+# environment variable acc-provision reads the APIC password from when it
+# is not given with -p
+ACC_PROVISION_PASSWORD_ENV = "ACC_PROVISION_PASS"
+
+# environment variable with the token of the admin endpoints (like the
+# profiler), they are disabled if it is not set
+ADMIN_TOKEN_ENV = "CCP_ACI_ADMIN_TOKEN"
+
+# fields of the http payloads that are not logged
+SENSITIVE_FIELDS = ["aci_username", "aci_password"]
+
+# maximum number of bytes of a request body that are logged
+MAX_LOGGED_BODY = 4096
+
+
+# function that returns the environment of an acc-provision run with the
+# APIC password
+#
+# the password is not passed on the command line, because the command
+# lines of all the processes can be read by every user in /proc/<pid>/cmdline
+# and end up in the logs, while /proc/<pid>/environ is only readable by the
+# user of the process
+def command_env(password):
+    env = dict(os.environ)
+    env[ACC_PROVISION_PASSWORD_ENV] = password
+    return env
+
+
+# function that returns a regex that matches the string values of fields
+# in a json document
+def _fields_regex(fields):
+    return re.compile(r'("(?:' + '|'.join(re.escape(f) for f in fields) +
+                      r')"\s*:\s*)"(?:[^"\\]|\\.)*"')
+
+
+_SENSITIVE_FIELDS_REGEX = _fields_regex(SENSITIVE_FIELDS)
+
+
+# function that returns the json document body with the string values of
+# SENSITIVE_FIELDS (at any depth) blanked and cut to limit bytes
+#
+# the body is not parsed, so this works for large and invalid bodies too
+def redact_json(body, limit=MAX_LOGGED_BODY):
+    body = _SENSITIVE_FIELDS_REGEX.sub(r'\1""', body)
+    if len(body) > limit:
+        body = body[:limit] + "... (" + str(len(body)) + " bytes)"
+    return body
+
+
+# function that returns True if the Authorization header of a request
+# ("Bearer <token>") has the admin token in $CCP_ACI_ADMIN_TOKEN (or in
+# admin_token if it is given), False if the admin endpoints are disabled
+def is_admin(authorization, admin_token=None):
+    if admin_token is None:
+        admin_token = os.environ.get(ADMIN_TOKEN_ENV, "")
+    if not admin_token or not authorization:
+        return False
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer":
+        return False
+    # compared in constant time so that the token can't be guessed from
+    # the time the comparison takes
+    return hmac.compare_digest(str(token.strip()), str(admin_token))
@@ -0,0 +1,620 @@
+#!/usr/bin/python
+
+# Copyright 2018 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+################################################################
+#                                                              #
+# Storage backends for the Allocator and CcpAciServer classes  #
+#                                                              #
+# Both classes only use the subset of the etcd3 client API     #
+# listed in ETCD_CLIENT_INTERFACE, so any object implementing  #
+# it can be used as their etcd_client:                         #
+#                                                              #
+#   * etcd3.client() talks to a real etcd server               #
+#   * MemoryEtcd is a thread-safe in-process stand-in with the #
+#     same semantics (revisions, leases, locks, transactions   #
+#     and watches) for tests, benchmarks and single-node       #
+#     deployments without an etcd sidecar                     #
+#                                                              #
+# new_etcd_client("memory") returns the process-wide           #
+# MemoryEtcd and new_etcd_client("<ip>:<port>") returns an     #
+# etcd3 client                                                 #
+#                                                              #
+################################################################
+
+import itertools
+import Queue
+import threading
+import time
+import uuid
+
+MEMORY_BACKEND = "memory"
+
+# etcd3 client methods that the Allocator and CcpAciServer classes use
+ETCD_CLIENT_INTERFACE = (
+    "get",
+    "get_prefix",
+    "put",
+    "delete",
+    "delete_prefix",
+    "transaction",
+    "transactions",
+    "lease",
+    "lock",
+    "watch",
+    "watch_prefix",
+    "watch_once",
+    "add_watch_callback",
+    "cancel_watch",
+)
+
+LOCK_PREFIX = '/locks/'
+
+_memory_etcd = None
+_memory_etcd_lock = threading.Lock()
+
+
+# use etcd3's exceptions if the etcd3 package is installed so that callers
+# can catch the same exceptions for both backends
+try:
+    from etcd3.exceptions import ConnectionFailedError, WatchTimedOut
+except ImportError:
+
+    class ConnectionFailedError(Exception):
+        pass
+
+    class WatchTimedOut(Exception):
+        pass
+
+
+# function to create the etcd client for etcd_ip_port
+#
+# etcd_ip_port is either "memory" for the in-process MemoryEtcd or
+# "<etcd's IP or DNS name>:<etcd port>" for an etcd server
+def new_etcd_client(etcd_ip_port):
+    global _memory_etcd
+
+    if etcd_ip_port == MEMORY_BACKEND:
+        # all the requests in the process must share one MemoryEtcd
+        with _memory_etcd_lock:
+            if _memory_etcd is None:
+                _memory_etcd = MemoryEtcd()
+            return _memory_etcd
+
+    import etcd3
+    return etcd3.client(
+        host=etcd_ip_port.split(':')[0], port=etcd_ip_port.split(':')[1])
+
+
+# function to check if an event from a watch of either backend is a delete
+def is_delete_event(event):
+    return type(event).__name__ == "DeleteEvent"
+
+
+def _to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+
+# function to get the end of the key range for a prefix
+# (same as etcd3.utils.increment_last_byte)
+def _prefix_range_end(prefix):
+    prefix = _to_bytes(prefix)
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class KVMetadata(object):
+    def __init__(self, key, create_revision, mod_revision, version,
+                 lease_id):
+        self.key = key
+        self.create_revision = create_revision
+        self.mod_revision = mod_revision
+        self.version = version
+        self.lease_id = lease_id
+
+
+class Event(object):
+    def __init__(self, key, value, metadata):
+        self.key = key
+        self.value = value
+        self.create_revision = metadata.create_revision
+        self.mod_revision = metadata.mod_revision
+        self.version = metadata.version
+        self.lease = metadata.lease_id
+
+    def __str__(self):
+        return '{type} key={key} value={value}'.format(
+            type=self.__class__, key=self.key, value=self.value)
+
+
+class PutEvent(Event):
+    pass
+
+
+class DeleteEvent(Event):
+    pass
+
+
+# comparisons and operations of a transaction with the same interface as
+# etcd3.transactions
+class _Compare(object):
+    def __init__(self, key):
+        self.key = _to_bytes(key)
+        self.value = None
+        self.op = None
+
+    def __eq__(self, other):
+        self.value, self.op = other, "=="
+        return self
+
+    def __ne__(self, other):
+        self.value, self.op = other, "!="
+        return self
+
+    def __lt__(self, other):
+        self.value, self.op = other, "<"
+        return self
+
+    def __gt__(self, other):
+        self.value, self.op = other, ">"
+        return self
+
+    def evaluate(self, kv):
+        if self.op is None:
+            raise ValueError('op must be one of =, < or >')
+        actual = self.target(kv)
+        expected = self.value
+        if isinstance(actual, str):
+            expected = _to_bytes(expected)
+        if self.op == "==":
+            return actual == expected
+        elif self.op == "!=":
+            return actual != expected
+        elif self.op == "<":
+            return actual < expected
+        return actual > expected
+
+
+class Value(_Compare):
+    def target(self, kv):
+        return kv.value if kv is not None else ''
+
+
+class Version(_Compare):
+    def target(self, kv):
+        return kv.version if kv is not None else 0
+
+
+class Create(_Compare):
+    def target(self, kv):
+        return kv.create_revision if kv is not None else 0
+
+
+class Mod(_Compare):
+    def target(self, kv):
+        return kv.mod_revision if kv is not None else 0
+
+
+class Put(object):
+    def __init__(self, key, value, lease=None):
+        self.key = key
+        self.value = value
+        self.lease = lease
+
+
+class Get(object):
+    def __init__(self, key):
+        self.key = key
+
+
+class Delete(object):
+    def __init__(self, key):
+        self.key = key
+
+
+class Transactions(object):
+    def __init__(self):
+        self.value = Value
+        self.version = Version
+        self.create = Create
+        self.mod = Mod
+
+        self.put = Put
+        self.get = Get
+        self.delete = Delete
+
+
+class _KeyValue(object):
+    def __init__(self, key, value, create_revision, mod_revision, version,
+                 lease_id):
+        self.key = key
+        self.value = value
+        self.create_revision = create_revision
+        self.mod_revision = mod_revision
+        self.version = version
+        self.lease_id = lease_id
+
+    def metadata(self):
+        return KVMetadata(self.key, self.create_revision, self.mod_revision,
+                          self.version, self.lease_id)
+
+
+class _DeleteRangeResponse(object):
+    def __init__(self, deleted):
+        self.deleted = deleted
+
+
+class Lease(object):
+    def __init__(self, lease_id, ttl, etcd_client):
+        self.id = lease_id
+        self.ttl = ttl
+        self.etcd_client = etcd_client
+
+    def revoke(self):
+        self.etcd_client.revoke_lease(self.id)
+
+    def refresh(self):
+        return list(self.etcd_client.refresh_lease(self.id))
+
+    @property
+    def remaining_ttl(self):
+        return self.etcd_client._remaining_ttl(self.id)
+
+    @property
+    def granted_ttl(self):
+        return self.ttl
+
+
+# class Lock implements the same locking protocol as etcd3.locks.Lock
+# (a /locks/<name> key created under a lease in a transaction), but waits
+# for changes of the in-process store instead of an etcd watch
+class Lock(object):
+    def __init__(self, name, ttl=60, etcd_client=None):
+        self.name = name
+        self.ttl = ttl
+        self.etcd_client = etcd_client
+        self.key = LOCK_PREFIX + self.name
+        self.lease = None
+        self.uuid = uuid.uuid1().bytes
+
+    def acquire(self, timeout=10):
+        deadline = None if timeout is None else time.time() + timeout
+        client = self.etcd_client
+
+        while True:
+            with client._changed:
+                revision = client.revision
+                lease = client.lease(self.ttl)
+                success, _ = client.transaction(
+                    compare=[client.transactions.create(self.key) == 0],
+                    success=[
+                        client.transactions.put(
+                            self.key, self.uuid, lease=lease)
+                    ],
+                    failure=[])
+                if success:
+                    self.lease = lease
+                    return True
+                client.revoke_lease(lease.id)
+
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                client._wait_for_change(revision, remaining)
+
+    def release(self):
+        success, _ = self.etcd_client.transaction(
+            compare=[self.etcd_client.transactions.value(self.key) == self.uuid],
+            success=[self.etcd_client.transactions.delete(self.key)],
+            failure=[])
+        return success
+
+    def refresh(self):
+        if self.lease is not None:
+            return self.lease.refresh()
+        else:
+            raise ValueError('No lease associated with this lock - have you '
+                             'acquired the lock yet?')
+
+    def is_acquired(self):
+        uuid, _ = self.etcd_client.get(self.key)
+        if uuid is None:
+            return False
+        return uuid == self.uuid
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.release()
+
+
+class MemoryEtcd(object):
+    def __init__(self):
+        # every modification of the store increments the revision
+        # like etcd does
+        self.revision = 1
+        self.transactions = Transactions()
+
+        self._kvs = {}
+        self._leases = {}  # lease id -> [ttl, expiry time]
+        self._lease_ids = itertools.count(1)
+        self._watch_ids = itertools.count(1)
+        self._watches = {}  # watch id -> (key, range_end, callback)
+
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+
+        # watch callbacks run in one dispatcher thread in the order of
+        # the events like they do in etcd3's watcher thread
+        self._events = Queue.Queue()
+        self._dispatcher = None
+
+    # ----- key-value --------------------------------------------------------
+
+    def get(self, key):
+        with self._lock:
+            self._expire_leases()
+            kv = self._kvs.get(_to_bytes(key))
+            if kv is None:
+                return None, None
+            return kv.value, kv.metadata()
+
+    def get_prefix(self, key_prefix, sort_order=None, sort_target='key'):
+        return self._get_range(
+            _to_bytes(key_prefix), _prefix_range_end(key_prefix),
+            sort_order, sort_target)
+
+    def get_all(self, sort_order=None, sort_target='key'):
+        return self._get_range('', None, sort_order, sort_target)
+
+    def _get_range(self, key, range_end, sort_order, sort_target):
+        with self._lock:
+            self._expire_leases()
+            kvs = [
+                kv for k, kv in self._kvs.items()
+                if k >= key and (range_end is None or k < range_end)
+            ]
+
+        if sort_target == 'key' or sort_target is None:
+            kvs.sort(key=lambda kv: kv.key)
+        else:
+            kvs.sort(key=lambda kv: getattr(kv, sort_target))
+        if sort_order == 'descend':
+            kvs.reverse()
+
+        for kv in kvs:
+            yield (kv.value, kv.metadata())
+
+    def put(self, key, value, lease=None):
+        with self._lock:
+            self._expire_leases()
+            self._put(key, value, lease)
+            self._commit()
+
+    def replace(self, key, initial_value, new_value):
+        status, _ = self.transaction(
+            compare=[self.transactions.value(key) == initial_value],
+            success=[self.transactions.put(key, new_value)],
+            failure=[])
+        return status
+
+    def delete(self, key):
+        with self._lock:
+            self._expire_leases()
+            deleted = self._delete([_to_bytes(key)])
+            if deleted:
+                self._commit()
+            return deleted >= 1
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            self._expire_leases()
+            range_end = _prefix_range_end(prefix)
+            deleted = self._delete([
+                k for k in self._kvs
+                if k >= _to_bytes(prefix) and k < range_end
+            ])
+            if deleted:
+                self._commit()
+            return _DeleteRangeResponse(deleted)
+
+    def transaction(self, compare, success=None, failure=None):
+        with self._lock:
+            self._expire_leases()
+            succeeded = all(
+                c.evaluate(self._kvs.get(c.key)) for c in compare)
+            ops = success if succeeded else failure
+
+            responses = []
+            modified = False
+            for op in ops or []:
+                if isinstance(op, Put):
+                    self._put(op.key, op.value, op.lease)
+                    modified = True
+                    responses.append(None)
+                elif isinstance(op, Get):
+                    kv = self._kvs.get(_to_bytes(op.key))
+                    responses.append([] if kv is None else [(kv.value,
+                                                             kv.metadata())])
+                elif isinstance(op, Delete):
+                    if self._delete([_to_bytes(op.key)]):
+                        modified = True
+                else:
+                    raise Exception(
+                        'Unknown request class {}'.format(op.__class__))
+
+            # all the operations of a transaction share one revision
+            if modified:
+                self._commit()
+            return succeeded, responses
+
+    # ----- leases -----------------------------------------------------------
+
+    def lease(self, ttl, lease_id=None):
+        with self._lock:
+            if lease_id is None:
+                lease_id = next(self._lease_ids)
+            self._leases[lease_id] = [ttl, time.time() + ttl]
+            return Lease(lease_id, ttl, self)
+
+    def revoke_lease(self, lease_id):
+        with self._lock:
+            if self._leases.pop(lease_id, None) is not None:
+                if self._delete([
+                        k for k, kv in self._kvs.items()
+                        if kv.lease_id == lease_id
+                ]):
+                    self._commit()
+
+    def refresh_lease(self, lease_id):
+        with self._lock:
+            self._expire_leases()
+            if lease_id in self._leases:
+                ttl = self._leases[lease_id][0]
+                self._leases[lease_id][1] = time.time() + ttl
+                return [ttl]
+            return []
+
+    def _remaining_ttl(self, lease_id):
+        with self._lock:
+            self._expire_leases()
+            if lease_id not in self._leases:
+                return -1
+            return int(self._leases[lease_id][1] - time.time())
+
+    def _expire_leases(self):
+        now = time.time()
+        for lease_id, (_, expiry) in self._leases.items():
+            if expiry <= now:
+                self.revoke_lease(lease_id)
+
+    # ----- locks ------------------------------------------------------------
+
+    def lock(self, name, ttl=60):
+        return Lock(name, ttl=ttl, etcd_client=self)
+
+    # ----- watches ----------------------------------------------------------
+
+    def add_watch_callback(self, key, callback, range_end=None, **kwargs):
+        with self._lock:
+            watch_id = next(self._watch_ids)
+            self._watches[watch_id] = (_to_bytes(key), range_end, callback)
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(
+                    target=self._dispatch_events, name="MemoryEtcdWatcher")
+                self._dispatcher.daemon = True
+                self._dispatcher.start()
+            return watch_id
+
+    def cancel_watch(self, watch_id):
+        with self._lock:
+            self._watches.pop(watch_id, None)
+
+    def watch(self, key, **kwargs):
+        event_queue = Queue.Queue()
+        watch_id = self.add_watch_callback(key, event_queue.put, **kwargs)
+        canceled = threading.Event()
+
+        def cancel():
+            canceled.set()
+            event_queue.put(None)
+            self.cancel_watch(watch_id)
+
+        def iterator():
+            while not canceled.is_set():
+                event = event_queue.get()
+                if event is None:
+                    canceled.set()
+                if not canceled.is_set():
+                    yield event
+
+        return iterator(), cancel
+
+    def watch_prefix(self, key_prefix, **kwargs):
+        kwargs['range_end'] = _prefix_range_end(key_prefix)
+        return self.watch(key_prefix, **kwargs)
+
+    def watch_once(self, key, timeout=None, **kwargs):
+        event_queue = Queue.Queue()
+        watch_id = self.add_watch_callback(key, event_queue.put, **kwargs)
+        try:
+            return event_queue.get(timeout=timeout)
+        except Queue.Empty:
+            raise WatchTimedOut()
+        finally:
+            self.cancel_watch(watch_id)
+
+    def watch_prefix_once(self, key_prefix, timeout=None, **kwargs):
+        kwargs['range_end'] = _prefix_range_end(key_prefix)
+        return self.watch_once(key_prefix, timeout=timeout, **kwargs)
+
+    def _dispatch_events(self):
+        while True:
+            callback, event = self._events.get()
+            try:
+                callback(event)
+            except Exception:
+                pass
+
+    # ----- internal (called with self._lock held) ---------------------------
+
+    def _put(self, key, value, lease):
+        key = _to_bytes(key)
+        lease_id = lease.id if isinstance(lease, Lease) else (lease or 0)
+        revision = self.revision + 1
+        kv = self._kvs.get(key)
+        if kv is None:
+            kv = _KeyValue(key, _to_bytes(value), revision, revision, 1,
+                           lease_id)
+        else:
+            kv = _KeyValue(key, _to_bytes(value), kv.create_revision,
+                           revision, kv.version + 1, lease_id)
+        self._kvs[key] = kv
+        self._notify(PutEvent(key, kv.value, kv.metadata()))
+
+    def _delete(self, keys):
+        deleted = 0
+        for key in keys:
+            kv = self._kvs.pop(key, None)
+            if kv is not None:
+                deleted += 1
+                metadata = KVMetadata(key, 0, self.revision + 1, 0, 0)
+                self._notify(DeleteEvent(key, '', metadata))
+        return deleted
+
+    def _commit(self):
+        self.revision += 1
+        self._changed.notify_all()
+
+    def _notify(self, event):
+        for key, range_end, callback in self._watches.values():
+            if (range_end is None and event.key == key) or \
+               (range_end is not None and key <= event.key < range_end):
+                self._events.put((callback, event))
+
+    # function to wait until the revision changes or the timeout expires
+    def _wait_for_change(self, revision, timeout):
+        # wake up in time to expire the next lease even without changes
+        if self._leases:
+            next_expiry = min(e for _, e in self._leases.values())
+            wait = max(next_expiry - time.time(), 0.01)
+            timeout = wait if timeout is None else min(timeout, wait)
+        if self.revision == revision:
+            self._changed.wait(timeout)
@@ -0,0 +1,125 @@
+#!/usr/bin/python
+
+# Copyright 2018 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import time
+
+# http header with the idempotency key of a request
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+
+# prefix of the etcd keys of the idempotency records
+IDEMPOTENCY_KEY_PREFIX = "/ccp_aci_idempotency__"
+
+# seconds an idempotency key is remembered
+IDEMPOTENCY_TTL = 24 * 60 * 60
+
+
+class IdempotencyKeyMismatchError(Exception):
+    pass
+
+
+# function that returns the hash of a request (its operation and json
+# payload with sorted keys), identical requests have the same hash
+def request_hash(operation, payload):
+    return hashlib.sha256(
+        operation + ":" + json.dumps(payload, sort_keys=True)).hexdigest()
+
+
+class IdempotencyRecord(object):
+    """
+    IdempotencyRecord remembers the response of the request that was sent
+    with an Idempotency-Key header, so that retries of the request with the
+    same key get the same response (and job) instead of starting a new job.
+
+    The record is stored in /ccp_aci_idempotency__<sha256 of the key> under
+    an etcd lease of IDEMPOTENCY_TTL seconds. It is created if absent in a
+    transaction before the request is handled ("pending"), so only one of
+    concurrent requests with the same key is handled, and it is completed
+    with the status code and body of the response.
+    """
+
+    def __init__(self, etcd_client, idempotency_key, ttl=IDEMPOTENCY_TTL):
+        self.etcd_client = etcd_client
+        # key format in etcd is:
+        # /ccp_aci_idempotency__<sha256 of the idempotency key>
+        self.key = IDEMPOTENCY_KEY_PREFIX + hashlib.sha256(
+            idempotency_key).hexdigest()
+        self.ttl = ttl
+        self.lease = None
+
+    # function to create the record for a request with the given hash if
+    # the key was not used before. Returns None if the record was created
+    # (and the request should be handled), or the record of the earlier
+    # request with the key. Raises IdempotencyKeyMismatchError if the key
+    # was used for a different request.
+    def reserve(self, operation, hash_value):
+        record = {
+            "operation": operation,
+            "request_hash": hash_value,
+            "state": "pending",
+            "created": time.time()
+        }
+        lease = self.etcd_client.lease(self.ttl)
+        txn = self.etcd_client.transactions
+        success, responses = self.etcd_client.transaction(
+            compare=[txn.version(self.key) == 0],
+            success=[txn.put(self.key, json.dumps(record), lease)],
+            failure=[txn.get(self.key)])
+        if success:
+            self.lease = lease
+            return None
+        lease.revoke()
+
+        if not responses or not responses[0]:
+            # the earlier record expired in between
+            return self.reserve(operation, hash_value)
+        existing = json.loads(responses[0][0][0])
+        if existing["operation"] != operation or \
+           existing["request_hash"] != hash_value:
+            raise IdempotencyKeyMismatchError(
+                "Idempotency-Key was already used for a different request")
+        return existing
+
+    # function to store the response of the request in the record
+    def complete(self, status_code, body):
+        value = self.etcd_client.get(self.key)[0]
+        if value is None or self.lease is None:
+            return
+        record = json.loads(value)
+        record["state"] = "completed"
+        record["status_code"] = status_code
+        record["body"] = body
+        self.etcd_client.put(self.key, json.dumps(record), self.lease)
+
+    # function to forget the key (when handling the request failed, so that
+    # the request can be retried with the same key)
+    def discard(self):
+        if self.lease is not None:
+            self.lease.revoke()
+            self.lease = None
+
+    # function to wait up to timeout seconds for the concurrent request
+    # with the key to complete. Returns its record.
+    def wait(self, timeout=10, poll_interval=0.2):
+        deadline = time.time() + timeout
+        while True:
+            value = self.etcd_client.get(self.key)[0]
+            record = None if value is None else json.loads(value)
+            if record is None or record["state"] == "completed" or \
+               time.time() >= deadline:
+                return record
+            time.sleep(poll_interval)
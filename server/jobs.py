@@ -0,0 +1,328 @@
+#!/usr/bin/python
+
+# Copyright 2018 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import json
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+
+from certs import get_cipher
+
+# prefix of the etcd keys of the job journal
+JOB_KEY_PREFIX = "/ccp_aci_jobs__"
+
+# a job that was started this many times is not resumed again
+MAX_JOB_ATTEMPTS = 3
+
+# field of the http request of a job that is not stored in the journal as
+# it is: the APIC password is encrypted with the cipher of the ACI
+# certificates and keys (see certs.get_cipher()), and not stored at all if
+# there is no cipher
+PASSWORD_FIELD = "aci_password"
+ENCRYPTED_PASSWORD_FIELD = "encrypted_aci_password"
+
+# prefix of the etcd keys of the claims of the running jobs
+CLAIM_KEY_PREFIX = "/ccp_aci_job_claims__"
+
+# seconds a claim outlives the replica that holds it
+CLAIM_TTL = 30
+
+# random token of this server process, a restarted server in the same
+# container gets the same hostname and pid but a new token
+PROCESS_TOKEN = uuid.uuid4().hex[:8]
+
+
+# function that returns the id of this server process as the owner of jobs
+def owner_id():
+    return socket.gethostname() + ":" + str(os.getpid()) + ":" + \
+        PROCESS_TOKEN
+
+
+# function that returns a new id of a job (the job handle returned to the
+# client that sent the request of the job)
+def new_job_id():
+    return uuid.uuid4().hex
+
+
+# function to check if the server process owner (an owner_id()) is dead,
+# which is only known for processes on this host
+def owner_is_dead(owner):
+    parts = owner.split(":")
+    if len(parts) != 3 or parts[0] != socket.gethostname():
+        return False
+    if owner == owner_id():
+        return False
+    if parts[1] == str(os.getpid()):
+        # an earlier server process of this container
+        return True
+    try:
+        os.kill(int(parts[1]), 0)
+    except OSError as e:
+        return e.errno == errno.ESRCH
+    except ValueError:
+        return False
+    return False
+
+
+class JobJournal(object):
+    """
+    JobJournal records an unfinished create, update or delete job of a
+    cluster in etcd so that a restarted server can resume it.
+
+    The job is stored in /ccp_aci_jobs__<cluster name> with the operation,
+    the http request of the job, its state ("running"), the number of times
+    it was started (attempt), the last step it completed (last_step), the
+    server process running it (owner) and the time it was last updated. The
+    job is deleted from the journal when it finishes or fails.
+
+    The APIC password of the http request is never stored in cleartext: it
+    is stored encrypted if $CCP_ACI_CERTS_ENCRYPTION_KEY is set, and left
+    out otherwise, so a job without it can't be resumed (see
+    resumable_request()).
+    """
+
+    def __init__(self, etcd_client, ccp_cluster_name):
+        self.etcd_client = etcd_client
+        # key format in etcd is:
+        # /ccp_aci_jobs__<cluster name>
+        self.key = JOB_KEY_PREFIX + ccp_cluster_name
+        self.job = None
+
+    # function to record a new job, or a resumed job if job (the record of
+    # the job in the journal) is given
+    def begin(self, operation, http_request, job=None, **fields):
+        if job is None:
+            http_request = dict(http_request)
+            password = http_request.pop(PASSWORD_FIELD, None)
+            self.job = {
+                "operation": operation,
+                "http_request": http_request,
+                "attempt": 0,
+                "last_step": "accepted"
+            }
+            cipher = get_cipher()
+            if password is not None and cipher is not None:
+                self.job[ENCRYPTED_PASSWORD_FIELD] = cipher.encrypt(
+                    password.encode("utf-8"))
+        else:
+            self.job = dict(job)
+        self.job.update(fields)
+        self.job["attempt"] += 1
+        self.job["state"] = "running"
+        self._store()
+        return self.job
+
+    # function to record that the job completed a step
+    def step(self, last_step, **fields):
+        self.job["last_step"] = last_step
+        self.job.update(fields)
+        self._store()
+
+    def finish(self):
+        self.etcd_client.delete(self.key)
+        self.job = None
+
+    def get(self):
+        value = self.etcd_client.get(self.key)[0]
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def _store(self):
+        self.job["owner"] = owner_id()
+        self.job["updated"] = time.time()
+        self.etcd_client.put(self.key, json.dumps(self.job))
+
+    # static function that returns the unfinished jobs in the journal
+    @staticmethod
+    def unfinished(etcd_client):
+        return [json.loads(value) for value, _ in
+                etcd_client.get_prefix(JOB_KEY_PREFIX)]
+
+    # static function that returns the http request of job (a record of the
+    # journal) with its APIC password, or None if the password is not in
+    # the journal or can't be decrypted: the client has to send the
+    # request again then
+    @staticmethod
+    def resumable_request(job):
+        http_request = dict(job["http_request"])
+        if PASSWORD_FIELD in http_request:
+            # a job recorded before the password was left out
+            return http_request
+        if ENCRYPTED_PASSWORD_FIELD not in job:
+            return None
+        try:
+            cipher = get_cipher()
+            if cipher is None:
+                return None
+            http_request[PASSWORD_FIELD] = cipher.decrypt(
+                str(job[ENCRYPTED_PASSWORD_FIELD])).decode("utf-8")
+        except Exception:
+            return None
+        return http_request
+
+
+class JobClaim(object):
+    """
+    JobClaim makes sure that the jobs of a cluster run on exactly one
+    server replica at a time.
+
+    The replica running a job holds /ccp_aci_job_claims__<cluster name>,
+    which is created under an etcd lease of CLAIM_TTL seconds that a
+    background thread refreshes while the job runs. If the replica dies,
+    the claim expires with the lease and any replica can claim the job
+    again (and resume it from the job journal). A claim of a dead server
+    process on the same host is taken over right away.
+    """
+
+    def __init__(self, etcd_client, ccp_cluster_name, ttl=CLAIM_TTL):
+        self.etcd_client = etcd_client
+        # key format in etcd is:
+        # /ccp_aci_job_claims__<cluster name>
+        self.key = CLAIM_KEY_PREFIX + ccp_cluster_name
+        self.ttl = ttl
+        self.owner_id = owner_id()
+        self.lease = None
+        self._stop = None
+
+    # function to claim the job, waiting up to timeout seconds (None
+    # waits forever) for the replica holding the claim to release it.
+    # Returns True if this replica holds the claim.
+    def acquire(self, timeout=0, poll_interval=1):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if self._try_acquire():
+                return True
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(poll_interval)
+
+    def _try_acquire(self):
+        if self.lease is not None:
+            return True
+        lease = self.etcd_client.lease(self.ttl)
+        txn = self.etcd_client.transactions
+        success, responses = self.etcd_client.transaction(
+            compare=[txn.version(self.key) == 0],
+            success=[txn.put(self.key, self.owner_id, lease)],
+            failure=[txn.get(self.key)])
+        if success:
+            self.lease = lease
+            self._start_keepalive()
+            return True
+        lease.revoke()
+
+        # take over the claim of a dead server process on this host
+        if responses and responses[0]:
+            owner = responses[0][0][0]
+            if owner_is_dead(owner):
+                print "\nTaking over claim", self.key, "of", owner, "\n"
+                self.etcd_client.transaction(
+                    compare=[txn.value(self.key) == owner],
+                    success=[txn.delete(self.key)],
+                    failure=[])
+                return self._try_acquire()
+        return False
+
+    def _start_keepalive(self):
+        self._stop = threading.Event()
+        t = threading.Thread(
+            target=self._keepalive,
+            args=(self.lease, self._stop),
+            name="claim-keepalive-" + self.key[len(CLAIM_KEY_PREFIX):])
+        t.daemon = True
+        t.start()
+
+    def _keepalive(self, lease, stop):
+        while not stop.wait(self.ttl / 3.0):
+            try:
+                lease.refresh()
+            except Exception as e:
+                # the claim expires if etcd can't be reached for ttl seconds
+                print "\nERROR: Failed to refresh claim", self.key, \
+                      type(e), str(e), "\n"
+
+    def release(self):
+        if self.lease is None:
+            return
+        self._stop.set()
+        # revoking the lease deletes the claim
+        self.lease.revoke()
+        self.lease = None
+
+    # function that returns the owner_id() of the replica holding the claim
+    # or None if the job is not claimed
+    def owner(self):
+        value = self.etcd_client.get(self.key)[0]
+        if value is None or owner_is_dead(value):
+            return None
+        return value
+
+    def __enter__(self):
+        self.acquire(timeout=None)
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.release()
+
+
+class FabricSemaphore(object):
+    """
+    FabricSemaphore limits the acc-provision runs on one ACI fabric to
+    `slots` at a time across all the server replicas.
+
+    Every slot is an etcd lock named acc_provision_fabric_<fabric>_<slot>,
+    a run holds one of them. The locks have a ttl, so the slot of a replica
+    that dies while it runs acc-provision is freed after ttl seconds.
+    """
+
+    def __init__(self, etcd_client, fabric, slots=1, ttl=60):
+        self.etcd_client = etcd_client
+        self.lock_names = [
+            "acc_provision_fabric_" + fabric + "_" + str(i)
+            for i in range(max(int(slots), 1))
+        ]
+        self.ttl = ttl
+        self.lock = None
+
+    # function to take a free slot, waiting until one is free
+    def acquire(self, poll_interval=1):
+        while True:
+            # start with a random slot so that the replicas don't all
+            # compete for the first one
+            names = list(self.lock_names)
+            random.shuffle(names)
+            for name in names:
+                lock = self.etcd_client.lock(name, ttl=self.ttl)
+                if lock.acquire(timeout=0):
+                    self.lock = lock
+                    return self
+            time.sleep(poll_interval)
+
+    def release(self):
+        if self.lock is not None:
+            self.lock.release()
+            self.lock = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.release()
@@ -0,0 +1,182 @@
+#!/usr/bin/python
+
+# Copyright 2018 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+import linecache
+import os
+import re
+import sys
+import threading
+import time
+
+# maximum seconds of a profile
+MAX_PROFILE_SECONDS = 60
+
+# default and minimum seconds between two samples of the stacks
+SAMPLE_INTERVAL = 0.01
+MIN_SAMPLE_INTERVAL = 0.001
+
+# functions a thread waits in for a lock, a condition, a slot of the
+# scheduler or of an ACI fabric, or a claim of a job (threading's
+# Condition.wait, FairScheduler.acquire, FabricSemaphore.acquire,
+# etcd_backend's Lock.acquire...). A sample of a thread whose innermost
+# frame is one of them is counted as waiting.
+WAIT_FUNCTIONS = frozenset(["wait", "acquire", "_wait_for_change"])
+
+# lines a thread waits on for a lock: on Python 2 the locks of the thread
+# module (threading.Lock, and the locks of the scheduler, the allocator and
+# MemoryEtcd) are acquired in C, without a frame of their own, so a thread
+# blocked in "with lock:" or "lock.acquire()" has the frame of the caller
+# innermost, on that line. A sample of a thread whose innermost frame is on
+# one of these lines is counted as waiting too (a "with" statement whose
+# context manager is written in Python has its own innermost frame).
+WAIT_LINE = re.compile(r"^\s*with\s.*:|\.acquire\(")
+
+# only one profile runs at a time in a process
+_profiling = threading.Lock()
+
+
+class ProfilerBusyError(Exception):
+    pass
+
+
+# function that returns the name of the frame in the stacks: the function,
+# and its file and line
+def frame_name(frame):
+    code = frame.f_code
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+                           frame.f_lineno)
+
+
+# function to check if the thread whose innermost frame is frame waits for
+# a lock, a condition or a claim (see WAIT_FUNCTIONS and WAIT_LINE)
+def is_waiting(frame):
+    code = frame.f_code
+    if code.co_name in WAIT_FUNCTIONS:
+        return True
+    line = linecache.getline(code.co_filename, frame.f_lineno)
+    return WAIT_LINE.search(line) is not None
+
+
+class StackSampler(object):
+    """
+    StackSampler is a statistical profiler of the threads of the process:
+    it takes the stacks of the threads (sys._current_frames()) once every
+    interval seconds for seconds, and counts the samples of every stack.
+
+    Only the threads whose names start with one of the prefixes are
+    sampled (all the threads if there are no prefixes), the jobs run in
+    threads named after the job and the cluster (create-<cluster name>,
+    delete-<cluster name>, update-<cluster name>). The thread that runs
+    the sampler is not sampled.
+
+    Nothing is instrumented: the threads only pay for the samples while a
+    profile runs, so the server runs at full speed the rest of the time.
+    """
+
+    def __init__(self, seconds, interval=SAMPLE_INTERVAL, prefixes=None):
+        if not 0 < seconds <= MAX_PROFILE_SECONDS:
+            raise ValueError("seconds must be > 0 and <= " +
+                             str(MAX_PROFILE_SECONDS))
+        if not MIN_SAMPLE_INTERVAL <= interval <= seconds:
+            raise ValueError("interval must be >= " +
+                             str(MIN_SAMPLE_INTERVAL) + " and <= seconds")
+        self.seconds = seconds
+        self.interval = interval
+        self.prefixes = [p for p in (prefixes or []) if p]
+        # (thread name, frames from the outermost) -> samples
+        self.stacks = {}
+        # thread name -> {"samples": ..., "waiting": ...}
+        self.threads = {}
+        self.samples = 0
+        self.duration = 0.0
+
+    def _sampled(self, name):
+        return not self.prefixes or \
+            any(name.startswith(p) for p in self.prefixes)
+
+    # function to take one sample of the stacks of the threads
+    def sample(self):
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        me = threading.current_thread().ident
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            name = names.get(ident, "thread-" + str(ident))
+            if not self._sampled(name):
+                continue
+
+            waiting = is_waiting(frame)
+            frames = []
+            while frame is not None:
+                frames.append(frame_name(frame))
+                frame = frame.f_back
+            frames.reverse()
+
+            key = (name, tuple(frames))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            counts = self.threads.setdefault(name, {
+                "samples": 0,
+                "waiting": 0
+            })
+            counts["samples"] += 1
+            if waiting:
+                counts["waiting"] += 1
+        self.samples += 1
+
+    # function to sample the stacks for seconds in the calling thread
+    def run(self):
+        started = time.time()
+        deadline = started + self.seconds
+        while True:
+            self.sample()
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(self.interval, remaining))
+        self.duration = round(time.time() - started, 3)
+        return self
+
+    # function that returns the stacks in the "folded" format of
+    # flamegraph.pl and speedscope (one "thread;frame;...;frame samples"
+    # line per stack, frames from the outermost)
+    def folded(self):
+        return "".join(
+            "%s %d\n" % (";".join((name, ) + frames), count)
+            for (name, frames), count in sorted(self.stacks.items()))
+
+    def report(self):
+        return {
+            "seconds": self.duration,
+            "interval": self.interval,
+            "samples": self.samples,
+            "threads": OrderedDict(sorted(self.threads.items())),
+            "folded": self.folded().splitlines()
+        }
+
+
+# function to profile the threads whose names start with one of the
+# prefixes for seconds, returns the StackSampler with the samples. Raises
+# ProfilerBusyError if a profile is already running.
+def profile(seconds, interval=SAMPLE_INTERVAL, prefixes=None):
+    sampler = StackSampler(seconds, interval, prefixes)
+    if not _profiling.acquire(False):
+        raise ProfilerBusyError("a profile is already running, re-try after "
+                                "it finishes")
+    try:
+        return sampler.run()
+    finally:
+        _profiling.release()
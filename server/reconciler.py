@@ -0,0 +1,576 @@
+#!/usr/bin/python
+
+# Copyright 2018 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+################################################################
+#                                                              #
+# Reconciler of the state of the CCP ACI service               #
+#                                                              #
+# Compares the allocator state (/ccp_aci_service), the status  #
+# records of the clusters (/acc_provision_status__*__ccp) and  #
+# optionally the configs on the APICs, reports the drift       #
+# between them and optionally repairs it                       #
+#                                                              #
+# Run "./reconciler.py -h" to see usage                        #
+#                                                              #
+################################################################
+
+import argparse
+import getpass
+import json
+import os
+import sys
+import time
+
+import allocator
+from apic import APIC_OBJECT_CLASSES, ApicClient, apic_object_dns
+from etcd_backend import MEMORY_BACKEND, new_etcd_client
+from jobs import JOB_KEY_PREFIX
+from status import INPUT_JSON_KEY_PREFIX, KEY_SUFFIX, STATUS_KEY_PREFIX, \
+    StatusStore, cluster_name_of_key
+
+# suffix of the etcd keys of the status records
+STATUS_KEY_SUFFIX = KEY_SUFFIX
+
+# seconds after which a creation in progress without a job has failed
+# (like in CcpAciServer._delete_expired_creations_in_progress())
+CREATION_EXPIRATION = 300
+
+# maximum number of keys deleted in one etcd transaction with the ACI input
+# json and manifests keys of their clusters (etcd allows 128 operations in a
+# transaction by default)
+REPAIR_BATCH_SIZE = 32
+
+# allocator keys of a bundle and the resource they allocate
+BUNDLE_KEYS = [
+    (allocator.Allocator.KUBEAPI_VLAN_KEY, "vlan"),
+    (allocator.Allocator.SERVICE_VLAN_KEY, "vlan"),
+    (allocator.Allocator.SERVICE_SUBNET_KEY, "service_subnet"),
+    (allocator.Allocator.MULTICAST_RANGE_START_KEY, "multicast_range"),
+    (allocator.Allocator.POD_SUBNET_KEY, "pod_subnet"),
+]
+
+
+# function that returns the cluster name of the status record key, or None
+# if the key is not a /acc_provision_status__<cluster name>__ccp key
+def cluster_name_of_status_key(key):
+    if not key.startswith(STATUS_KEY_PREFIX) or \
+       not key.endswith(STATUS_KEY_SUFFIX) or \
+       len(key) <= len(STATUS_KEY_PREFIX) + len(STATUS_KEY_SUFFIX):
+        return None
+    return key[len(STATUS_KEY_PREFIX):-len(STATUS_KEY_SUFFIX)]
+
+
+# function that returns the value of the dotted key (like
+# "net_config.pod_subnet") in the ACI input json, or None
+def get_dotted(input_json, dotted_key):
+    value = input_json
+    for k in dotted_key.split('.'):
+        if not isinstance(value, dict) or k not in value:
+            return None
+        value = value[k]
+    return value
+
+
+# function that returns the allocator bundle of a cluster from the ACI
+# input json in its status record, or None if a value is missing
+def bundle_from_input_json(ccp_cluster_name, input_json):
+    bundle = {}
+    keys = [k for k, _ in BUNDLE_KEYS] + \
+        [allocator.Allocator.MULTICAST_RANGE_END_KEY]
+    for k in keys:
+        value = get_dotted(input_json, k)
+        if value is None or value == "":
+            return None
+        bundle[k] = value
+    bundle['aci_config.system_id'] = ccp_cluster_name
+    return bundle
+
+
+# function that returns the resources a bundle allocates as a list of
+# (resource, value) with the values normalized like the allocator indexes
+# them (the /16 block of a multicast range)
+def bundle_resources(bundle):
+    resources = []
+    for k, resource in BUNDLE_KEYS:
+        value = bundle.get(k)
+        if value is None:
+            continue
+        if resource == "vlan":
+            resources.append((resource, int(value)))
+        elif resource == "multicast_range":
+            resources.append((resource, allocator.int_to_ip(
+                allocator.ip_to_int(value) & allocator.prefix_mask(16))))
+        else:
+            resources.append((resource, allocator.int_to_ip(
+                allocator.parse_subnet(value)[0])))
+    return resources
+
+
+class Reconciler(object):
+    """
+    Reconciler finds the drift between the allocator state of every pool in
+    config_file, the status records of the clusters and the job journal,
+    and optionally the configs on the APICs:
+
+    - orphaned_reservations: bundles of clusters that have no status record
+      (and no running job), they are freed by repair()
+    - orphaned_status_keys: status keys that are not of a cluster, or of
+      creations that failed (no job and older than CREATION_EXPIRATION
+      seconds), and ACI input json keys of clusters without a status
+      record, they are deleted by repair() with the ACI input json and
+      manifests keys of their clusters
+    - missing_reservations: created clusters without a bundle in the
+      allocator state (like after the allocator state was lost), their
+      bundles are imported from the ACI input json of their status records
+      by repair() unless they conflict with other bundles
+    - mismatched_reservations: created clusters whose ACI input json does
+      not have the values of their bundle
+    - conflicts: vlan ids, service subnets, multicast ranges and pod
+      subnets used by more than one bundle of a pool
+    - missing_on_apic: created clusters whose configs are missing on their
+      APIC (only checked if apic_username is given)
+
+    All the state is read in four range reads (the allocator state of all
+    the pools, the status records, the ACI input jsons and the job journal;
+    the ACI CNI manifests are not read) and the conflict
+    indexes are built in one pass, so that a scan of thousands of clusters
+    takes about a second. The APICs are checked with one class query for
+    every class of APIC_OBJECT_CLASSES on every APIC.
+    """
+
+    def __init__(self,
+                 etcd_client,
+                 config_file="aci.conf",
+                 apic_username=None,
+                 apic_password=None,
+                 apic_client_factory=ApicClient):
+        self.etcd_client = etcd_client
+        self.config_file = config_file
+        self.apic_username = apic_username
+        self.apic_password = apic_password
+        self.apic_client_factory = apic_client_factory
+        self.allocators = dict(
+            (pool, allocator.Allocator(etcd_client, config_file, pool=pool))
+            for pool in [None] + allocator.pool_names(
+                allocator.get_aci_config(config_file)))
+
+    # function to read the status records with their ACI input json and the
+    # job journal, returns a dict of status key to (status record or None
+    # if it's not json, mod revision), the set of the cluster names with a
+    # job and the orphaned ACI input json keys (of clusters without a status
+    # record)
+    def _read_clusters(self):
+        records = {}
+        for value, meta in self.etcd_client.get_prefix(STATUS_KEY_PREFIX):
+            try:
+                record = json.loads(value)
+            except ValueError:
+                record = None
+            records[meta.key] = (record, meta.mod_revision)
+
+        orphaned_inputs = []
+        for value, meta in self.etcd_client.get_prefix(INPUT_JSON_KEY_PREFIX):
+            name = cluster_name_of_key(meta.key)
+            status_key = None if name is None else StatusStore.key(name)
+            if status_key not in records:
+                orphaned_inputs.append({
+                    "key": meta.key,
+                    "reason": "ACI input json of a cluster without a "
+                    "status record",
+                    "mod_revision": meta.mod_revision
+                })
+                continue
+            record = records[status_key][0]
+            if isinstance(record, dict):
+                try:
+                    record["aci_input_json"] = json.loads(value)
+                except ValueError:
+                    pass
+
+        jobs = set(meta.key[len(JOB_KEY_PREFIX):] for _, meta in
+                   self.etcd_client.get_prefix(JOB_KEY_PREFIX))
+        return records, jobs, orphaned_inputs
+
+    # function to read the allocator state of every pool, returns a dict of
+    # pool to state
+    def _read_states(self):
+        values = dict((meta.key, value) for value, meta in
+                      self.etcd_client.get_prefix(allocator.Allocator.DB_KEY))
+        return dict((pool, a.state_from_values(values))
+                    for pool, a in self.allocators.items())
+
+    # function that returns the reason the status record of cluster name is
+    # orphaned, or None if it is not
+    @staticmethod
+    def _orphaned_reason(name, record, jobs, now):
+        if name is None:
+            return "not a status key of a cluster"
+        if not isinstance(record, dict):
+            return "not a status record"
+        if name in jobs or record.get("completed", False):
+            return None
+        creation_start_time = record.get("creation_start_time", 0.0)
+        if creation_start_time != 0.0 and \
+           now - creation_start_time > CREATION_EXPIRATION:
+            return "creation did not finish in %d seconds" % \
+                CREATION_EXPIRATION
+        return None
+
+    # function to find the clusters of every pool: the clusters that exist
+    # (with a valid status record or a job) and the created clusters with
+    # their status records
+    def _classify(self, records, jobs, now):
+        orphaned_status_keys = []
+        existing = dict((pool, set(jobs)) for pool in self.allocators)
+        created = dict((pool, {}) for pool in self.allocators)
+        unknown_pools = []
+
+        for key in sorted(records):
+            record, mod_revision = records[key]
+            name = cluster_name_of_status_key(key)
+            reason = self._orphaned_reason(name, record, jobs, now)
+            if reason is not None:
+                orphaned_status_keys.append({
+                    "key": key,
+                    "reason": reason,
+                    "mod_revision": mod_revision
+                })
+                continue
+
+            pool = record.get("allocator_pool")
+            if pool not in self.allocators:
+                unknown_pools.append({"cluster": name, "pool": pool})
+                continue
+            existing[pool].add(name)
+            if record.get("completed", False):
+                created[pool][name] = record
+
+        return orphaned_status_keys, existing, created, unknown_pools
+
+    def scan(self):
+        """
+        scan returns the report of the drift (a json serializable dict with
+        the lists described in the class docstring and the number of
+        clusters and bundles).
+        """
+
+        started = time.time()
+        now = time.time()
+        records, jobs, orphaned_inputs = self._read_clusters()
+        states = self._read_states()
+
+        orphaned_status_keys, existing, created, unknown_pools = \
+            self._classify(records, jobs, now)
+        orphaned_status_keys.extend(orphaned_inputs)
+
+        report = {
+            "clusters": len(records),
+            "reservations": 0,
+            "warm_pool": 0,
+            "orphaned_reservations": [],
+            "orphaned_status_keys": orphaned_status_keys,
+            "missing_reservations": [],
+            "mismatched_reservations": [],
+            "conflicts": [],
+            "unknown_pools": unknown_pools,
+            "missing_on_apic": [],
+            "apic_errors": []
+        }
+
+        for pool in sorted(self.allocators):
+            self._scan_pool(pool, states[pool], existing[pool], created[pool],
+                            report)
+
+        if self.apic_username is not None:
+            self._verify_apics(created, report)
+
+        report["seconds"] = round(time.time() - started, 3)
+        return report
+
+    def _scan_pool(self, pool, state, existing, created, report):
+        a = self.allocators[pool]
+        warm_pool = set(a._warm_pool_names(state))
+        report["warm_pool"] += len(warm_pool)
+        report["reservations"] += len(state) - len(warm_pool)
+
+        # owners of the resources (the conflict indexes of the pool)
+        owners = {}
+
+        def index(name, bundle):
+            for resource in bundle_resources(bundle):
+                owners.setdefault(resource, set()).add(name)
+
+        for name in sorted(state):
+            bundle = state[name]
+            index(name, bundle)
+            if name in warm_pool:
+                continue
+            if name not in existing:
+                report["orphaned_reservations"].append({
+                    "pool": pool,
+                    "cluster": name
+                })
+            elif name in created:
+                input_json = created[name].get("aci_input_json", {})
+                fields = [k for k, _ in BUNDLE_KEYS
+                          if get_dotted(input_json, k) != bundle.get(k)]
+                if fields:
+                    report["mismatched_reservations"].append({
+                        "pool": pool,
+                        "cluster": name,
+                        "fields": fields
+                    })
+
+        missing = []
+        for name in sorted(created):
+            if name in state:
+                continue
+            bundle = bundle_from_input_json(
+                name, created[name].get("aci_input_json", {}))
+            entry = {"pool": pool, "cluster": name, "importable": True}
+            if bundle is None:
+                entry["importable"] = False
+                entry["error"] = "ACI input json does not have the bundle"
+            else:
+                index(name, bundle)
+            missing.append(entry)
+
+        conflicting = set()
+        for resource in sorted(owners):
+            if len(owners[resource]) > 1:
+                conflicting.update(owners[resource])
+                report["conflicts"].append({
+                    "pool": pool,
+                    "resource": resource[0],
+                    "value": resource[1],
+                    "owners": sorted(owners[resource])
+                })
+
+        for entry in missing:
+            if entry["importable"] and entry["cluster"] in conflicting:
+                entry["importable"] = False
+                entry["error"] = "bundle conflicts with other bundles"
+        report["missing_reservations"].extend(missing)
+
+    # function to check that the configs of the created clusters exist on
+    # their APICs
+    def _verify_apics(self, created, report):
+        clusters_by_apic = {}
+        for pool in created:
+            for name, record in created[pool].items():
+                input_json = record.get("aci_input_json", {})
+                apic_hosts = get_dotted(input_json, "aci_config.apic_hosts")
+                if not apic_hosts:
+                    continue
+                system_id = get_dotted(input_json,
+                                       "aci_config.system_id") or name
+                clusters_by_apic.setdefault(apic_hosts[0], []).append(
+                    (name, system_id))
+
+        for apic_host in sorted(clusters_by_apic):
+            try:
+                apic_client = self.apic_client_factory(
+                    apic_host, self.apic_username,
+                    self.apic_password).login()
+                dns = set()
+                for class_name in APIC_OBJECT_CLASSES:
+                    dns.update(apic_client.class_dns(class_name))
+            except Exception as e:
+                report["apic_errors"].append({
+                    "apic_host": apic_host,
+                    "error": str(e)
+                })
+                continue
+
+            for name, system_id in sorted(clusters_by_apic[apic_host]):
+                missing_dns = [
+                    dn for dn in apic_object_dns(system_id) if dn not in dns
+                ]
+                if missing_dns:
+                    report["missing_on_apic"].append({
+                        "cluster": name,
+                        "apic_host": apic_host,
+                        "dns": missing_dns
+                    })
+
+    def repair(self, report):
+        """
+        repair deletes the orphaned status keys, frees the orphaned
+        reservations and imports the importable missing reservations of
+        report (the result of scan()). Everything is checked again against
+        the current state, so changes made since the scan are not undone.
+        Returns the number of status keys deleted, reservations freed and
+        reservations imported.
+        """
+
+        repaired = {
+            "status_keys_deleted":
+            self._delete_status_keys(report["orphaned_status_keys"]),
+            "reservations_freed": 0,
+            "reservations_imported": 0
+        }
+
+        records, jobs, _ = self._read_clusters()
+        _, existing, created, _ = self._classify(records, jobs, time.time())
+
+        for pool in sorted(self.allocators):
+            free = [r["cluster"] for r in report["orphaned_reservations"]
+                    if r["pool"] == pool and r["cluster"] not in existing[pool]]
+            imports = [r["cluster"] for r in report["missing_reservations"]
+                       if r["pool"] == pool and r["importable"] and
+                       r["cluster"] in created[pool]]
+            if not free and not imports:
+                continue
+
+            changes = self.allocators[pool].modify(
+                "reconcile",
+                lambda state: self._pool_changes(state, free, imports,
+                                                 created[pool]))
+            for bundle in changes.values():
+                if bundle is None:
+                    repaired["reservations_freed"] += 1
+                else:
+                    repaired["reservations_imported"] += 1
+        return repaired
+
+    # function that returns the changes of the allocator state of a pool to
+    # free the clusters in free and import the bundles of the clusters in
+    # imports
+    @staticmethod
+    def _pool_changes(state, free, imports, created):
+        changes = dict((name, None) for name in free if name in state)
+
+        used = set()
+        for name, bundle in state.items():
+            if name not in changes:
+                used.update(bundle_resources(bundle))
+        for name in imports:
+            if name in state:
+                continue
+            bundle = bundle_from_input_json(
+                name, created[name].get("aci_input_json", {}))
+            if bundle is None:
+                continue
+            resources = set(bundle_resources(bundle))
+            if resources & used:
+                continue
+            used.update(resources)
+            changes[name] = bundle
+        return changes
+
+    # function that returns the keys deleted with an orphaned key: the key
+    # and the keys after it in StatusStore.keys() (a status record takes
+    # its ACI input json and manifests with it, an ACI input json only its
+    # manifests, so that a creation started since the scan is kept)
+    @staticmethod
+    def _keys_to_delete(key):
+        name = cluster_name_of_key(key)
+        if name is None:
+            return [key]
+        keys = StatusStore.keys(name)
+        if key not in keys:
+            return [key]
+        return keys[keys.index(key):]
+
+    # function to delete the status keys in batched transactions, a key is
+    # only deleted if it did not change since the scan. Returns the number
+    # of keys deleted.
+    def _delete_status_keys(self, orphaned_status_keys):
+        txn = self.etcd_client.transactions
+        deleted = 0
+        for i in range(0, len(orphaned_status_keys), REPAIR_BATCH_SIZE):
+            batch = orphaned_status_keys[i:i + REPAIR_BATCH_SIZE]
+            success, _ = self.etcd_client.transaction(
+                compare=[txn.mod(k["key"]) == k["mod_revision"]
+                         for k in batch],
+                success=[txn.delete(key) for k in batch
+                         for key in self._keys_to_delete(k["key"])],
+                failure=[])
+            if success:
+                deleted += len(batch)
+                continue
+
+            # some keys of the batch changed, delete the others one by one
+            for k in batch:
+                success, _ = self.etcd_client.transaction(
+                    compare=[txn.mod(k["key"]) == k["mod_revision"]],
+                    success=[txn.delete(key)
+                             for key in self._keys_to_delete(k["key"])],
+                    failure=[])
+                if success:
+                    deleted += 1
+        return deleted
+
+
+# function that returns True if the report has drift
+def has_drift(report):
+    return any(report[k] for k in [
+        "orphaned_reservations", "orphaned_status_keys",
+        "missing_reservations", "mismatched_reservations", "conflicts",
+        "unknown_pools", "missing_on_apic", "apic_errors"
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--config_file',
+        help='Path to config file. Default is aci.conf',
+        default='aci.conf')
+    parser.add_argument(
+        '--repair',
+        help='Delete the orphaned status keys, free the orphaned '
+        'reservations and import the missing reservations',
+        action='store_true')
+    parser.add_argument(
+        '--apic_username',
+        help='Check that the configs of the clusters exist on their APICs '
+        'as this APIC user (the password is read from $APIC_PASSWORD or '
+        'prompted for)')
+    parser.add_argument(
+        'etcd_ip_port',
+        help="etcd server's IP address or DNS name and port in the " \
+             "format <etcd's IP or DNS name>:<etcd port>")
+    args = parser.parse_args()
+
+    if args.etcd_ip_port == MEMORY_BACKEND or \
+       ':' not in args.etcd_ip_port or \
+       not args.etcd_ip_port.split(':')[1].isdigit():
+        print "\nERROR: Invalid etcd_ip_port. etcd_ip_port's format is \
+               \n<IP address or DNS name of etcd server>:<port of etcd server>\n"
+        sys.exit(1)
+
+    apic_password = None
+    if args.apic_username is not None:
+        apic_password = os.environ.get("APIC_PASSWORD")
+        if apic_password is None:
+            apic_password = getpass.getpass("APIC password: ")
+
+    reconciler = Reconciler(
+        new_etcd_client(args.etcd_ip_port), args.config_file,
+        args.apic_username, apic_password)
+    report = reconciler.scan()
+    if args.repair:
+        report["repaired"] = reconciler.repair(report)
+
+    print json.dumps(report, indent=4, sort_keys=True)
+
+    # exit code 1 tells scripts that drift was found
+    sys.exit(1 if has_drift(report) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/python
+
+# Copyright 2018 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import deque, OrderedDict
+import threading
+import time
+
+# http header with the tenant (caller) a request is scheduled for, the ACI
+# username of the request is used if it is missing
+CALLER_HEADER = "X-Ccp-Tenant"
+
+# priority classes of the acc-provision runs, lower classes run first:
+# deletes free capacity, and retries of failed or resumed jobs have waited
+# already
+PRIORITY_DELETE = 0
+PRIORITY_RETRY = 1
+PRIORITY_UPDATE = 2
+PRIORITY_CREATE = 3
+
+PRIORITY_NAMES = {
+    PRIORITY_DELETE: "delete",
+    PRIORITY_RETRY: "retry",
+    PRIORITY_UPDATE: "update",
+    PRIORITY_CREATE: "create"
+}
+
+# number of the latest queue waits of every priority class the percentiles
+# are computed from
+WAIT_SAMPLES = 1000
+
+
+# function that returns the p-th percentile (0 to 100) of the sorted list
+# values, interpolated linearly between the two closest values (the load
+# test of perf/ reports its latencies with it too)
+def percentile(values, p):
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * p / 100.0
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+class _Ticket(object):
+    def __init__(self, scheduler, key, caller, priority, slots):
+        self.scheduler = scheduler
+        self.key = key
+        self.caller = caller
+        self.priority = priority
+        self.slots = slots
+        self.granted = False
+        self.enqueued = None
+
+    def __enter__(self):
+        self.scheduler.acquire(self)
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.scheduler.release(self)
+
+
+class _Queue(object):
+    def __init__(self):
+        self.running = 0
+        # priority class -> caller -> tickets of the caller in order, the
+        # caller whose turn it is first
+        self.waiting = dict((p, OrderedDict()) for p in PRIORITY_NAMES)
+
+    # function that returns the next ticket to run: the first ticket of the
+    # caller whose turn it is in the lowest priority class with tickets.
+    # The caller then moves to the end of the turns of its class.
+    def pop(self):
+        for priority in sorted(self.waiting):
+            callers = self.waiting[priority]
+            if callers:
+                caller, tickets = callers.popitem(last=False)
+                ticket = tickets.popleft()
+                if tickets:
+                    callers[caller] = tickets
+                return ticket
+        return None
+
+
+class FairScheduler(object):
+    """
+    FairScheduler orders the acc-provision runs of this server replica that
+    wait for a slot of an ACI fabric (the key of a run). A run waits in the
+    queue of its fabric until fewer than `slots` runs of the fabric are
+    running, and the waiting runs are started in this order:
+
+    - the runs of a lower priority class first (PRIORITY_DELETE first,
+      PRIORITY_CREATE last)
+    - within a priority class, the callers (tenants) take turns, so a
+      caller with 50 queued creates gets one run per turn like a caller
+      with one create, and the queue wait of small callers stays bounded
+
+    The queue waits and queue lengths are kept for the metrics.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._queues = {}
+        self._waits = dict((p, deque(maxlen=WAIT_SAMPLES))
+                           for p in PRIORITY_NAMES)
+        self._counts = dict((p, 0) for p in PRIORITY_NAMES)
+        self._wait_sums = dict((p, 0.0) for p in PRIORITY_NAMES)
+        self._wait_maxes = dict((p, 0.0) for p in PRIORITY_NAMES)
+
+    # function that returns a ticket for a run of caller in the priority
+    # class on key (a context manager that waits for the run's turn)
+    def slot(self, key, caller, priority, slots=1):
+        return _Ticket(self, key, caller, priority, max(int(slots), 1))
+
+    def acquire(self, ticket):
+        with self._cond:
+            queue = self._queues.setdefault(ticket.key, _Queue())
+            ticket.enqueued = time.time()
+            queue.waiting[ticket.priority].setdefault(
+                ticket.caller, deque()).append(ticket)
+            self._dispatch(queue, ticket.slots)
+            while not ticket.granted:
+                self._cond.wait()
+
+            wait = time.time() - ticket.enqueued
+            self._waits[ticket.priority].append(wait)
+            self._counts[ticket.priority] += 1
+            self._wait_sums[ticket.priority] += wait
+            self._wait_maxes[ticket.priority] = max(
+                self._wait_maxes[ticket.priority], wait)
+
+    def release(self, ticket):
+        with self._cond:
+            queue = self._queues[ticket.key]
+            queue.running -= 1
+            self._dispatch(queue, ticket.slots)
+            if queue.running == 0 and not any(queue.waiting.values()):
+                del self._queues[ticket.key]
+
+    # function to start the next runs of queue while it has free slots
+    def _dispatch(self, queue, slots):
+        granted = False
+        while queue.running < slots:
+            ticket = queue.pop()
+            if ticket is None:
+                break
+            ticket.granted = True
+            queue.running += 1
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def metrics(self):
+        """
+        metrics returns the number of running and queued runs, the queued
+        runs of every caller, and for every priority class the number of
+        queued runs, the number of runs started and their queue wait in
+        seconds (mean, max and percentiles of the latest WAIT_SAMPLES).
+        """
+
+        with self._cond:
+            running = 0
+            queued = dict((p, 0) for p in PRIORITY_NAMES)
+            queued_by_caller = {}
+            for queue in self._queues.values():
+                running += queue.running
+                for priority, callers in queue.waiting.items():
+                    for caller, tickets in callers.items():
+                        queued[priority] += len(tickets)
+                        queued_by_caller[caller] = \
+                            queued_by_caller.get(caller, 0) + len(tickets)
+
+            classes = {}
+            for priority, name in PRIORITY_NAMES.items():
+                waits = sorted(self._waits[priority])
+                count = self._counts[priority]
+                classes[name] = {
+                    "queued": queued[priority],
+                    "started": count,
+                    "wait_seconds": {
+                        "mean": round(self._wait_sums[priority] / count, 3)
+                        if count else 0.0,
+                        "max": round(self._wait_maxes[priority], 3),
+                        "p50": round(percentile(waits, 50), 3),
+                        "p90": round(percentile(waits, 90), 3),
+                        "p99": round(percentile(waits, 99), 3)
+                    }
+                }
+
+            return {
+                "running": running,
+                "queued": sum(queued.values()),
+                "queued_by_caller": queued_by_caller,
+                "priority_classes": classes
+            }
@@ -15,16 +15,46 @@
 # limitations under the License.
 
 import allocator
+from apic import ApicClient, apic_object_dns
+from certs import CertStore, get_cipher
+from credentials import command_env
 from datetime import datetime
+from etcd_backend import WatchTimedOut
+import hashlib
+from jobs import FabricSemaphore, JobClaim, JobJournal, MAX_JOB_ATTEMPTS
 import json
 import logging
+from scheduler import FairScheduler, PRIORITY_CREATE, PRIORITY_DELETE, \
+    PRIORITY_RETRY, PRIORITY_UPDATE
+from status import StatusStore, iter_manifest_texts
 import subprocess
 import threading
 import time
 import os
-import yaml
+from workdir import JobWorkDir
 
-lock = threading.Lock()
+# yaml (and requests in apic.py) are imported on first use, so that the
+# server starts listening without waiting for them
+
+# scheduler of the acc-provision runs of this server replica
+scheduler = FairScheduler()
+
+# sections of the ACI input json with configs that acc-provision creates on
+# the ACI fabric, changes in the other sections only change the ACI CNI
+FABRIC_CONFIG_SECTIONS = ["aci_config", "net_config"]
+
+
+# function that returns the sorted dotted keys (like
+# "aci_config.vrf.name") whose values differ between two ACI input jsons
+def diff_input_json(old, new, prefix=""):
+    changed = []
+    for k in set(old.keys()) | set(new.keys()):
+        key = prefix + k
+        if isinstance(old.get(k), dict) and isinstance(new.get(k), dict):
+            changed.extend(diff_input_json(old[k], new[k], key + "."))
+        elif old.get(k) != new.get(k):
+            changed.append(key)
+    return sorted(changed)
 
 
 class CcpAciServer(object):
@@ -35,11 +65,30 @@ class CcpAciServer(object):
         ])
         self.aci_cni_output_YAML = ''.join(
             ["aci_cni_deployment_", http_request["ccp_cluster_name"], ".yaml"])
+        self.aci_crt_file = ''.join(
+            ["user-", http_request["ccp_cluster_name"], ".crt"])
+        self.aci_key_file = ''.join(
+            ["user-", http_request["ccp_cluster_name"], ".key"])
+        # private work directory of the job for the files above
+        # (created on first use and deleted by cleanup_files())
+        self.workdir = None
         self.etcd_client = etcd_client
+        # summary, ACI input json and ACI CNI of the cluster in etcd
+        self.status_store = StatusStore(etcd_client,
+                                        http_request["ccp_cluster_name"])
         self.db_key = self._generate_db_key()
         self.etcd_lock_name = "acc_provision_status_lock"
         self.aci_flavor = self._get_aci_flavor()
         self.config_file = config_file
+        self.allocator_pool = self._get_allocator_pool()
+        self.journal = JobJournal(etcd_client, http_request["ccp_cluster_name"])
+        self.claim = JobClaim(etcd_client, http_request["ccp_cluster_name"])
+        # id of the job returned to the client (set for accepted requests)
+        self.job_id = None
+        # tenant the acc-provision runs of the job are scheduled for, and
+        # if the job is resumed after a failure or restart
+        self.caller = http_request.get("aci_username")
+        self.resumed = False
 
     # function to generate etcd key for creation_status
     def _generate_db_key(self):
@@ -62,13 +111,91 @@ class CcpAciServer(object):
             elif "1.9" in self.http_request["k8s_version"]:
                 return "kubernetes-1.9"
 
-        elif self.get_from_etcd()[0] is not None:
+        else:
             # return aci_flavor from etcd for "delete" and "status" operations
             try:
-                return json.loads(self.get_from_etcd()[0])["aci_flavor"]
+                return self.get_summary_from_etcd()["aci_flavor"]
+            except:
+                pass
+
+    # function to get the allocator pool of the cluster
+    def _get_allocator_pool(self):
+
+        if "aci_input_json" in self.http_request:
+            # choose the pool from apic_hosts and vmm_domain in the ACI
+            # input json for "create" operation
+            return allocator.select_pool(
+                allocator.get_aci_config(self.config_file),
+                self.http_request["aci_input_json"])
+
+        else:
+            # return allocator_pool from etcd for "delete" and "status"
+            # operations
+            try:
+                return self.get_summary_from_etcd().get("allocator_pool")
             except:
                 pass
 
+    # function that returns the id of the cluster's ACI fabric (a hash of
+    # its sorted apic_hosts) for the per-fabric concurrency limit
+    def get_fabric_id(self):
+        try:
+            apic_hosts = self._get_input_json()["aci_config"]["apic_hosts"]
+        except (KeyError, TypeError):
+            apic_hosts = []
+        return hashlib.sha1(','.join(sorted(apic_hosts))).hexdigest()[:16]
+
+    # function that returns the number of acc-provision runs on the
+    # cluster's ACI fabric at a time, MAX_CONCURRENT_ACC_PROVISION_PER_FABRIC
+    # in the DEFAULT section of config_file
+    def get_fabric_slots(self):
+        aci_config = allocator.get_aci_config(self.config_file)
+        return int(aci_config['DEFAULT'].get(
+            'MAX_CONCURRENT_ACC_PROVISION_PER_FABRIC', 1))
+
+    # function that returns the semaphore limiting the acc-provision runs
+    # on the cluster's ACI fabric across all the server replicas
+    def get_fabric_semaphore(self):
+        return FabricSemaphore(self.etcd_client, self.get_fabric_id(),
+                               self.get_fabric_slots())
+
+    # function that returns the priority class of try (starting at 1) of
+    # an acc-provision run for operation in the scheduler
+    def get_priority(self, operation, attempt=1):
+        if operation == "delete":
+            return PRIORITY_DELETE
+        if attempt > 1 or self.resumed:
+            return PRIORITY_RETRY
+        if operation == "update":
+            return PRIORITY_UPDATE
+        return PRIORITY_CREATE
+
+    # function to claim the job of the cluster for this server replica,
+    # waiting up to timeout seconds for the job of the cluster running on
+    # another replica to finish. job is the record of a resumed job in the
+    # job journal. Returns True if this replica should run the job.
+    def claim_job(self, job=None, timeout=0):
+        if not self.claim.acquire(timeout=timeout):
+            print "\nA job of cluster", self.db_key, "is already running on",\
+                  self.claim.owner(), "\n"
+            return False
+        if job is not None:
+            # another replica may have resumed or finished the job before
+            # this replica claimed it
+            current = self.journal.get()
+            if current is None or current["attempt"] != job["attempt"]:
+                self.claim.release()
+                return False
+        return True
+
+    def release_job(self):
+        self.claim.release()
+
+    # function to get the allocator of the cluster's pool
+    def get_allocator(self):
+        return allocator.Allocator(
+            self.etcd_client, self.config_file, pool=self.allocator_pool)
+
     # this function checks if the cluster name (self.db_key) already exists in etcd
     def cluster_name_is_duplicate(self):
         # delete expired and failed creations in progress if any
@@ -77,6 +204,29 @@ class CcpAciServer(object):
         if self.get_from_etcd()[0] is not None:
             return True
 
+    # function to store the creation in progress of the cluster in etcd if
+    # the cluster name does not exist yet. The check and the write are one
+    # etcd transaction, so only one of concurrent creates of a cluster gets
+    # True and starts creating it.
+    def begin_creation_in_etcd(self):
+        # delete expired and failed creations in progress if any
+        self._delete_expired_creations_in_progress()
+
+        per_cluster_status = {
+            "completed": False,
+            "aci_flavor": "",
+            "creation_start_time": time.time(),
+            "key_name": self.db_key,
+            "allocator_pool": self.allocator_pool,
+            "job_id": self.job_id
+        }
+        txn = self.etcd_client.transactions
+        success, _ = self.etcd_client.transaction(
+            compare=[txn.version(self.db_key) == 0],
+            success=[txn.put(self.db_key, json.dumps(per_cluster_status))],
+            failure=[])
+        return success
+
     # static function to validate fields in HTTP payload
     @staticmethod
     def validate_http_payload(http_request, create=False):
@@ -110,9 +260,15 @@ class CcpAciServer(object):
     # for each tenant cluster and updates the ACI input json used to
     # create configs on ACI
     def update_aci_input_json_for_cluster(self):
-        aci_allocator = allocator.Allocator(self.etcd_client, self.config_file)
-        per_cluster_state = aci_allocator.get(
-            self.http_request["ccp_cluster_name"])
+        aci_allocator = self.get_allocator()
+        try:
+            # claim a pre-reserved bundle from the warm pool without
+            # taking the allocation lock
+            per_cluster_state = aci_allocator.claim(
+                self.http_request["ccp_cluster_name"])
+        except allocator.TenantAlreadyExistsError:
+            per_cluster_state = aci_allocator.get(
+                self.http_request["ccp_cluster_name"])
         if per_cluster_state == {}:
             per_cluster_state = aci_allocator.reserve(
                 self.http_request["ccp_cluster_name"])
@@ -143,51 +299,79 @@ class CcpAciServer(object):
                     [aci_keys[2]]\
                     [aci_keys[3]] = per_cluster_state[k]
 
+    # function to get the work directory of the job
+    def get_workdir(self):
+        if self.workdir is None:
+            self.workdir = JobWorkDir(prefix="ccp-aci-" +
+                                      self.http_request["ccp_cluster_name"] +
+                                      "-")
+        return self.workdir
+
     # function to convert input json to YAML file
     def convert_input_json_to_yaml_file(self):
-        if os.path.exists(self.acc_provision_input_YAML):
-            os.remove(self.acc_provision_input_YAML)
-
-        f = open(self.acc_provision_input_YAML, "w")
+        import yaml
+        self.get_workdir().write(
+            self.acc_provision_input_YAML,
+            yaml.safe_dump(self._get_input_json(), default_flow_style=False))
 
+    # function to get the ACI input json of the cluster
+    def _get_input_json(self):
         input_json = {}
 
         if "aci_input_json" in self.http_request:
-            # get input_json from http payload for "create" operation
+            # get input_json from http payload for "create" and "update"
+            # operations
             input_json = self.http_request["aci_input_json"]
 
-        elif self.get_from_etcd()[0] is not None:
+        else:
             # get input_json from etcd for "delete" and "status" operations
-            input_json = json.loads(self.get_from_etcd()[0])["aci_input_json"]
+            input_json = self.get_input_json_from_etcd()
 
-        f.write(yaml.safe_dump(input_json, default_flow_style=False))
-        f.close()
+        return input_json
 
     # function to get the ACI certificate and key file from etcd
     #
     # after creating configs on ACI, ACI sends back a certificate file
     # (user-<cluster name>.crt) and a key file (user-<cluster name>.key) and
     # they are needed and used when deleting configs on ACI. Without these
-    # crt and key files, configs cannot be deleted on the ACI. If these crt
-    # and key files are missing due to any reason, get them from etcd and
-    # create these files so that they can be used to delete configs on ACI.
+    # crt and key files, configs cannot be deleted on the ACI. etcd is the
+    # only place they are kept, so get them from etcd into the work
+    # directory of the job so that they can be used to delete configs on ACI.
     #
+    # they are kept in their own etcd key (see certs.py), clusters created
+    # before have them in their status record
     def get_aci_certs_from_etcd(self):
-        crt_filename = "user-" + \
-                   self.http_request["ccp_cluster_name"] + \
-                   ".crt"
-        if not os.path.exists(crt_filename):
-            f = open(crt_filename, "w")
-            f.write(json.loads(self.get_from_etcd()[0])["crt_file"])
-            f.close()
-
-        key_filename = "user-" + \
-                   self.http_request["ccp_cluster_name"] + \
-                   ".key"
-        if not os.path.exists(key_filename):
-            f = open(key_filename, "w")
-            f.write(json.loads(self.get_from_etcd()[0])["key_file"])
-            f.close()
+        certs = self.get_cert_store().get(
+            self.http_request["ccp_cluster_name"])
+        if certs is None:
+            per_cluster_status = self.get_summary_from_etcd()
+            certs = per_cluster_status["crt_file"], \
+                per_cluster_status["key_file"]
+        self._write_aci_certs(*certs)
+
+    # function to store the ACI certificate and key file created by
+    # acc-provision in etcd
+    def store_aci_certs_in_etcd(self):
+        crt_file, key_file = self._read_aci_certs()
+        self.get_cert_store().put(self.http_request["ccp_cluster_name"],
+                                  crt_file, key_file)
+
+    # function to delete the ACI certificate and key file of the cluster in
+    # etcd
+    def delete_aci_certs_from_etcd(self):
+        self.get_cert_store().delete(self.http_request["ccp_cluster_name"])
+
+    # function that returns the store of the ACI certificates and keys
+    # (encrypted with the keys in $CCP_ACI_CERTS_ENCRYPTION_KEY if it is
+    # set)
+    def get_cert_store(self):
+        return CertStore(self.etcd_client, get_cipher())
+
+    # function to write the ACI certificate and key file into the work
+    # directory of the job
+    def _write_aci_certs(self, crt_file, key_file):
+        self.get_workdir().write(self.aci_crt_file, crt_file)
+        self.get_workdir().write(self.aci_key_file, key_file)
 
     # function to retry the acc-provision command
     def run_command_and_retry(self, operation, retry_count=11):
@@ -204,27 +388,33 @@ class CcpAciServer(object):
             else:
                 cmd = self._build_command(operation)
 
-            c = cmd.split()
-            # don't print ACI username and password in logs
-            c.remove(c[c.index('-u') + 1])
-            c.remove(c[c.index('-p') + 1])
-
+            # the ACI username is not printed in logs, and the ACI password
+            # is never on the command line
             print ''.join([
                 datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'),
                 " acc-provision command sent to ACI fabric", " (try ",
-                str(i) + ")", "\n\n", ' '.join(c), "\n"
+                str(i) + ")", "\n\n", ' '.join(cmd), "\n"
             ])
 
-            # grab lock and run acc-provision command on ACI fabric
-            global lock
-            with lock:
-                if not os.path.exists(self.acc_provision_input_YAML):
+            # wait for the turn of the run among the runs of this replica
+            # on the ACI fabric, take a slot of the ACI fabric (shared by
+            # all the server replicas) and run acc-provision command on ACI
+            # fabric
+            with scheduler.slot(self.get_fabric_id(), self.caller,
+                                self.get_priority(operation, i),
+                                self.get_fabric_slots()), \
+                    self.get_fabric_semaphore():
+                if not self.get_workdir().exists(
+                        self.acc_provision_input_YAML):
                     if "aci_input_json" in self.http_request:
                         # update ACI input json only for create operation
                         self.update_aci_input_json_for_cluster()
                     self.convert_input_json_to_yaml_file()
 
-                result = self.run_command(cmd)
+                result = self.run_command(
+                    cmd + ["-u", self.http_request["aci_username"]],
+                    cwd=self.get_workdir().path,
+                    env=command_env(self.http_request["aci_password"]))
                 # rate-limit multiple back-to-back requests to acc-provision
                 time.sleep(3)
 
@@ -238,25 +428,27 @@ class CcpAciServer(object):
             if result is not None:
                 print str(result)
 
-            if operation == "create":
+            if operation in ["create", "update", "generate"]:
                 if result is None or \
                    "kubectl apply -f aci_cni_deployment" not in result or \
-                   not os.path.exists(self.aci_cni_output_YAML):
-                    print "\nERROR: acc_provision_create failed (try " + str(
-                        i) + ")", "\n"
+                   not self.get_workdir().exists(self.aci_cni_output_YAML):
+                    print "\nERROR: acc_provision_" + operation + \
+                          " failed (try " + str(i) + ")", "\n"
                     if i < (retry_count - 1):
                         # sleep 3 seconds before trying to create again
                         time.sleep(3)
 
                         # return False if creation was successful in another parallel thread
-                        if self.get_from_etcd()[0] is not None and \
-                            json.loads(self.get_from_etcd()[0])["completed"]:
+                        per_cluster_status = self.get_summary_from_etcd() \
+                            if operation == "create" else None
+                        if per_cluster_status is not None and \
+                           per_cluster_status["completed"]:
                             # no need to retry creating already-created configs
                             return False
                     else:
                         # all retries to create have failed at this point
-                        print "ERROR: acc_provision_create failed after", str(
-                            retry_count - 1), "retries"
+                        print "ERROR: acc_provision_" + operation + \
+                              " failed after", str(retry_count - 1), "retries"
                 else:
                     # create succeeded
                     return True
@@ -283,13 +475,22 @@ class CcpAciServer(object):
         # all retries to create/delete have failed, return False
         return False
 
-    # static function to run a Linux command
+    # static function to run a Linux command (in the directory cwd and with
+    # the environment env if they are given)
+    #
+    # cmd is the list of the arguments of the command, or a string of
+    # arguments separated by spaces
     @staticmethod
-    def run_command(cmd):
+    def run_command(cmd, cwd=None, env=None):
+        if isinstance(cmd, basestring):
+            cmd = cmd.split()
         try:
-            cmd = "timeout 20 " + cmd
             p = subprocess.Popen(
-                cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                ["timeout", "20"] + cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                cwd=cwd,
+                env=env)
             (output, err) = p.communicate()
 
             if p.returncode != 0:
@@ -304,23 +505,18 @@ class CcpAciServer(object):
 
             return ''.join([str(output), str(err)])
         except Exception as e:
-            c = cmd.split()
-            # don't print ACI username and password in logs
-            if '-u' in c:
-                c.remove(c[c.index('-u') + 1])
-            if '-p' in c:
-                c.remove(c[c.index('-p') + 1])
+            # don't print ACI username in logs
+            c = cmd[:cmd.index('-u')] if '-u' in cmd else cmd
             print "\nERROR: The command \"" + ' '.join(c) + \
                   "\" failed with the following error: \n", type(e), str(e), "\n"
             logging.exception(e)
 
-    # function to remove input and output YAML files
+    # function to remove the work directory of the job with the input and
+    # output YAML files and the ACI certificate and key file
     def cleanup_files(self):
-        if os.path.exists(self.acc_provision_input_YAML):
-            os.remove(self.acc_provision_input_YAML)
-        if hasattr(self, 'aci_cni_output_YAML') and os.path.exists(
-                self.aci_cni_output_YAML):
-            os.remove(self.aci_cni_output_YAML)
+        if self.workdir is not None:
+            self.workdir.cleanup()
+            self.workdir = None
 
     # static function to get the git sha1 as the version
     @staticmethod
@@ -331,12 +527,18 @@ class CcpAciServer(object):
             return CcpAciServer.run_command("cat ../ccp_aci_service_version")
 
     # function to convert ACI CNI deployment output YAML to list
+    #
+    # the ACI CNI is returned as a list of the json texts of its Kubernetes
+    # manifests, the YAML documents are read from the file and converted one
+    # at a time
     def get_response_list(self):
-        f = open(self.aci_cni_output_YAML, "r")
-        k8s_manifests = yaml.load_all(f)
+        import yaml
+        f = open(self.get_workdir().join(self.aci_cni_output_YAML), "r")
+        k8s_manifests = yaml.safe_load_all(f)
         response = []
         for k8s_manifest in k8s_manifests:
-            response.append(k8s_manifest)
+            if k8s_manifest is not None:
+                response.append(json.dumps(k8s_manifest))
         f.close()
         return response
 
@@ -345,43 +547,56 @@ class CcpAciServer(object):
         with self.etcd_client.lock(self.etcd_lock_name):
             return self.etcd_client.get(self.db_key)
 
+    # function to get the summary of the cluster (the value of self.db_key)
+    # from etcd, or None if the cluster does not exist
+    def get_summary_from_etcd(self):
+        with self.etcd_client.lock(self.etcd_lock_name):
+            return self.status_store.get_summary()
+
+    # function to get the ACI input json of the cluster from etcd
+    def get_input_json_from_etcd(self, per_cluster_status=None):
+        with self.etcd_client.lock(self.etcd_lock_name):
+            return self.status_store.get_input_json(per_cluster_status)
+
+    # function to get an iterator over the json texts of the manifests of
+    # the ACI CNI of the cluster from etcd
+    def get_aci_cni_texts_from_etcd(self, per_cluster_status=None):
+        with self.etcd_client.lock(self.etcd_lock_name):
+            return self.status_store.get_manifest_texts(per_cluster_status)
+
     # function to put a dictionary as value of self.db_key into etcd
     def put_into_etcd(self, dict_value):
         with self.etcd_client.lock(self.etcd_lock_name):
-            self.etcd_client.put(self.db_key, json.dumps(dict_value))
+            self.status_store.put_summary(dict_value)
+
+    # function to read the ACI certificate and key file created by
+    # acc-provision
+    def _read_aci_certs(self):
+        return self.get_workdir().read(self.aci_crt_file), \
+            self.get_workdir().read(self.aci_key_file)
 
     # function to update creation_status value of self.db_key in etcd
+    # together with the ACI input json and the ACI CNI of the cluster (the
+    # ACI certificate and key file are stored by store_aci_certs_in_etcd())
     def update_creation_status_in_etcd(self, response):
-        key_filename = "user-" + \
-                   self.http_request["ccp_cluster_name"] + \
-                   ".key"
-        f = open(key_filename, "r")
-        key_file = f.read()
-        f.close()
-
-        crt_filename = "user-" + \
-                   self.http_request["ccp_cluster_name"] + \
-                   ".crt"
-        f = open(crt_filename, "r")
-        crt_file = f.read()
-        f.close()
-
         per_cluster_status = {
             "completed": True,
-            "crt_file": crt_file,
-            "key_file": key_file,
-            "aci_input_json": self.http_request["aci_input_json"],
             "aci_flavor": self.aci_flavor,
-            "output_aci_cni_yaml": response,
             "creation_start_time": 0.0,
-            "key_name": self.db_key
+            "key_name": self.db_key,
+            "allocator_pool": self.allocator_pool,
+            "manifests": len(response)
         }
-        self.put_into_etcd(per_cluster_status)
+        with self.etcd_client.lock(self.etcd_lock_name):
+            self.status_store.put(per_cluster_status,
+                                  self.http_request["aci_input_json"],
+                                  response)
 
-    # function to delete self.db_key in etcd
+    # function to delete self.db_key, the ACI input json and the ACI CNI of
+    # the cluster in etcd
     def delete_from_etcd(self):
         with self.etcd_client.lock(self.etcd_lock_name):
-            self.etcd_client.delete(self.db_key)
+            self.status_store.delete()
 
     # function to delete stale key for the cluster in etcd
     def delete_stale_key_in_etcd(self):
@@ -393,38 +608,220 @@ class CcpAciServer(object):
             self.etcd_client.delete_prefix(prefix)
 
     # function to get the per-cluster ACI CNI if it exists in etcd
-    def get_aci_cni_for_cluster_from_etcd(self):
-        if self.get_from_etcd()[0] is None:
+    #
+    # with manifests=False the ACI CNI is not read, and the summary of the
+    # created cluster is returned instead of it. With as_json=True the ACI
+    # CNI is returned as an iterator over the json texts of its manifests
+    # as they are stored.
+    def get_aci_cni_for_cluster_from_etcd(self, manifests=True,
+                                          as_json=False):
+        per_cluster_status = self.get_summary_from_etcd()
+        if per_cluster_status is None:
             return [False, False]
-        elif not json.loads(self.get_from_etcd()[0])["completed"]:
+        elif not per_cluster_status["completed"]:
             return ["", "Creation of ACI configs for cluster still in progress... "\
                    "Re-try after few seconds."]
         else:
-            aci_cni_json = json.loads(
-                self.get_from_etcd()[0])["output_aci_cni_yaml"]
-            aci_allocator = allocator.Allocator(self.etcd_client,
-                                                self.config_file)
+            aci_cni_json = per_cluster_status
+            if manifests:
+                aci_cni_json = self.get_aci_cni_texts_from_etcd(
+                    per_cluster_status)
+                if aci_cni_json is None:
+                    return [False, False]
+                if not as_json:
+                    aci_cni_json = [json.loads(m) for m in aci_cni_json]
+            aci_allocator = self.get_allocator()
             per_cluster_allocator_state = aci_allocator.get(
                 self.http_request["ccp_cluster_name"])
             return [per_cluster_allocator_state, aci_cni_json]
 
+    # function to generate etcd key for the cached acc-provision output of
+    # the rendered ACI input YAML and the ACI flavor
+    @staticmethod
+    def _generate_cache_key(input_json, aci_flavor):
+        import yaml
+        # yaml.safe_dump sorts the keys, so the same ACI input json always
+        # renders to the same YAML
+        h = hashlib.sha256()
+        h.update(str(aci_flavor))
+        h.update("\n")
+        h.update(yaml.safe_dump(input_json, default_flow_style=False))
+
+        # key format in etcd is:
+        # /acc_provision_cache__<sha256 of ACI flavor and input YAML>
+        return "/acc_provision_cache__" + h.hexdigest()
+
+    # function to get the cached ACI CNI for the rendered ACI input YAML
+    #
+    # acc-provision is not run again for a create with the same ACI input
+    # json (including the allocator bundle) and ACI flavor as an earlier
+    # successful create (a retried create for example) if the configs it
+    # created still exist on the APIC. Returns None if there is no cached
+    # output or the configs on the APIC are missing.
+    def get_cached_response(self):
+        value = self.etcd_client.get(
+            self._generate_cache_key(self._get_input_json(),
+                                     self.aci_flavor))[0]
+        if value is None:
+            return None
+
+        cached = json.loads(value)
+        try:
+            apic_client = ApicClient(
+                self.http_request["aci_input_json"]["aci_config"][
+                    "apic_hosts"][0], self.http_request["aci_username"],
+                self.http_request["aci_password"]).login()
+            if not apic_client.all_exist(cached["apic_object_dns"]):
+                print "\nCached ACI CNI for cluster", self.db_key, \
+                      "is stale as its configs are missing on ACI\n"
+                return None
+        except Exception as e:
+            print "\nERROR: Could not verify the cached ACI CNI for cluster", \
+                  self.db_key, "on ACI:", type(e), str(e), "\n"
+            return None
+
+        # restore the certificate and key file of the cached output (cached
+        # outputs of earlier versions have them)
+        if "crt_file" in cached:
+            self._write_aci_certs(cached["crt_file"], cached["key_file"])
+        else:
+            self.get_aci_certs_from_etcd()
+
+        # cached outputs of earlier versions have the manifests as a list
+        if "manifests" not in cached:
+            return [json.dumps(m) for m in cached["output_aci_cni_yaml"]]
+        return list(iter_manifest_texts(cached["manifests"]))
+
+    # function to cache the ACI CNI created by acc-provision for the
+    # rendered ACI input YAML (the ACI certificate and key file of the
+    # cluster are stored by store_aci_certs_in_etcd() before)
+    def cache_response(self, response):
+        cached = {
+            "aci_flavor": self.aci_flavor,
+            "manifests": '\n'.join(response),
+            "apic_object_dns":
+            apic_object_dns(self.http_request["ccp_cluster_name"]),
+            "cached_time": time.time()
+        }
+        self.etcd_client.put(
+            self._generate_cache_key(self._get_input_json(), self.aci_flavor),
+            json.dumps(cached))
+
+    # function to delete the cached ACI CNI for the rendered ACI input YAML
+    # (or for input_json and aci_flavor if they are given)
+    def delete_cached_response(self, input_json=None, aci_flavor=None):
+        if input_json is None:
+            input_json = self._get_input_json()
+            aci_flavor = self.aci_flavor
+        self.etcd_client.delete(
+            self._generate_cache_key(input_json, aci_flavor))
+
     # function to build acc-provision command
+    #
+    # "update" creates the configs on ACI like "create" (the APIC does not
+    # change the configs that are already up to date) and "generate" only
+    # generates the ACI CNI without changing the configs on ACI
+    # the command is a list of arguments without the ACI username and
+    # password, run_command_and_retry() adds them
     def _build_command(self, operation):
-        if operation == "create":
-            return ''.join([
-                "acc-provision -a -c ", self.acc_provision_input_YAML, " -f ",
-                self.aci_flavor, " ", "-o ", self.aci_cni_output_YAML,
-                " --debug -u ", self.http_request["aci_username"], " ", "-p ",
-                self.http_request["aci_password"]
-            ])
+        if operation in ["create", "update"]:
+            return [
+                "acc-provision", "-a", "-c", self.acc_provision_input_YAML,
+                "-f", self.aci_flavor, "-o", self.aci_cni_output_YAML,
+                "--debug"
+            ]
+
+        elif operation == "generate":
+            return [
+                "acc-provision", "-c", self.acc_provision_input_YAML, "-f",
+                self.aci_flavor, "-o", self.aci_cni_output_YAML, "--debug"
+            ]
 
         elif operation == "delete":
-            return ''.join([
-                "acc-provision -d -c ", self.acc_provision_input_YAML, " -f ",
-                self.aci_flavor, " ", "--debug -u ",
-                self.http_request["aci_username"], " ", "-p ",
-                self.http_request["aci_password"]
-            ])
+            return [
+                "acc-provision", "-d", "-c", self.acc_provision_input_YAML,
+                "-f", self.aci_flavor, "--debug"
+            ]
+
+    # function to mark the cluster as being updated in etcd
+    #
+    # returns an empty error if the update can start, or the http status
+    # code and error if the cluster can't be updated
+    def begin_update_in_etcd(self, expiration_time=300):
+        with self.etcd_client.lock(self.etcd_lock_name):
+            value = self.etcd_client.get(self.db_key)[0]
+            if value is None:
+                return 404, "ACI configs not found for cluster " + \
+                       self.http_request["ccp_cluster_name"] + \
+                       ". Use http endpoint /api/v1/acc_provision_create " \
+                       "to create (POST) configs on ACI first."
+
+            per_cluster_status = json.loads(value)
+            update_expired = (time.time() - per_cluster_status.get(
+                "update_start_time", 0.0)) > expiration_time
+            if not per_cluster_status["completed"] or \
+               (per_cluster_status.get("update_in_progress") and
+                not update_expired):
+                return 409, "Creation or update of ACI configs for " \
+                       "cluster still in progress... Re-try after few seconds."
+
+            if per_cluster_status.get("allocator_pool") != \
+               self.allocator_pool:
+                return 400, "apic_hosts or vmm_domain of the update " \
+                       "belong to a different allocator pool. Delete and " \
+                       "create the cluster to move it to another pool."
+
+            per_cluster_status["update_in_progress"] = True
+            per_cluster_status["update_start_time"] = time.time()
+            self.etcd_client.put(self.db_key, json.dumps(per_cluster_status))
+            return 202, ''
+
+    # function to clear the update in progress of the cluster in etcd
+    # after a failed update
+    def end_update_in_etcd(self, error=''):
+        with self.etcd_client.lock(self.etcd_lock_name):
+            value = self.etcd_client.get(self.db_key)[0]
+            if value is None:
+                return
+            per_cluster_status = json.loads(value)
+            per_cluster_status["update_in_progress"] = False
+            per_cluster_status["update_error"] = error
+            self.etcd_client.put(self.db_key, json.dumps(per_cluster_status))
+
+    # function to check if the cluster is being updated
+    def update_in_progress(self):
+        per_cluster_status = self.get_summary_from_etcd()
+        return per_cluster_status is not None and \
+            per_cluster_status.get("update_in_progress", False)
+
+    # function to check if a creation, update or deletion of the cluster is
+    # in progress
+    def job_in_progress(self):
+        per_cluster_status = self.get_summary_from_etcd()
+        if per_cluster_status is not None:
+            if not per_cluster_status["completed"] or \
+               per_cluster_status.get("update_in_progress", False):
+                return True
+        return self.journal.get() is not None
+
+    # function to wait up to timeout seconds for the creation, update or
+    # deletion of the cluster in progress to finish (long-poll of
+    # /api/v1/acc_provision_status)
+    #
+    # waits for changes of the cluster's status in etcd, and checks the job
+    # at least once every poll_interval seconds
+    def wait_for_job(self, timeout, poll_interval=1):
+        deadline = time.time() + timeout
+        while self.job_in_progress():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                self.etcd_client.watch_once(
+                    self.db_key, timeout=min(remaining, poll_interval))
+            except WatchTimedOut:
+                pass
+        return True
 
     # function to delete expired and failed creations in progress
     # (default expiration time is 5 mins or 300 seconds)
@@ -438,9 +835,6 @@ class CcpAciServer(object):
                 if creation_start_time != 0.0 and \
                    not completed and \
                    (time.time() - creation_start_time) > expiration_time:
-                    # delete expired creation status in progress for failed cluster
-                    self.etcd_client.delete(c["key_name"])
-
                     # get cluster name from c["key_name"]
                     #
                     # format of c["key_name"] in etcd is:
@@ -451,8 +845,20 @@ class CcpAciServer(object):
                     cluster_name.remove(cluster_name[len(cluster_name) - 1])
                     cluster_name = ''.join(cluster_name)
 
+                    # a creation in the job journal is still running or
+                    # will be resumed, so it has not failed
+                    if JobJournal(self.etcd_client,
+                                  cluster_name).get() is not None:
+                        continue
+
+                    # delete expired creation status in progress for failed cluster
+                    StatusStore(self.etcd_client, cluster_name).delete()
+                    CertStore(self.etcd_client).delete(cluster_name)
+
                     # delete expired allocator state for failed cluster
-                    a = allocator.Allocator(self.etcd_client, self.config_file)
+                    a = allocator.Allocator(self.etcd_client,
+                                            self.config_file,
+                                            pool=c.get("allocator_pool"))
                     if a.get(cluster_name) != {}:
                         a.free(cluster_name)
                     print "\n", datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'),\
@@ -463,27 +869,38 @@ class CcpAciServer(object):
 
 # class CcpAciAsyncCreate inherits the threading.Thread class and
 # configures ACI asynchronously in a different thread
+#
+# job is the record of an unfinished create in the job journal if the create
+# is resumed after a restart, reserved is True if the creation in progress
+# was stored by begin_creation_in_etcd()
 class CcpAciAsyncCreate(threading.Thread):
-    def __init__(self, ccp_aci_server):
-        threading.Thread.__init__(self)
+    def __init__(self, ccp_aci_server, job=None, reserved=False):
+        # the thread is named after the job and the cluster (shown in the
+        # profiles of the threads)
+        threading.Thread.__init__(
+            self,
+            name="create-" + ccp_aci_server.http_request["ccp_cluster_name"])
         self.ccp_aci_server = ccp_aci_server
+        self.job = job
+        self.reserved = reserved
 
     # this function runs in a different thread
     # (start() in threading.Thread class calls this function)
     def run(self):
+        # only one replica runs the jobs of a cluster at a time
+        if not self.ccp_aci_server.claim_job(self.job):
+            return
         try:
             # delete expired and failed creations in progress if any
             self.ccp_aci_server._delete_expired_creations_in_progress()
 
             per_cluster_status = {
                 "completed": False,
-                "crt_file": "",
-                "key_file": "",
-                "aci_input_json": {},
                 "aci_flavor": "",
-                "output_aci_cni_yaml": [],
                 "creation_start_time": time.time(),
-                "key_name": self.ccp_aci_server.db_key
+                "key_name": self.ccp_aci_server.db_key,
+                "allocator_pool": self.ccp_aci_server.allocator_pool,
+                "job_id": self.ccp_aci_server.job_id
             }
 
             program_aci = False
@@ -495,19 +912,58 @@ class CcpAciAsyncCreate(threading.Thread):
                     self.ccp_aci_server.db_key, "\n"
                 program_aci = True
 
+            elif self.reserved and self.job is None:
+                print "\nStored creation_status in etcd for new cluster", \
+                    self.ccp_aci_server.db_key, "\n"
+                program_aci = True
+
+            elif self.job is not None and not json.loads(
+                    self.ccp_aci_server.get_from_etcd()[0])["completed"]:
+                # refresh creation_start_time of the resumed creation so that
+                # it does not expire while it runs again
+                self.ccp_aci_server.put_into_etcd(per_cluster_status)
+                print "\nResuming creation of ACI configs for cluster", \
+                    self.ccp_aci_server.db_key, "after step", \
+                    self.job["last_step"], "\n"
+                program_aci = True
+
             if program_aci:
+                self.ccp_aci_server.journal.begin(
+                    "create",
+                    self.ccp_aci_server.http_request,
+                    self.job,
+                    job_id=self.ccp_aci_server.job_id,
+                    caller=self.ccp_aci_server.caller)
                 print "Programming ACI for new cluster", \
                     self.ccp_aci_server.db_key, "\n"
-                # update ACI input json
+                # update ACI input json (a resumed creation gets the
+                # allocator state it reserved before)
                 self.ccp_aci_server.update_aci_input_json_for_cluster()
+                self.ccp_aci_server.journal.step(
+                    "allocated",
+                    http_request=self.ccp_aci_server.http_request)
                 self.ccp_aci_server.convert_input_json_to_yaml_file()
-                if not self.ccp_aci_server.run_command_and_retry("create"):
-                    raise Exception("Failed to program ACI for cluster " +
-                                    self.ccp_aci_server.db_key)
-                response = self.ccp_aci_server.get_response_list()
-                self.ccp_aci_server.cleanup_files()
+
+                # a resumed creation that already programmed ACI gets its
+                # ACI CNI from the cache
+                response = self.ccp_aci_server.get_cached_response()
+                if response is not None:
+                    print "Using cached ACI CNI for cluster", \
+                        self.ccp_aci_server.db_key, "\n"
+                else:
+                    if not self.ccp_aci_server.run_command_and_retry(
+                            "create"):
+                        raise Exception("Failed to program ACI for cluster " +
+                                        self.ccp_aci_server.db_key)
+                    response = self.ccp_aci_server.get_response_list()
+                    self.ccp_aci_server.store_aci_certs_in_etcd()
+                    self.ccp_aci_server.cache_response(response)
+                self.ccp_aci_server.journal.step("provisioned")
+
                 # update creation_status for the successful cluster in etcd
                 self.ccp_aci_server.update_creation_status_in_etcd(response)
+                self.ccp_aci_server.cleanup_files()
+                self.ccp_aci_server.journal.finish()
                 print "Done programming ACI for new cluster", \
                     self.ccp_aci_server.db_key, "\n"
             else:
@@ -531,48 +987,89 @@ class CcpAciAsyncCreate(threading.Thread):
             if self.ccp_aci_server.get_from_etcd()[0] is not None and \
                not json.loads(self.ccp_aci_server.get_from_etcd()[0])["completed"]:
                 self.ccp_aci_server.delete_from_etcd()
+            if self.ccp_aci_server.journal.job is not None:
+                self.ccp_aci_server.journal.finish()
             raise e
+        finally:
+            self.ccp_aci_server.release_job()
 
 
 # class CcpAciAsyncDelete inherits the threading.Thread class and
 # deletes ACI configs asynchronously in a different thread
+#
+# job is the record of an unfinished delete in the job journal if the delete
+# is resumed after a restart
 class CcpAciAsyncDelete(threading.Thread):
-    def __init__(self, ccp_aci_server):
-        threading.Thread.__init__(self)
+    def __init__(self, ccp_aci_server, job=None):
+        threading.Thread.__init__(
+            self,
+            name="delete-" + ccp_aci_server.http_request["ccp_cluster_name"])
         self.ccp_aci_server = ccp_aci_server
+        self.job = job
 
     # this function runs in a different thread
     # (start() in threading.Thread class calls this function)
     def run(self):
+        # wait for a running job of the cluster (like its creation) to
+        # finish on this or another replica
+        if not self.ccp_aci_server.claim_job(
+                self.job, timeout=None if self.job is None else 0):
+            return
         try:
             # also delete expired and failed creations in progress if any
             self.ccp_aci_server._delete_expired_creations_in_progress()
 
-            if self.ccp_aci_server.get_from_etcd()[0] is None:
+            deprovisioned = self.job is not None and \
+                self.job["last_step"] == "deprovisioned"
+
+            if self.ccp_aci_server.get_from_etcd()[0] is None and \
+               not deprovisioned:
                 print "\nState not found in etcd for cluster", self.ccp_aci_server.db_key, "\n"
+                if self.job is not None:
+                    self.ccp_aci_server.journal.finish()
                 return
 
-            print "Deleting ACI configs for cluster", \
-                self.ccp_aci_server.db_key, "\n"
-            self.ccp_aci_server.convert_input_json_to_yaml_file()
-            self.ccp_aci_server.get_aci_certs_from_etcd()
-            if not self.ccp_aci_server.run_command_and_retry("delete"):
-                raise Exception("Failed to delete ACI configs for cluster " +
-                                self.ccp_aci_server.db_key)
-            self.ccp_aci_server.cleanup_files()
+            if self.job is not None:
+                # the cluster's state in etcd may be deleted already
+                self.ccp_aci_server.allocator_pool = self.job.get(
+                    "allocator_pool")
+            self.ccp_aci_server.journal.begin(
+                "delete",
+                self.ccp_aci_server.http_request,
+                self.job,
+                allocator_pool=self.ccp_aci_server.allocator_pool,
+                job_id=self.ccp_aci_server.job_id,
+                caller=self.ccp_aci_server.caller)
+
+            if deprovisioned:
+                print "Resuming deletion of ACI configs for cluster", \
+                    self.ccp_aci_server.db_key, "after step", \
+                    self.job["last_step"], "\n"
+            else:
+                print "Deleting ACI configs for cluster", \
+                    self.ccp_aci_server.db_key, "\n"
+                self.ccp_aci_server.convert_input_json_to_yaml_file()
+                self.ccp_aci_server.get_aci_certs_from_etcd()
+                if not self.ccp_aci_server.run_command_and_retry("delete"):
+                    raise Exception("Failed to delete ACI configs for cluster " +
+                                    self.ccp_aci_server.db_key)
+                # the cached ACI CNI is stale once its configs are deleted
+                self.ccp_aci_server.delete_cached_response()
+                self.ccp_aci_server.cleanup_files()
+                self.ccp_aci_server.journal.step("deprovisioned")
 
             # delete creation_status for cluster in etcd
             self.ccp_aci_server.delete_from_etcd()
             self.ccp_aci_server.delete_stale_key_in_etcd()
-            aci_allocator = allocator.Allocator(
-                self.ccp_aci_server.etcd_client,
-                self.ccp_aci_server.config_file)
+            self.ccp_aci_server.delete_aci_certs_from_etcd()
+            aci_allocator = self.ccp_aci_server.get_allocator()
             if aci_allocator.get(self.ccp_aci_server.
                                  http_request["ccp_cluster_name"]) != {}:
                 # free state stored by server/allocator.py
                 aci_allocator.free(
                     self.ccp_aci_server.http_request["ccp_cluster_name"])
 
+            self.ccp_aci_server.journal.finish()
             print "Deleted ACI configs for cluster", \
                 self.ccp_aci_server.db_key, "\n"
 
@@ -584,4 +1081,284 @@ class CcpAciAsyncDelete(threading.Thread):
                 self.ccp_aci_server.cleanup_files()
             except:
                 pass
+            if self.ccp_aci_server.journal.job is not None:
+                self.ccp_aci_server.journal.finish()
+            raise e
+        finally:
+            self.ccp_aci_server.release_job()
+
+
+# class CcpAciAsyncUpdate inherits the threading.Thread class and updates
+# the ACI configs and ACI CNI of a created cluster asynchronously in a
+# different thread
+#
+# the cluster keeps its allocator bundle and ACI certificate, and configs on
+# ACI are only pushed again if the ACI fabric sections of the ACI input json
+# changed (changes in the other sections, like the registry, only generate
+# the ACI CNI again)
+#
+# job is the record of an unfinished update in the job journal if the update
+# is resumed after a restart
+class CcpAciAsyncUpdate(threading.Thread):
+    def __init__(self, ccp_aci_server, job=None):
+        threading.Thread.__init__(
+            self,
+            name="update-" + ccp_aci_server.http_request["ccp_cluster_name"])
+        self.ccp_aci_server = ccp_aci_server
+        self.job = job
+
+    # this function runs in a different thread
+    # (start() in threading.Thread class calls this function)
+    def run(self):
+        if not self.ccp_aci_server.claim_job(
+                self.job, timeout=None if self.job is None else 0):
+            return
+        try:
+            self.ccp_aci_server.journal.begin(
+                "update",
+                self.ccp_aci_server.http_request,
+                self.job,
+                job_id=self.ccp_aci_server.job_id,
+                caller=self.ccp_aci_server.caller)
+            if self.job is not None:
+                print "\nResuming update of ACI configs for cluster", \
+                    self.ccp_aci_server.db_key, "\n"
+
+            per_cluster_status = \
+                self.ccp_aci_server.get_summary_from_etcd()
+            old_input_json = self.ccp_aci_server.get_input_json_from_etcd(
+                per_cluster_status)
+
+            # apply the cluster's allocator bundle to the new ACI input json
+            self.ccp_aci_server.update_aci_input_json_for_cluster()
+
+            changed = diff_input_json(
+                old_input_json,
+                self.ccp_aci_server.http_request["aci_input_json"])
+            if not changed and \
+               per_cluster_status["aci_flavor"] == self.ccp_aci_server.aci_flavor:
+                print "\nNo changes to ACI configs for cluster", \
+                    self.ccp_aci_server.db_key, "\n"
+                self.ccp_aci_server.end_update_in_etcd()
+                self.ccp_aci_server.journal.finish()
+                return
+
+            fabric_changed = [
+                k for k in changed
+                if k.split('.')[0] in FABRIC_CONFIG_SECTIONS
+            ]
+            print "Updating ACI configs for cluster", \
+                self.ccp_aci_server.db_key, "changed:", ', '.join(changed), \
+                "\n"
+
+            self.ccp_aci_server.convert_input_json_to_yaml_file()
+            # keep the cluster's ACI certificate and key
+            self.ccp_aci_server.get_aci_certs_from_etcd()
+            operation = "update" if fabric_changed else "generate"
+            if not self.ccp_aci_server.run_command_and_retry(operation):
+                raise Exception("Failed to update ACI configs for cluster " +
+                                self.ccp_aci_server.db_key)
+            response = self.ccp_aci_server.get_response_list()
+            self.ccp_aci_server.store_aci_certs_in_etcd()
+            self.ccp_aci_server.journal.step("provisioned")
+
+            # the cached ACI CNI of the old ACI input json is stale now
+            self.ccp_aci_server.delete_cached_response(
+                old_input_json,
+                per_cluster_status["aci_flavor"])
+            self.ccp_aci_server.cache_response(response)
+
+            # update creation_status for the updated cluster in etcd
+            self.ccp_aci_server.update_creation_status_in_etcd(response)
+            self.ccp_aci_server.cleanup_files()
+            self.ccp_aci_server.journal.finish()
+            print "Updated ACI configs for cluster", \
+                self.ccp_aci_server.db_key, "\n"
+
+        except Exception as e:
+            # handle exception raised in thread
+            print "\nERROR:", type(e), str(e), "in thread\n"
+            logging.exception(e)
+            try:
+                self.ccp_aci_server.cleanup_files()
+            except:
+                pass
+            # keep the cluster's last ACI CNI and allow updating it again
+            self.ccp_aci_server.end_update_in_etcd(str(e))
+            if self.ccp_aci_server.journal.job is not None:
+                self.ccp_aci_server.journal.finish()
             raise e
+        finally:
+            self.ccp_aci_server.release_job()
+
+
+# function to resume the unfinished jobs in the job journal that no
+# replica runs (after a restart, or when the replica running them died)
+#
+# every job is resumed at the last step it completed (the steps before it
+# are not run again, or are idempotent), unless it was started
+# MAX_JOB_ATTEMPTS times already or its APIC password is not in the journal
+# (see JobJournal.resumable_request()). Returns the threads of the resumed
+# jobs.
+def resume_unfinished_jobs(etcd_client, config_file="aci.conf"):
+    threads = []
+    for job in JobJournal.unfinished(etcd_client):
+        # the APIC password is not in the journal unless it is encrypted
+        http_request = JobJournal.resumable_request(job)
+        ccp_aci_server = CcpAciServer(http_request or job["http_request"],
+                                      etcd_client, config_file)
+        if ccp_aci_server.claim.owner() is not None:
+            # the job is running on a replica
+            continue
+        ccp_aci_server.job_id = job.get("job_id")
+        ccp_aci_server.caller = job.get("caller", ccp_aci_server.caller)
+        ccp_aci_server.resumed = True
+
+        error = None
+        if job["attempt"] >= MAX_JOB_ATTEMPTS:
+            error = job["operation"] + " did not finish after " + \
+                str(job["attempt"]) + " attempts"
+        elif http_request is None:
+            error = job["operation"] + " can't be resumed without the " \
+                "APIC password, send the request again"
+        if error is not None:
+            if not ccp_aci_server.claim_job(job):
+                continue
+            print "\nERROR: Giving up", job["operation"], "of cluster", \
+                  ccp_aci_server.db_key + ":", error, "\n"
+            if job["operation"] == "create" and \
+               ccp_aci_server.get_from_etcd()[0] is not None and \
+               not json.loads(ccp_aci_server.get_from_etcd()[0])["completed"]:
+                ccp_aci_server.delete_from_etcd()
+            elif job["operation"] == "update":
+                ccp_aci_server.end_update_in_etcd(error)
+            ccp_aci_server.journal.finish()
+            ccp_aci_server.release_job()
+            continue
+
+        print "\nResuming", job["operation"], "of cluster", \
+              ccp_aci_server.db_key, "(attempt", job["attempt"] + 1, \
+              "of", str(MAX_JOB_ATTEMPTS) + ") owned by", job["owner"], "\n"
+        async_task = {
+            "create": CcpAciAsyncCreate,
+            "delete": CcpAciAsyncDelete,
+            "update": CcpAciAsyncUpdate
+        }[job["operation"]](ccp_aci_server, job)
+        async_task.start()
+        threads.append(async_task)
+    return threads
+
+
+# class OrphanJobScanner inherits the threading.Thread class and resumes
+# the unfinished jobs that no replica runs once every interval seconds
+#
+# with several replicas, the jobs of a replica that dies are resumed by the
+# first replica that claims them after their claims expire
+class OrphanJobScanner(threading.Thread):
+    def __init__(self, etcd_client, config_file="aci.conf", interval=10):
+        threading.Thread.__init__(self, name="orphan-job-scanner")
+        self.daemon = True
+        self.etcd_client = etcd_client
+        self.config_file = config_file
+        self.interval = interval
+
+    # this function runs in a different thread
+    # (start() in threading.Thread class calls this function)
+    def run(self):
+        while True:
+            try:
+                resume_unfinished_jobs(self.etcd_client, self.config_file)
+            except Exception as e:
+                # keep scanning after errors
+                print "\nERROR:", type(e), str(e), "in orphan job thread\n"
+                logging.exception(e)
+            time.sleep(self.interval)
+
+
+# class AciConfigWatcher inherits the threading.Thread class and checks
+# config_file once every interval seconds, the new configurations are used
+# once they are validated against the bundles handed out, so that pools
+# can be added and their ranges changed without restarting the server
+class AciConfigWatcher(threading.Thread):
+    def __init__(self, etcd_client, config_file="aci.conf", interval=5):
+        threading.Thread.__init__(self, name="aci-config-watcher")
+        self.daemon = True
+        self.etcd_client = etcd_client
+        self.config_file = config_file
+        self.interval = interval
+
+    # this function runs in a different thread
+    # (start() in threading.Thread class calls this function)
+    def run(self):
+        while True:
+            try:
+                self.reload()
+            except Exception as e:
+                # keep watching after errors
+                print "\nERROR:", type(e), str(e), "in config watcher thread\n"
+                logging.exception(e)
+            time.sleep(self.interval)
+
+    # function to use config_file again if it changed and its new
+    # configurations are valid, returns True if they are used
+    def reload(self):
+        old_aci_config = allocator.get_aci_config(self.config_file)
+        warnings = []
+
+        def validate(aci_config):
+            warnings.extend(allocator.validate_aci_config(
+                self.etcd_client, aci_config, old_aci_config))
+
+        try:
+            if not allocator.aci_configs.reload(self.config_file, validate):
+                return False
+        except Exception as e:
+            print "\nERROR: the changes of", self.config_file, \
+                  "are not used:", str(e), "\n"
+            return False
+
+        for warning in warnings:
+            print "\nWARNING:", warning, "\n"
+        print datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'), \
+              "Using version", \
+              allocator.aci_configs.info(self.config_file)["version"], \
+              "of", self.config_file, "\n"
+        return True
+
+
+# class WarmPoolFiller inherits the threading.Thread class and keeps the
+# warm pools of pre-reserved bundles of the default pool and of the named
+# pools in config_file full in the background
+class WarmPoolFiller(threading.Thread):
+    def __init__(self, etcd_client, config_file="aci.conf", interval=10):
+        threading.Thread.__init__(self, name="warm-pool-filler")
+        self.daemon = True
+        self.etcd_client = etcd_client
+        self.config_file = config_file
+        self.interval = interval
+
+    # this function runs in a different thread
+    # (start() in threading.Thread class calls this function)
+    def run(self):
+        while True:
+            pools = [None] + allocator.pool_names(
+                allocator.get_aci_config(self.config_file))
+            for pool in pools:
+                try:
+                    self.fill(pool)
+                except Exception as e:
+                    # keep filling the warm pools after errors
+                    print "\nERROR:", type(e), str(e), "in warm pool thread\n"
+                    logging.exception(e)
+            time.sleep(self.interval)
+
+    # function to fill the warm pool of one allocator pool
+    def fill(self, pool):
+        aci_allocator = allocator.Allocator(self.etcd_client,
+                                            self.config_file, pool=pool)
+        if aci_allocator.warm_pool_count() < aci_allocator.WARM_POOL_SIZE:
+            added = aci_allocator.fill_warm_pool()
+            if added > 0:
+                print datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'),\
+                      "Added", added, "bundles to the warm pool of pool",\
+                      pool or "default", "\n"
@@ -0,0 +1,647 @@
+#!/usr/bin/python
+
+# Copyright 2018 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+################################################################
+#                                                              #
+# Snapshots of the state of the CCP ACI service                #
+#                                                              #
+# Exports the allocator state of every pool and the status of  #
+# the clusters to a binary snapshot file, and imports it into  #
+# etcd, to back up, restore or clone the state                 #
+#                                                              #
+# Run "./snapshot.py -h" to see usage                          #
+#                                                              #
+################################################################
+
+import argparse
+import json
+import struct
+import sys
+import zlib
+
+import allocator
+from certs import CertStore
+from etcd_backend import MEMORY_BACKEND, new_etcd_client
+from status import STATUS_KEY_PREFIX, StatusStore, cluster_name_of_key
+
+# A snapshot is a header followed by sections, so that it can be written
+# and read one section at a time:
+#
+#   header:  SNAPSHOT_MAGIC, version (uint16), flags (uint16)
+#   section: kind (uint8), length (uint32), crc32 (uint32) of the payload,
+#            payload (compressed with zlib if FLAG_ZLIB is set)
+#
+# All the integers are big endian. The payloads of the sections are:
+#
+#   NAMES:    count (uint32), then count names (uint16 length + utf-8),
+#             appended to the table of the names of the clusters (and warm
+#             pool bundles) the other sections refer to by index
+#   POOL:     pool name (uint16 length + utf-8, "" for the default pool),
+#             count (uint32) of bundles, then the columns of the bundles:
+#             name index (uint32), kubeapi vlan (uint16), service vlan
+#             (uint16), service subnet (uint32), its prefix length (uint8),
+#             multicast range start and end (uint32), pod subnet (uint32),
+#             its prefix length (uint8), and the json of the bundles that
+#             don't fit in the columns (uint32 length)
+#   CLUSTERS: count (uint32) of clusters, then for every cluster its name
+#             index (uint32) and the values of its status, ACI input json,
+#             manifests and certs keys (int32 length, -1 if the key does
+#             not exist, + the value as it is in etcd)
+#   END:      number of pools and clusters (uint32), so that the reader
+#             knows that the snapshot is complete
+SNAPSHOT_MAGIC = "CCPASNAP"
+SNAPSHOT_VERSION = 1
+FLAG_ZLIB = 1
+
+SECTION_NAMES = 1
+SECTION_POOL = 2
+SECTION_CLUSTERS = 3
+SECTION_END = 4
+
+_HEADER = struct.Struct(">8sHH")
+_SECTION = struct.Struct(">BII")
+
+# number of clusters in a CLUSTERS section (their keys are read in one etcd
+# transaction)
+SNAPSHOT_BATCH_SIZE = 32
+
+# maximum number of operations and bytes of the values written in one etcd
+# transaction on import (etcd allows 128 operations and 1.5 MiB requests
+# by default)
+MAX_TXN_OPS = 128
+MAX_TXN_BYTES = 1024 * 1024
+
+# keys of the bundles in the columns of POOL sections
+_COLUMN_KEYS = set([
+    allocator.Allocator.KUBEAPI_VLAN_KEY, allocator.Allocator.SERVICE_VLAN_KEY,
+    allocator.Allocator.SERVICE_SUBNET_KEY,
+    allocator.Allocator.MULTICAST_RANGE_START_KEY,
+    allocator.Allocator.MULTICAST_RANGE_END_KEY,
+    allocator.Allocator.POD_SUBNET_KEY, "aci_config.system_id"
+])
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class SnapshotConflictError(SnapshotError):
+    pass
+
+
+# function that returns the etcd keys of the status of cluster name that
+# are in snapshots, in the order of the values of a CLUSTERS section
+def cluster_keys(name):
+    return StatusStore.keys(name) + [CertStore.key(name)]
+
+
+def _pack_string(s):
+    s = s.encode("utf-8")
+    return struct.pack(">H", len(s)) + s
+
+
+def _pack_blob(value):
+    if value is None:
+        return struct.pack(">i", -1)
+    return struct.pack(">i", len(value)) + value
+
+
+class _Buffer(object):
+    """
+    _Buffer reads the integers, strings and columns of a payload in order.
+    """
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.offset = 0
+
+    def unpack(self, fmt):
+        size = struct.calcsize(fmt)
+        if self.offset + size > len(self.payload):
+            raise SnapshotError("section ends too early")
+        values = struct.unpack_from(fmt, self.payload, self.offset)
+        self.offset += size
+        return values
+
+    def bytes(self, length):
+        if self.offset + length > len(self.payload):
+            raise SnapshotError("section ends too early")
+        value = self.payload[self.offset:self.offset + length]
+        self.offset += length
+        return value
+
+    def string(self):
+        return self.bytes(self.unpack(">H")[0]).decode("utf-8")
+
+    def blob(self):
+        length = self.unpack(">i")[0]
+        return None if length < 0 else self.bytes(length)
+
+
+class SnapshotWriter(object):
+    """
+    SnapshotWriter returns the bytes of the header and sections of a
+    snapshot. The names of the clusters are interned: every name is written
+    once, in a NAMES section before the first section that refers to it.
+    """
+
+    def __init__(self, compress=True):
+        self.compress = compress
+        self.names = {}
+        self.pools = 0
+        self.clusters = 0
+
+    def header(self):
+        return _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                            FLAG_ZLIB if self.compress else 0)
+
+    def _section(self, kind, payload):
+        if self.compress:
+            payload = zlib.compress(payload)
+        return _SECTION.pack(kind, len(payload),
+                             zlib.crc32(payload) & 0xffffffff) + payload
+
+    # function that returns the NAMES section of the names that are not
+    # interned yet ("" if there are none)
+    def _intern(self, names):
+        new = []
+        for name in names:
+            if name not in self.names:
+                self.names[name] = len(self.names)
+                new.append(name)
+        if not new:
+            return ""
+        return self._section(
+            SECTION_NAMES,
+            struct.pack(">I", len(new)) + "".join(
+                _pack_string(n) for n in new))
+
+    # function that returns the sections of the allocator state of pool
+    def pool_sections(self, pool, state):
+        columns = []
+        extras = {}
+        for name in sorted(state):
+            bundle = state[name]
+            try:
+                if set(bundle) != _COLUMN_KEYS or \
+                   bundle["aci_config.system_id"] != name:
+                    raise ValueError()
+                svc_subnet, svc_prefix = allocator.parse_subnet(
+                    bundle[allocator.Allocator.SERVICE_SUBNET_KEY])
+                pod_subnet, pod_prefix = allocator.parse_subnet(
+                    bundle[allocator.Allocator.POD_SUBNET_KEY])
+                row = (name, bundle[allocator.Allocator.KUBEAPI_VLAN_KEY],
+                       bundle[allocator.Allocator.SERVICE_VLAN_KEY],
+                       svc_subnet, svc_prefix,
+                       allocator.ip_to_int(bundle[
+                           allocator.Allocator.MULTICAST_RANGE_START_KEY]),
+                       allocator.ip_to_int(bundle[
+                           allocator.Allocator.MULTICAST_RANGE_END_KEY]),
+                       pod_subnet, pod_prefix)
+                if not all(0 <= v < 2**16 for v in row[1:3]):
+                    raise ValueError()
+                # the bundle must come back the same from the columns
+                if _bundle_of_row(row) != bundle:
+                    raise ValueError()
+                columns.append(row)
+            except (ValueError, TypeError, KeyError,
+                    allocator.InvalidIPError):
+                extras[name] = bundle
+
+        names = self._intern([row[0] for row in columns])
+        count = len(columns)
+        rows = zip(*columns) if columns else [()] * 9
+        payload = [
+            _pack_string(pool or ""),
+            struct.pack(">I", count),
+            struct.pack(">%dI" % count, *[self.names[n] for n in rows[0]])
+        ]
+        for fmt, values in zip("HHIBIIIB", rows[1:]):
+            payload.append(struct.pack(">%d%s" % (count, fmt), *values))
+        extras = json.dumps(extras, sort_keys=True)
+        payload.append(struct.pack(">I", len(extras)) + extras)
+
+        self.pools += 1
+        return names + self._section(SECTION_POOL, "".join(payload))
+
+    # function that returns the sections of clusters, a list of the names of
+    # the clusters and the values of their keys (see cluster_keys())
+    def cluster_sections(self, clusters):
+        if not clusters:
+            return ""
+        names = self._intern([name for name, _ in clusters])
+        payload = [struct.pack(">I", len(clusters))]
+        for name, values in clusters:
+            payload.append(struct.pack(">I", self.names[name]))
+            payload.extend(_pack_blob(v) for v in values)
+
+        self.clusters += len(clusters)
+        return names + self._section(SECTION_CLUSTERS, "".join(payload))
+
+    def end_section(self):
+        return self._section(SECTION_END,
+                             struct.pack(">II", self.pools, self.clusters))
+
+
+# function that returns the bundle of a row of the columns of a POOL
+# section
+def _bundle_of_row(row):
+    (name, kubeapi_vlan, service_vlan, svc_subnet, svc_prefix,
+     mcast_range_start, mcast_range_end, pod_subnet, pod_prefix) = row
+    return {
+        allocator.Allocator.KUBEAPI_VLAN_KEY: kubeapi_vlan,
+        allocator.Allocator.SERVICE_VLAN_KEY: service_vlan,
+        allocator.Allocator.SERVICE_SUBNET_KEY:
+        allocator.int_to_ip(svc_subnet) + "/" + str(svc_prefix),
+        allocator.Allocator.MULTICAST_RANGE_START_KEY:
+        allocator.int_to_ip(mcast_range_start),
+        allocator.Allocator.MULTICAST_RANGE_END_KEY:
+        allocator.int_to_ip(mcast_range_end),
+        allocator.Allocator.POD_SUBNET_KEY:
+        allocator.int_to_ip(pod_subnet) + "/" + str(pod_prefix),
+        "aci_config.system_id": name
+    }
+
+
+def read_snapshot(stream):
+    """
+    read_snapshot reads the snapshot in stream (a file object) one section
+    at a time and yields its contents in order:
+
+    - ("pool", pool name or None, allocator state of the pool)
+    - ("clusters", list of the names of clusters and the values of their
+      keys, see cluster_keys())
+    - ("end", {"pools": ..., "clusters": ...})
+
+    Raises SnapshotError if the snapshot is not valid, incomplete or
+    corrupted (every section is checked before it is yielded).
+    """
+
+    header = stream.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        raise SnapshotError("not a snapshot of the CCP ACI service")
+    magic, version, flags = _HEADER.unpack(header)
+    if magic != SNAPSHOT_MAGIC:
+        raise SnapshotError("not a snapshot of the CCP ACI service")
+    if version != SNAPSHOT_VERSION:
+        raise SnapshotError("version %d of snapshots is not supported "
+                            "(only version %d is)" %
+                            (version, SNAPSHOT_VERSION))
+
+    names = []
+    pools = 0
+    clusters = 0
+    section = 0
+    while True:
+        header = stream.read(_SECTION.size)
+        if len(header) < _SECTION.size:
+            raise SnapshotError("the snapshot is incomplete")
+        kind, length, crc = _SECTION.unpack(header)
+        payload = stream.read(length)
+        if len(payload) < length:
+            raise SnapshotError("the snapshot is incomplete")
+        if zlib.crc32(payload) & 0xffffffff != crc:
+            raise SnapshotError("section %d of the snapshot is corrupted" %
+                                section)
+        try:
+            if flags & FLAG_ZLIB:
+                payload = zlib.decompress(payload)
+            item = _read_section(kind, _Buffer(payload), names)
+        except (IndexError, ValueError, zlib.error) as e:
+            raise SnapshotError("section %d of the snapshot is invalid: %s" %
+                                (section, e))
+        section += 1
+
+        if item is None:
+            continue
+        if item[0] == "pool":
+            pools += 1
+        elif item[0] == "clusters":
+            clusters += len(item[1])
+        else:
+            if item[1] != (pools, clusters):
+                raise SnapshotError("the snapshot is incomplete")
+            yield "end", {"pools": pools, "clusters": clusters}
+            return
+        yield item
+
+
+# function that returns the contents of a section of a snapshot (None for
+# a NAMES section, whose names are appended to names)
+def _read_section(kind, buf, names):
+    if kind == SECTION_NAMES:
+        count = buf.unpack(">I")[0]
+        names.extend(buf.string() for _ in range(count))
+        return None
+
+    if kind == SECTION_POOL:
+        pool = buf.string() or None
+        count = buf.unpack(">I")[0]
+        columns = [[names[i] for i in buf.unpack(">%dI" % count)]]
+        for fmt in "HHIBIIIB":
+            columns.append(buf.unpack(">%d%s" % (count, fmt)))
+        state = dict((row[0], _bundle_of_row(row)) for row in zip(*columns))
+        state.update(json.loads(buf.bytes(buf.unpack(">I")[0])))
+        return "pool", pool, state
+
+    if kind == SECTION_CLUSTERS:
+        count = buf.unpack(">I")[0]
+        batch = []
+        for _ in range(count):
+            name = names[buf.unpack(">I")[0]]
+            batch.append((name, [buf.blob() for _ in range(4)]))
+        return "clusters", batch
+
+    if kind == SECTION_END:
+        return "end", buf.unpack(">II")
+
+    raise SnapshotError("unknown section %d in the snapshot" % kind)
+
+
+def iter_snapshot(etcd_client, config_file="aci.conf", blobs=True,
+                  writer=None, batch_size=SNAPSHOT_BATCH_SIZE):
+    """
+    iter_snapshot yields the bytes of a snapshot of the allocator state of
+    every pool in config_file and of the status of the clusters, one
+    section at a time. The ACI input json, manifests and certs of the
+    clusters are only in the snapshot if blobs is True, the status keys
+    (the status index) always are. The certs are copied as they are in
+    etcd (encrypted if they are).
+    """
+
+    if writer is None:
+        writer = SnapshotWriter()
+    yield writer.header()
+
+    for pool in [None] + allocator.pool_names(
+            allocator.get_aci_config(config_file)):
+        yield writer.pool_sections(pool, allocator.Allocator(
+            etcd_client, config_file, pool=pool).load_from_db())
+
+    batch = []
+    for value, meta in etcd_client.get_prefix(STATUS_KEY_PREFIX):
+        name = cluster_name_of_key(meta.key)
+        if name is None:
+            continue
+        batch.append((name, value))
+        if len(batch) >= batch_size:
+            yield writer.cluster_sections(
+                _read_clusters(etcd_client, batch, blobs))
+            batch = []
+    yield writer.cluster_sections(_read_clusters(etcd_client, batch, blobs))
+    yield writer.end_section()
+
+
+# function that returns the names and the values of the keys of the
+# clusters in batch (a list of the names of clusters and the values of
+# their status keys), the other keys are read in one etcd transaction
+def _read_clusters(etcd_client, batch, blobs):
+    if not blobs:
+        return [(name, [value, None, None, None]) for name, value in batch]
+    if not batch:
+        return []
+
+    t = etcd_client.transactions
+    _, responses = etcd_client.transaction(
+        compare=[],
+        success=[t.get(key) for name, _ in batch
+                 for key in cluster_keys(name)[1:]],
+        failure=[])
+    values = [r[0][0] if r else None for r in responses]
+    return [(name, [value] + values[3 * i:3 * i + 3])
+            for i, (name, value) in enumerate(batch)]
+
+
+# function to export a snapshot to stream (a file object), returns the
+# number of pools and clusters in it
+def export_snapshot(etcd_client, stream, config_file="aci.conf", blobs=True):
+    writer = SnapshotWriter()
+    for chunk in iter_snapshot(etcd_client, config_file, blobs, writer):
+        stream.write(chunk)
+    return {"pools": writer.pools, "clusters": writer.clusters}
+
+
+class _TransactionBatch(object):
+    """
+    _TransactionBatch writes puts and deletes in etcd transactions of up to
+    MAX_TXN_OPS operations and MAX_TXN_BYTES bytes of values.
+    """
+
+    def __init__(self, etcd_client):
+        self.etcd_client = etcd_client
+        self.ops = []
+        self.size = 0
+        self.transactions = 0
+
+    def put(self, key, value):
+        if self.ops and self.size + len(value) > MAX_TXN_BYTES:
+            self.flush()
+        self.ops.append(self.etcd_client.transactions.put(key, value))
+        self.size += len(value)
+        if len(self.ops) >= MAX_TXN_OPS:
+            self.flush()
+
+    def delete(self, key):
+        self.ops.append(self.etcd_client.transactions.delete(key))
+        if len(self.ops) >= MAX_TXN_OPS:
+            self.flush()
+
+    def flush(self):
+        if self.ops:
+            self.etcd_client.transaction(compare=[], success=self.ops,
+                                         failure=[])
+            self.transactions += 1
+        self.ops = []
+        self.size = 0
+
+
+# function that returns the names of the clusters with status keys
+def _cluster_names(etcd_client):
+    names = set()
+    for _, meta in etcd_client.get_prefix(STATUS_KEY_PREFIX):
+        name = cluster_name_of_key(meta.key)
+        if name is not None:
+            names.add(name)
+    return names
+
+
+def import_snapshot(etcd_client, stream, config_file="aci.conf",
+                    replace=False):
+    """
+    import_snapshot imports the snapshot in stream (a file object) into
+    etcd. The pools of the snapshot must be defined in config_file and
+    their bundles must be in the ranges of the pools.
+
+    Raises SnapshotConflictError if one of the pools has bundles or a
+    cluster has a status already, unless replace is True: then the state of
+    the pools in the snapshot is replaced, and the status of the clusters
+    that are not in the snapshot is deleted. The clusters are imported in
+    batched transactions as the snapshot is read, the pools are written
+    (one state log event each) before them.
+
+    Returns the number of pools, bundles and clusters imported, the
+    clusters deleted and the etcd transactions. Raises SnapshotError if the
+    snapshot is not valid: the sections read before the error are imported
+    (the pools only once all of them are read and checked).
+    """
+
+    pools = [None] + allocator.pool_names(
+        allocator.get_aci_config(config_file))
+    existing = _cluster_names(etcd_client)
+    if not replace:
+        if existing:
+            raise SnapshotConflictError(
+                "%d clusters have a status already, import with replace "
+                "to replace them" % len(existing))
+        for pool in pools:
+            if allocator.Allocator(etcd_client, config_file,
+                                   pool=pool).load_from_db():
+                raise SnapshotConflictError(
+                    "pool %s has bundles already, import with replace to "
+                    "replace them" % (pool or "default"))
+
+    states = {}
+    imported = set()
+    batch = _TransactionBatch(etcd_client)
+    counts = {}
+    for item in read_snapshot(stream):
+        if item[0] == "pool":
+            _, pool, state = item
+            if pool not in pools:
+                raise SnapshotError("pool %s is not defined in %s" %
+                                    (pool, config_file))
+            try:
+                out_of_range = allocator.Allocator(
+                    etcd_client, config_file, pool=pool).out_of_range(state)
+            except (KeyError, TypeError, ValueError,
+                    allocator.InvalidIPError):
+                raise SnapshotError("the bundles of pool %s are not valid" %
+                                    (pool or "default"))
+            if out_of_range:
+                raise SnapshotError(
+                    "the bundles of %s are not in the ranges of pool %s" %
+                    (", ".join(out_of_range[:10]), pool or "default"))
+            states[pool] = state
+            continue
+
+        # the pools are before the clusters in snapshots
+        if states is not None:
+            for pool, state in states.items():
+                _import_pool(etcd_client, config_file, pool, state)
+            counts["bundles"] = sum(len(s) for s in states.values())
+            states = None
+
+        if item[0] == "clusters":
+            for name, values in item[1]:
+                imported.add(name)
+                for key, value in zip(cluster_keys(name), values):
+                    if value is not None:
+                        batch.put(key, value)
+                    elif name in existing:
+                        batch.delete(key)
+
+    deleted = existing - imported
+    for name in sorted(deleted):
+        for key in cluster_keys(name):
+            batch.delete(key)
+    batch.flush()
+
+    counts.update(item[1])
+    counts["deleted"] = len(deleted)
+    counts["transactions"] = batch.transactions
+    return counts
+
+
+# function to replace the state of pool with state
+def _import_pool(etcd_client, config_file, pool, state):
+    a = allocator.Allocator(etcd_client, config_file, pool=pool)
+
+    def update(stored):
+        changes = dict((k, None) for k in stored if k not in state)
+        changes.update((k, v) for k, v in state.items()
+                       if stored.get(k) != v)
+        return changes
+
+    a.modify("import", update)
+    a.compact()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--config_file',
+        help='Path to config file. Default is aci.conf',
+        default='aci.conf')
+    subparsers = parser.add_subparsers(dest='command')
+    export_parser = subparsers.add_parser(
+        'export', help='Export a snapshot of the state')
+    export_parser.add_argument(
+        '--no_blobs',
+        help="Don't export the ACI input json, manifests and certs of the "
+        'clusters, only the allocator state and the status of the clusters',
+        action='store_true')
+    import_parser = subparsers.add_parser(
+        'import', help='Import a snapshot of the state')
+    import_parser.add_argument(
+        '--replace',
+        help='Replace the state of the pools and the status of the clusters '
+        'that exist in etcd',
+        action='store_true')
+    for p in [export_parser, import_parser]:
+        p.add_argument('file', help='Path to the snapshot file, - for '
+                       'stdout (export) or stdin (import)')
+        p.add_argument(
+            'etcd_ip_port',
+            help="etcd server's IP address or DNS name and port in the " \
+                 "format <etcd's IP or DNS name>:<etcd port>")
+    args = parser.parse_args()
+
+    if args.etcd_ip_port == MEMORY_BACKEND or \
+       ':' not in args.etcd_ip_port or \
+       not args.etcd_ip_port.split(':')[1].isdigit():
+        print "\nERROR: Invalid etcd_ip_port. etcd_ip_port's format is \
+               \n<IP address or DNS name of etcd server>:<port of etcd server>\n"
+        sys.exit(1)
+
+    etcd_client = new_etcd_client(args.etcd_ip_port)
+    try:
+        if args.command == 'export':
+            if args.file == '-':
+                report = export_snapshot(etcd_client, sys.stdout,
+                                         args.config_file, not args.no_blobs)
+            else:
+                with open(args.file, 'wb') as f:
+                    report = export_snapshot(etcd_client, f,
+                                             args.config_file,
+                                             not args.no_blobs)
+        else:
+            if args.file == '-':
+                report = import_snapshot(etcd_client, sys.stdin,
+                                         args.config_file, args.replace)
+            else:
+                with open(args.file, 'rb') as f:
+                    report = import_snapshot(etcd_client, f,
+                                             args.config_file, args.replace)
+    except SnapshotError as e:
+        sys.stderr.write("\nERROR: %s\n\n" % e)
+        sys.exit(1)
+
+    # the snapshot may be on stdout
+    sys.stderr.write(json.dumps(report, indent=4, sort_keys=True) + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+# Copyright 2018 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+import threading
+import time
+
+# default seconds the preflight checks at startup may take
+PREFLIGHT_TIMEOUT = 30
+
+
+class StartupTimer(object):
+    """
+    StartupTimer measures the phases of the startup of the server, from
+    started (the time the process started its imports) on. mark(name) ends
+    the phase name, which began when the previous phase ended.
+    """
+
+    def __init__(self, started=None):
+        self.started = started if started is not None else time.time()
+        self.last = self.started
+        self.phases = OrderedDict()
+        self.checks = OrderedDict()
+        self.ready = False
+
+    def mark(self, name):
+        now = time.time()
+        self.phases[name] = round(now - self.last, 3)
+        self.last = now
+
+    def report(self):
+        return {
+            "ready": self.ready,
+            "seconds": round(self.last - self.started, 3),
+            "phases": self.phases,
+            "checks": self.checks
+        }
+
+
+# function to run the checks (a list of (name, function) tuples)
+# concurrently, each in its own thread, for up to timeout seconds in total
+#
+# a check fails if its function raises an exception or does not return in
+# time, and it returns its detail (like a version) otherwise. Returns an
+# OrderedDict of the name of every check to its result (ok, seconds, and
+# detail or error).
+def run_checks(checks, timeout=PREFLIGHT_TIMEOUT):
+    results = OrderedDict((name, {
+        "ok": False,
+        "seconds": None,
+        "error": "did not finish in %s seconds" % timeout
+    }) for name, _ in checks)
+
+    def run(name, check):
+        started = time.time()
+        try:
+            result = {"ok": True, "detail": check()}
+        except Exception as e:
+            result = {"ok": False, "error": str(e) or type(e).__name__}
+        result["seconds"] = round(time.time() - started, 3)
+        results[name] = result
+
+    threads = []
+    for name, check in checks:
+        # a check that hangs must not keep the process from exiting
+        t = threading.Thread(target=run, args=(name, check),
+                             name="preflight-" + name)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    deadline = time.time() + timeout
+    for t in threads:
+        t.join(max(deadline - time.time(), 0))
+    # checks that finish late don't change the results returned
+    return OrderedDict(results.items())
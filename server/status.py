@@ -0,0 +1,182 @@
+#!/usr/bin/python
+
+# Copyright 2018 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+# prefixes and suffix of the etcd keys of the status of the clusters:
+# the summary (status record), the ACI input json and the ACI CNI manifests
+STATUS_KEY_PREFIX = "/acc_provision_status__"
+INPUT_JSON_KEY_PREFIX = "/acc_provision_input_json__"
+MANIFESTS_KEY_PREFIX = "/acc_provision_manifests__"
+KEY_SUFFIX = "__ccp"
+
+# fields of the status records of clusters created before the summary was
+# split from the ACI input json and the ACI CNI manifests
+LEGACY_INPUT_JSON_FIELD = "aci_input_json"
+LEGACY_MANIFESTS_FIELD = "output_aci_cni_yaml"
+
+
+# function that yields the json texts of the ACI CNI manifests in the value
+# of a manifests key: one manifest per line (NDJSON), or a json list in the
+# keys written before. The lines are split one at a time, so no list of all
+# the manifests is built.
+def iter_manifest_texts(value):
+    if value.startswith("["):
+        for manifest in json.loads(value):
+            yield json.dumps(manifest)
+        return
+
+    start = 0
+    while start < len(value):
+        end = value.find("\n", start)
+        if end == -1:
+            end = len(value)
+        if end > start:
+            yield value[start:end]
+        start = end + 1
+
+
+# function that returns the name of the cluster of a summary, ACI input json
+# or manifests key, or None if the key is not one of them
+def cluster_name_of_key(key):
+    for prefix in [STATUS_KEY_PREFIX, INPUT_JSON_KEY_PREFIX,
+                   MANIFESTS_KEY_PREFIX]:
+        if key.startswith(prefix) and key.endswith(KEY_SUFFIX) and \
+           len(key) > len(prefix) + len(KEY_SUFFIX):
+            return key[len(prefix):-len(KEY_SUFFIX)]
+    return None
+
+
+class StatusStore(object):
+    """
+    StatusStore keeps the status of a cluster in three etcd keys:
+
+    - the summary in /acc_provision_status__<cluster name>__ccp, a small
+      json record with the fields the status checks, the expiry scans and
+      the reconciler read (completed, creation_start_time, aci_flavor,
+      allocator_pool, update_in_progress...)
+    - the ACI input json in /acc_provision_input_json__<cluster name>__ccp
+    - the ACI CNI manifests in
+      /acc_provision_manifests__<cluster name>__ccp, one json document per
+      line (NDJSON)
+
+    The ACI input json and the manifests are only read when they are
+    needed, and the manifests are kept as the json texts they are served
+    as, so that they can be sent one at a time without decoding them.
+
+    The summary of a cluster created before has the ACI input json and the
+    manifests in its fields, they are read from there if their keys don't
+    exist.
+    """
+
+    def __init__(self, etcd_client, ccp_cluster_name):
+        self.etcd_client = etcd_client
+        self.ccp_cluster_name = ccp_cluster_name
+
+    @staticmethod
+    def key(ccp_cluster_name):
+        # key format in etcd is:
+        # /acc_provision_status__<cluster name>__ccp
+        return STATUS_KEY_PREFIX + ccp_cluster_name + KEY_SUFFIX
+
+    @staticmethod
+    def input_json_key(ccp_cluster_name):
+        return INPUT_JSON_KEY_PREFIX + ccp_cluster_name + KEY_SUFFIX
+
+    @staticmethod
+    def manifests_key(ccp_cluster_name):
+        return MANIFESTS_KEY_PREFIX + ccp_cluster_name + KEY_SUFFIX
+
+    # function that returns the summary of the cluster, or None if the
+    # cluster does not exist
+    def get_summary(self):
+        value = self.etcd_client.get(self.key(self.ccp_cluster_name))[0]
+        if value is None:
+            return None
+        return json.loads(value)
+
+    # function that returns the ACI input json of the cluster ({} if it is
+    # not stored), summary is read if it is not given
+    def get_input_json(self, summary=None):
+        value = self.etcd_client.get(
+            self.input_json_key(self.ccp_cluster_name))[0]
+        if value is not None:
+            return json.loads(value)
+        if summary is None:
+            summary = self.get_summary() or {}
+        return summary.get(LEGACY_INPUT_JSON_FIELD, {})
+
+    # function that returns an iterator over the json texts of the ACI CNI
+    # manifests of the cluster, or None if they are not stored. The
+    # manifests key is read when this is called. summary is read if it is
+    # not given.
+    def get_manifest_texts(self, summary=None):
+        value = self.etcd_client.get(
+            self.manifests_key(self.ccp_cluster_name))[0]
+        if value is not None:
+            return iter_manifest_texts(value)
+        if summary is None:
+            summary = self.get_summary() or {}
+        if LEGACY_MANIFESTS_FIELD not in summary:
+            return None
+        return (json.dumps(m) for m in summary[LEGACY_MANIFESTS_FIELD])
+
+    # function that returns the ACI CNI manifests of the cluster, or None if
+    # they are not stored
+    def get_manifests(self, summary=None):
+        manifests = self.get_manifest_texts(summary)
+        if manifests is None:
+            return None
+        return [json.loads(m) for m in manifests]
+
+    # function to store the summary of the cluster
+    def put_summary(self, summary):
+        self.etcd_client.put(
+            self.key(self.ccp_cluster_name), json.dumps(summary))
+
+    # function to store the summary, the ACI input json and the manifests
+    # (json texts) of the cluster in one etcd transaction, so that readers
+    # of the completed summary always find the manifests that belong to it
+    def put(self, summary, input_json, manifests):
+        txn = self.etcd_client.transactions
+        self.etcd_client.transaction(
+            compare=[],
+            success=[
+                txn.put(self.input_json_key(self.ccp_cluster_name),
+                        json.dumps(input_json)),
+                txn.put(self.manifests_key(self.ccp_cluster_name),
+                        '\n'.join(manifests)),
+                txn.put(self.key(self.ccp_cluster_name), json.dumps(summary))
+            ],
+            failure=[])
+
+    # function to delete the summary, the ACI input json and the manifests
+    # of the cluster in one etcd transaction
+    def delete(self):
+        txn = self.etcd_client.transactions
+        self.etcd_client.transaction(
+            compare=[],
+            success=[txn.delete(k) for k in self.keys(self.ccp_cluster_name)],
+            failure=[])
+
+    # function that returns the etcd keys of the status of the cluster
+    @classmethod
+    def keys(cls, ccp_cluster_name):
+        return [
+            cls.key(ccp_cluster_name),
+            cls.input_json_key(ccp_cluster_name),
+            cls.manifests_key(ccp_cluster_name)
+        ]
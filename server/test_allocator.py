@@ -1,11 +1,17 @@
-import etcd3
+import json
 import os
 import pytest
 
 from allocator import *
+from etcd_backend import MemoryEtcd
 
-etcd_address = os.environ["ETCD_CONTAINER_IP"]
-etcd = etcd3.client(host=etcd_address)
+# run against the etcd server in ETCD_CONTAINER_IP if it is set, otherwise
+# against the in-process etcd stand-in
+if os.environ.get("ETCD_CONTAINER_IP"):
+    import etcd3
+    etcd = etcd3.client(host=os.environ["ETCD_CONTAINER_IP"])
+else:
+    etcd = MemoryEtcd()
 
 # ===== HELPER FUNCTIONS ============================================================================
 
@@ -13,7 +19,8 @@ def dump_etcd():
     print(etcd.get(Allocator.DB_KEY)[0])
 
 def wipe_etcd():
-    etcd.delete(Allocator.DB_KEY)
+    # also wipes the state of the named pools
+    etcd.delete_prefix(Allocator.DB_KEY)
 
 def setup_function(function):
     print("running test function: %s" % function.__name__)
@@ -31,6 +38,30 @@ def teardown_function(function):
 def stock_allocator():
     return Allocator(etcd)
 
+def write_pool_config(tmpdir):
+    config_file = tmpdir.join("aci.conf")
+    config_file.write("""
+[DEFAULT]
+DEFAULT_VLAN_MIN = 2120
+DEFAULT_VLAN_MAX = 4000
+DEFAULT_MULTICAST_RANGE = 225.32.0.0/16
+DEFAULT_SERVICE_SUBNET = 10.5.0.0/24
+DEFAULT_POD_SUBNET = 10.50.0.1/16
+
+[pool:fabric1]
+APIC_HOSTS = 10.0.0.1, 10.0.0.2
+DEFAULT_VLAN_MIN = 100
+DEFAULT_VLAN_MAX = 200
+
+[pool:vcenter2]
+VMM_DOMAIN = vcenter2
+""")
+    return str(config_file)
+
+def input_json(apic_hosts, vmm_domain):
+    return {"aci_config": {"apic_hosts": apic_hosts,
+                           "vmm_domain": {"nested_inside": {"name": vmm_domain}}}}
+
 # ===== TESTS =======================================================================================
 
 # ----- helper functions ----------------------------------------------------------------------------
@@ -60,6 +91,19 @@ def test_generate_next_subnet():
 def test_start_and_end_addresses_for_mcast_range():
     assert start_and_end_addresses_for_mcast_range("10.0.0.0/16") == ("10.0.1.1", "10.0.255.255")
 
+def test_ip_integers():
+    assert ip_to_int("10.0.1.2") == (10 << 24) + (1 << 8) + 2
+    assert int_to_ip(ip_to_int("225.32.255.255")) == "225.32.255.255"
+    assert parse_subnet("10.50.0.1/16") == (ip_to_int("10.50.0.1"), 16)
+    assert prefix_mask(16) == ip_to_int("255.255.0.0")
+    assert mcast_range_bounds(ip_to_int("225.32.7.0")) == (ip_to_int("225.32.1.1"), ip_to_int("225.32.255.255"))
+
+    for invalid in ["10.0.1", "10.0.0.256", "a.b.c.d", ""]:
+        with pytest.raises(InvalidIPError):
+            ip_to_int(invalid)
+    with pytest.raises(InvalidIPError):
+        parse_subnet("10.0.0.0/33")
+
 # ----- Allocator class -----------------------------------------------------------------------------
 
 def test_getting():
@@ -86,32 +130,32 @@ def test_reservations():
     a = stock_allocator()
     foo = a.reserve("foo")
 
-    assert foo[Allocator.KUBEAPI_VLAN_KEY] == Allocator.DEFAULT_VLAN_MIN
-    assert foo[Allocator.SERVICE_VLAN_KEY] == Allocator.DEFAULT_VLAN_MIN + 1
-    assert foo[Allocator.SERVICE_SUBNET_KEY] == Allocator.DEFAULT_SERVICE_SUBNET
+    assert foo[Allocator.KUBEAPI_VLAN_KEY] == a.DEFAULT_VLAN_MIN
+    assert foo[Allocator.SERVICE_VLAN_KEY] == a.DEFAULT_VLAN_MIN + 1
+    assert foo[Allocator.SERVICE_SUBNET_KEY] == a.DEFAULT_SERVICE_SUBNET
 
-    start_address, end_address = start_and_end_addresses_for_mcast_range(Allocator.DEFAULT_MULTICAST_RANGE)
+    start_address, end_address = start_and_end_addresses_for_mcast_range(a.DEFAULT_MULTICAST_RANGE)
 
     assert foo[Allocator.MULTICAST_RANGE_START_KEY] == start_address
     assert foo[Allocator.MULTICAST_RANGE_END_KEY] == end_address
 
-    assert foo[Allocator.POD_SUBNET_KEY] == Allocator.DEFAULT_POD_SUBNET
+    assert foo[Allocator.POD_SUBNET_KEY] == a.DEFAULT_POD_SUBNET
 
     bar = a.reserve("bar")
 
-    assert bar[Allocator.KUBEAPI_VLAN_KEY] == Allocator.DEFAULT_VLAN_MIN + 2
-    assert bar[Allocator.SERVICE_VLAN_KEY] == Allocator.DEFAULT_VLAN_MIN + 3
+    assert bar[Allocator.KUBEAPI_VLAN_KEY] == a.DEFAULT_VLAN_MIN + 2
+    assert bar[Allocator.SERVICE_VLAN_KEY] == a.DEFAULT_VLAN_MIN + 3
 
-    svc_subnet = generate_next_subnet(Allocator.DEFAULT_SERVICE_SUBNET)
+    svc_subnet = generate_next_subnet(a.DEFAULT_SERVICE_SUBNET)
     assert bar[Allocator.SERVICE_SUBNET_KEY] == svc_subnet
 
-    mcast_range = generate_next_subnet(Allocator.DEFAULT_MULTICAST_RANGE, "/16")
+    mcast_range = generate_next_subnet(a.DEFAULT_MULTICAST_RANGE, "/16")
     start_address, end_address = start_and_end_addresses_for_mcast_range(mcast_range)
 
     assert bar[Allocator.MULTICAST_RANGE_START_KEY] == start_address
     assert bar[Allocator.MULTICAST_RANGE_END_KEY] == end_address
 
-    pod_subnet = generate_next_subnet(Allocator.DEFAULT_POD_SUBNET, "/16")
+    pod_subnet = generate_next_subnet(a.DEFAULT_POD_SUBNET, "/16")
     assert bar[Allocator.POD_SUBNET_KEY] == pod_subnet
 
     a.free("bar")
@@ -172,3 +216,376 @@ def test_allocating_too_many_multicast_ranges():
     with pytest.raises(NoMulticastRangesAvailableError):
         for i in range(0, 3):
             a.reserve("foo" + str(i))
+
+# ----- capacity planning ---------------------------------------------------------------------------
+
+def test_usage():
+    a = Allocator(etcd, vlan_min=100, vlan_max=109, warm_pool_size=1)
+    for i in range(3):
+        a.reserve("foo" + str(i))
+    a.free("foo1")
+
+    usage = a.usage()
+    assert usage["pool"] == "default"
+    assert usage["clusters"] == 2
+    # the freed bundle went to the warm pool
+    assert usage["warm_pool"] == 1
+    assert usage["vlans"]["capacity"] == 10
+    assert usage["vlans"]["used"] == 6
+    assert usage["vlans"]["free"] == 4
+    assert usage["service_subnets"]["used"] == 3
+    assert usage["clusters_remaining"] == 1 + 2
+
+    a.fill_warm_pool()
+    a.claim("bar")
+    usage = a.usage()
+    assert usage["vlans"]["holes"] == 0
+    assert usage["vlans"]["fragmentation"] == 0.0
+
+    # foo0's bundle goes to the warm pool, bar's vlans 102 and 103 are free
+    # again, but are not next to the other free vlans 106 to 109
+    a.free("foo0")
+    a.free("bar")
+    usage = a.usage()
+    assert usage["vlans"]["free_runs"] == 2
+    assert usage["vlans"]["holes"] == 2
+    assert usage["vlans"]["fragmentation"] == 0.333
+
+def test_plan():
+    a = Allocator(etcd, vlan_min=100, vlan_max=107, warm_pool_size=1)
+    a.reserve("foo")
+    a.fill_warm_pool()
+    head = etcd.get(a._head_key())[1].mod_revision
+
+    plan = a.plan(2)
+    assert plan["feasible"]
+    assert plan["planned"] == 2
+    assert [b["source"] for b in plan["bundles"]] == ["warm_pool", "new"]
+    assert plan["usage_after"]["clusters"] == 3
+    assert plan["usage_after"]["clusters_remaining"] == 1
+    # nothing was written
+    assert etcd.get(a._head_key())[1].mod_revision == head
+
+    # the plan matches the bundles the clusters get
+    assert a.claim("bar") == dict(plan["bundles"][0]["bundle"], **{"aci_config.system_id": "bar"})
+    assert a.reserve("baz") == dict(plan["bundles"][1]["bundle"], **{"aci_config.system_id": "baz"})
+
+    plan = a.plan(3)
+    assert not plan["feasible"]
+    assert plan["planned"] == 1
+    assert "vlan ids" in plan["error"]
+
+    with pytest.raises(ValueError):
+        a.plan(-1)
+
+def test_validating_ranges():
+    assert Allocator(etcd, service_subnet="10.5.0.0/24", pod_subnet="20.0.0.1/16",
+                     multicast_range="225.0.0.0/16").validate_ranges() == []
+
+    # the default service subnets run into the default pod subnets
+    warnings = stock_allocator().validate_ranges()
+    assert warnings == ["pool default: service subnets and pod subnets overlap after 45 clusters "
+                        "(the vlan ids are enough for 940 clusters)"]
+
+    with pytest.raises(InvalidPoolRangeError):
+        Allocator(etcd, service_subnet="255.254.0.0/24").validate_ranges()
+    with pytest.raises(InvalidPoolRangeError):
+        Allocator(etcd, multicast_range="239.250.0.0/16").validate_ranges()
+    with pytest.raises(InvalidPoolRangeError):
+        Allocator(etcd, multicast_range="10.0.0.0/16").validate_ranges()
+    with pytest.raises(InvalidPoolRangeError):
+        Allocator(etcd, pod_subnet="10.50.0.0/16").validate_ranges()
+
+# ----- warm pool -----------------------------------------------------------------------------------
+
+def test_warm_pool_disabled():
+    a = stock_allocator()
+
+    assert a.fill_warm_pool() == 0
+    assert a.claim("foo") == {}
+    assert a.get("foo") == {}
+
+def test_filling_warm_pool():
+    a = Allocator(etcd, warm_pool_size=3)
+
+    assert a.fill_warm_pool() == 3
+    assert a.warm_pool_count() == 3
+
+    # already full
+    assert a.fill_warm_pool() == 0
+
+    # reservations don't reuse the resources of the warm pool
+    foo = a.reserve("foo")
+    assert foo[Allocator.KUBEAPI_VLAN_KEY] == a.VLAN_MIN + 6
+
+def test_claiming_from_warm_pool():
+    a = Allocator(etcd, warm_pool_size=2)
+    a.fill_warm_pool()
+
+    foo = a.claim("foo")
+    assert foo["aci_config.system_id"] == "foo"
+    assert foo[Allocator.KUBEAPI_VLAN_KEY] == a.VLAN_MIN
+    assert foo[Allocator.SERVICE_SUBNET_KEY] == a.SERVICE_SUBNET
+    assert a.get("foo") == foo
+    assert a.warm_pool_count() == 1
+
+    with pytest.raises(TenantAlreadyExistsError):
+        a.claim("foo")
+
+    assert a.claim("bar")[Allocator.KUBEAPI_VLAN_KEY] == a.VLAN_MIN + 2
+
+    # warm pool is empty
+    assert a.claim("baz") == {}
+
+def test_freeing_returns_bundle_to_warm_pool():
+    a = Allocator(etcd, warm_pool_size=1)
+    a.fill_warm_pool()
+    foo = a.claim("foo")
+
+    a.free("foo")
+    assert a.get("foo") == {}
+    assert a.warm_pool_count() == 1
+
+    bar = a.claim("bar")
+    assert bar[Allocator.KUBEAPI_VLAN_KEY] == foo[Allocator.KUBEAPI_VLAN_KEY]
+
+def test_warm_pool_names_are_reserved():
+    a = stock_allocator()
+
+    with pytest.raises(InvalidNameError):
+        a.reserve(Allocator.WARM_POOL_PREFIX + "foo")
+
+# ----- slots -------------------------------------------------------------------------------------
+
+def misaligned_bundle(name, state={}):
+    # a bundle of an allocator whose vlan ids started at 101
+    bundle = Allocator(etcd, vlan_min=101, vlan_max=109)._next_bundle(state)
+    bundle["aci_config.system_id"] = name
+    return bundle
+
+def test_slot_mode():
+    a = Allocator(etcd, vlan_min=100, vlan_max=109, allocation_mode=SLOT_MODE)
+    for i in range(3):
+        assert a.slot_of(a.reserve("foo" + str(i))) == i
+    a.free("foo1")
+
+    # bar gets all the values of the freed slot
+    bar = a.reserve("bar")
+    assert bar == dict(a.slot_bundle(1), **{"aci_config.system_id": "bar"})
+    assert bar[Allocator.KUBEAPI_VLAN_KEY] == 102
+    assert bar[Allocator.SERVICE_SUBNET_KEY] == "10.6.0.0/24"
+    assert bar[Allocator.POD_SUBNET_KEY] == "10.51.0.1/16"
+
+    assert a.plan(2)["bundles"][1]["bundle"] == a.slot_bundle(4)
+    a.reserve("baz")
+    a.reserve("qux")
+    assert a.usage()["slots"] == {"capacity": 5, "free": 0, "misaligned": 0}
+    with pytest.raises(InsufficientVLANsAvailableError):
+        a.reserve("quux")
+    assert "free slot" in a.plan(1)["error"]
+
+    with pytest.raises(ValueError):
+        Allocator(etcd, allocation_mode="best_fit")
+    with pytest.raises(ValueError):
+        a.slot_bundle(5)
+
+def test_slot_mode_with_first_fit_bundles():
+    a = Allocator(etcd, vlan_min=100, vlan_max=109, allocation_mode=SLOT_MODE)
+    a.store_in_db({"foo": misaligned_bundle("foo")})
+    assert a.slot_of(a.get("foo")) is None
+
+    # foo has vlan ids of slots 0 and 1, and the subnets of slot 0
+    assert a.slot_of(a.reserve("bar")) == 2
+    usage = a.usage()
+    assert usage["allocation_mode"] == "slot"
+    assert usage["slots"] == {"capacity": 5, "free": 2, "misaligned": 1}
+    assert usage["clusters_remaining"] == 2
+
+def test_plan_compaction():
+    a = Allocator(etcd, vlan_min=100, vlan_max=109, allocation_mode=SLOT_MODE)
+    a.store_in_db({"foo": misaligned_bundle("foo")})
+    a.reserve("bar")
+    head = etcd.get(a._head_key())[1].mod_revision
+
+    plan = a.plan_compaction()
+    assert plan["feasible"]
+    assert plan["bundles"] == 2
+    assert plan["aligned"] == 1
+    # foo keeps its subnets in slot 0, only its vlan ids change
+    assert plan["moves"] == [{
+        "name": "foo",
+        "warm_pool": False,
+        "slot": 0,
+        "changes": {
+            Allocator.KUBEAPI_VLAN_KEY: [101, 100],
+            Allocator.SERVICE_VLAN_KEY: [102, 101]
+        }
+    }]
+    assert plan["changed_fields"] == 2
+    assert plan["usage_after"]["slots"]["misaligned"] == 0
+    assert plan["usage_after"]["slots"]["free"] == 3
+    # nothing was written
+    assert etcd.get(a._head_key())[1].mod_revision == head
+
+    # the clusters only move with tenants=True
+    assert a.plan_compaction(tenants=False)["moves"] == []
+
+def test_apply_compaction():
+    a = Allocator(etcd, vlan_min=100, vlan_max=109)
+    foo = misaligned_bundle("foo")
+    warm = misaligned_bundle(Allocator.WARM_POOL_PREFIX + "1", {"foo": foo})
+    a.store_in_db({"foo": foo, warm["aci_config.system_id"]: warm})
+
+    # foo keeps its bundle (and the slots 0 and 1 of its values), the warm
+    # pool bundle moves to slot 2
+    assert a.apply_compaction()["moves"][0]["slot"] == 2
+    assert a.get("foo") == misaligned_bundle("foo")
+    assert a.usage()["slots"]["misaligned"] == 1
+
+    a.apply_compaction(tenants=True)
+    assert a.get("foo") == dict(a.slot_bundle(0), **{"aci_config.system_id": "foo"})
+    assert a.usage()["slots"]["misaligned"] == 0
+    assert a.history()[-1]["op"] == "compact_slots"
+
+def test_compaction_without_free_slots():
+    a = Allocator(etcd, vlan_min=100, vlan_max=103)
+    state = {}
+    for i in range(3):
+        state["foo" + str(i)] = misaligned_bundle("foo" + str(i), state)
+    a.store_in_db(state)
+
+    assert not a.plan_compaction()["feasible"]
+    with pytest.raises(CompactionError):
+        a.apply_compaction(tenants=True)
+    assert a.load_from_db() == state
+
+# ----- named pools ---------------------------------------------------------------------------------
+
+def test_selecting_pool(tmpdir):
+    config = get_aci_config(write_pool_config(tmpdir))
+
+    assert sorted(pool_names(config)) == ["fabric1", "vcenter2"]
+    assert select_pool(config, input_json(["10.0.0.2"], "vcenter1")) == "fabric1"
+    assert select_pool(config, input_json(["10.0.0.9"], "vcenter2")) == "vcenter2"
+    assert select_pool(config, input_json(["10.0.0.9"], "vcenter1")) is None
+
+def test_pools_are_independent(tmpdir):
+    config_file = write_pool_config(tmpdir)
+    default = Allocator(etcd, config_file)
+    fabric1 = Allocator(etcd, config_file, pool="fabric1")
+    vcenter2 = Allocator(etcd, config_file, pool="vcenter2")
+
+    assert fabric1.DB_KEY != default.DB_KEY
+    assert fabric1.LOCK_NAME != default.LOCK_NAME
+
+    # fabric1 has its own vlans, vcenter2 inherits the settings of [DEFAULT]
+    assert fabric1.reserve("foo")[Allocator.KUBEAPI_VLAN_KEY] == 100
+    assert vcenter2.reserve("foo")[Allocator.KUBEAPI_VLAN_KEY] == 2120
+    assert default.reserve("foo")[Allocator.KUBEAPI_VLAN_KEY] == 2120
+
+    fabric1.free("foo")
+    assert fabric1.get("foo") == {}
+    assert vcenter2.get("foo") != {}
+
+def test_unknown_pool(tmpdir):
+    with pytest.raises(UnknownPoolError):
+        Allocator(etcd, write_pool_config(tmpdir), pool="nope")
+
+def test_reloading_config(tmpdir):
+    config_file = write_pool_config(tmpdir)
+    configs = AciConfigManager()
+    config = configs.get(config_file)
+    assert configs.info(config_file)["version"] == 1
+    assert configs.reload(config_file) is False
+
+    # the file is only read again by reload()
+    tmpdir.join("aci.conf").write(open(config_file).read().replace(
+        "DEFAULT_VLAN_MAX = 200", "DEFAULT_VLAN_MAX = 300"))
+    assert configs.get(config_file) is config
+    assert configs.reload(config_file) is True
+    assert configs.get(config_file)["pool:fabric1"]["DEFAULT_VLAN_MAX"] == "300"
+    assert configs.info(config_file)["version"] == 2
+
+    def reject(aci_config):
+        raise InvalidPoolRangeError("no")
+    tmpdir.join("aci.conf").write(open(config_file).read().replace(
+        "DEFAULT_VLAN_MAX = 300", "DEFAULT_VLAN_MAX = 400"))
+    with pytest.raises(InvalidPoolRangeError):
+        configs.reload(config_file, reject)
+    assert configs.get(config_file)["pool:fabric1"]["DEFAULT_VLAN_MAX"] == "300"
+    assert configs.info(config_file)["error"] == "no"
+    # the rejected file is not read again until it changes
+    assert configs.reload(config_file, reject) is False
+
+def test_validating_config(tmpdir):
+    config_file = write_pool_config(tmpdir)
+    old_config = get_aci_config(config_file)
+    Allocator(etcd, config_file, pool="fabric1").reserve("foo")
+    Allocator(etcd, config_file, pool="fabric1").reserve("bar")
+
+    def new_config(old, new):
+        tmpdir.join("new.conf").write(open(config_file).read().replace(old, new))
+        return read_aci_config(str(tmpdir.join("new.conf")))
+
+    # a pool can get more vlan ids, the warnings are the ones of validate_ranges()
+    warnings = validate_aci_config(etcd, new_config("DEFAULT_VLAN_MAX = 200",
+                                                    "DEFAULT_VLAN_MAX = 300"), old_config)
+    assert "pool fabric1: service subnets and pod subnets overlap after 45 clusters " \
+           "(the vlan ids are enough for 100 clusters)" in warnings
+
+    with pytest.raises(InvalidPoolRangeError) as e:
+        validate_aci_config(etcd, new_config("DEFAULT_VLAN_MIN = 100", "DEFAULT_VLAN_MIN = 102"))
+    assert "1 bundles are outside the new ranges (foo)" in str(e.value)
+    with pytest.raises(InvalidPoolRangeError):
+        validate_aci_config(etcd, new_config("[pool:fabric1]", "[pool:fabric3]"), old_config)
+    with pytest.raises(InvalidPoolRangeError) as e:
+        validate_aci_config(etcd, new_config("DEFAULT_VLAN_MAX = 200", "DEFAULT_VLAN_MAX = 101"))
+    assert "(bar)" in str(e.value)
+    with pytest.raises(ValueError):
+        validate_aci_config(etcd, new_config("DEFAULT_VLAN_MAX = 200", "DEFAULT_VLAN_MAX = 100"))
+
+# ----- state log -----------------------------------------------------------------------------------
+
+def test_history():
+    a = stock_allocator()
+    foo = a.reserve("foo")
+    a.free("foo")
+
+    history = a.history()
+    assert [e["seq"] for e in history] == [1, 2]
+    assert [e["op"] for e in history] == ["reserve", "free"]
+    assert history[0]["changes"] == {"foo": foo}
+    assert history[1]["changes"] == {"foo": None}
+
+def test_compacting_state_log():
+    a = Allocator(etcd, log_compaction_interval=3)
+    a.reserve("foo")
+    a.reserve("bar")
+    assert etcd.get(Allocator.DB_KEY) == (None, None)
+
+    # the third event folds the log into the snapshot
+    a.reserve("baz")
+    assert sorted(json.loads(etcd.get(Allocator.DB_KEY)[0])) == ["bar", "baz", "foo"]
+    assert a.history() == []
+    assert list(etcd.get_prefix(Allocator.DB_KEY + "__log/")) == []
+
+    a.free("bar")
+    assert sorted(a.load_from_db()) == ["baz", "foo"]
+    assert [e["seq"] for e in a.history()] == [4]
+
+def test_loading_state_without_log():
+    # state stored by releases without the state log
+    etcd.put(Allocator.DB_KEY, json.dumps({"foo": stock_allocator()._next_bundle({})}))
+
+    a = stock_allocator()
+    assert a.get("foo") != {}
+    assert a.reserve("bar")[Allocator.KUBEAPI_VLAN_KEY] == a.VLAN_MIN + 2
+
+def test_storing_whole_state():
+    a = stock_allocator()
+    foo = a.reserve("foo")
+    a.reserve("bar")
+
+    a.store_in_db({"foo": foo})
+    assert a.load_from_db() == {"foo": foo}
+    assert a.history()[-1]["changes"] == {"bar": None}
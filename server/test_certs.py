@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+from certs import *
+from etcd_backend import MemoryEtcd
+
+# ===== HELPER FUNCTIONS ============================================================================
+
+def setup_function(function):
+    print("running test function: %s" % function.__name__)
+
+def new_key():
+    fernet = pytest.importorskip("cryptography.fernet")
+    return fernet.Fernet.generate_key()
+
+# ===== TESTS =======================================================================================
+
+def test_store():
+    etcd = MemoryEtcd()
+    store = CertStore(etcd)
+    assert store.get("foo") is None
+
+    store.put("foo", "crt", "key")
+    assert store.get("foo") == ("crt", "key")
+    assert etcd.get("/acc_provision_certs__foo__ccp")[0] is not None
+
+    store.delete("foo")
+    assert store.get("foo") is None
+
+def test_no_cipher():
+    assert get_cipher("") is None
+    assert get_cipher(" , ") is None
+
+def test_encrypted_store():
+    etcd = MemoryEtcd()
+    key = new_key()
+    CertStore(etcd, get_cipher(key)).put("foo", "crt", "secret key")
+
+    value = etcd.get(CertStore.key("foo"))[0]
+    assert "secret key" not in value
+    assert json.loads(value)["encrypted"]
+    assert CertStore(etcd, get_cipher(key)).get("foo") == ("crt", "secret key")
+
+    # a new key in front of the old one still decrypts
+    assert CertStore(etcd, get_cipher(new_key() + "," + key)).get("foo") == ("crt", "secret key")
+
+    with pytest.raises(CertsEncryptionError):
+        CertStore(etcd).get("foo")
+    with pytest.raises(CertsEncryptionError):
+        CertStore(etcd, get_cipher(new_key())).get("foo")
+
+def test_invalid_key():
+    new_key()
+    with pytest.raises(CertsEncryptionError):
+        get_cipher("not a key")
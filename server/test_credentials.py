@@ -0,0 +1,46 @@
+import json
+import os
+
+from credentials import *
+
+# ===== HELPER FUNCTIONS ============================================================================
+
+def setup_function(function):
+    print("running test function: %s" % function.__name__)
+
+# ===== TESTS =======================================================================================
+
+def test_command_env():
+    env = command_env("secret")
+    assert env[ACC_PROVISION_PASSWORD_ENV] == "secret"
+    assert env["PATH"] == os.environ["PATH"]
+
+def test_redact_json():
+    body = json.dumps({
+        "ccp_cluster_name": "foo",
+        "aci_username": "admin",
+        "aci_password": 'se"cr\\et',
+        "nested": {"aci_password" : "secret2"}
+    })
+    redacted = json.loads(redact_json(body))
+    assert redacted == {
+        "ccp_cluster_name": "foo",
+        "aci_username": "",
+        "aci_password": "",
+        "nested": {"aci_password": ""}
+    }
+
+    # large and invalid bodies are cut without parsing them
+    body = '{"aci_password": "secret", "aci_input_json": "' + "x" * 10000
+    redacted = redact_json(body, limit=100)
+    assert "secret" not in redacted
+    assert redacted.endswith("... (" + str(len(body) - len("secret")) + " bytes)")
+
+def test_is_admin():
+    assert is_admin("Bearer secret", admin_token="secret")
+    assert is_admin("bearer secret", admin_token="secret")
+    assert not is_admin("Bearer wrong", admin_token="secret")
+    assert not is_admin("secret", admin_token="secret")
+    assert not is_admin(None, admin_token="secret")
+    # the admin endpoints are disabled without a token
+    assert not is_admin("Bearer ", admin_token="")
@@ -0,0 +1,151 @@
+import threading
+import time
+
+import pytest
+
+from etcd_backend import *
+
+# ===== HELPER FUNCTIONS ============================================================================
+
+def setup_function(function):
+    print("running test function: %s" % function.__name__)
+
+# ===== TESTS =======================================================================================
+
+# ----- key-value -----------------------------------------------------------------------------------
+
+def test_get_put_delete():
+    etcd = MemoryEtcd()
+    assert etcd.get("/foo") == (None, None)
+
+    etcd.put("/foo", "bar")
+    value, metadata = etcd.get("/foo")
+    assert value == "bar"
+    assert metadata.key == "/foo"
+    assert metadata.version == 1
+
+    assert etcd.delete("/foo")
+    assert not etcd.delete("/foo")
+    assert etcd.get("/foo") == (None, None)
+
+def test_revisions():
+    etcd = MemoryEtcd()
+    start = etcd.revision
+
+    etcd.put("/foo", "1")
+    _, created = etcd.get("/foo")
+    etcd.put("/foo", "2")
+    _, modified = etcd.get("/foo")
+
+    assert etcd.revision == start + 2
+    assert created.create_revision == modified.create_revision == start + 1
+    assert modified.mod_revision == start + 2
+    assert modified.version == 2
+
+def test_prefixes():
+    etcd = MemoryEtcd()
+    etcd.put("/acc_provision_status__b__ccp", "b")
+    etcd.put("/acc_provision_status__a__ccp", "a")
+    etcd.put("/acc_provision_statux", "not in prefix")
+
+    assert [v for v, _ in etcd.get_prefix("/acc_provision_status")] == ["a", "b"]
+    assert [v for v, _ in etcd.get_prefix("/acc_provision_status", sort_order="descend")] == ["b", "a"]
+
+    assert etcd.delete_prefix("/acc_provision_status").deleted == 2
+    assert etcd.get("/acc_provision_statux")[0] == "not in prefix"
+
+# ----- transactions --------------------------------------------------------------------------------
+
+def test_transactions():
+    etcd = MemoryEtcd()
+    t = etcd.transactions
+
+    # create-if-absent
+    assert etcd.transaction(compare=[t.version("/foo") == 0], success=[t.put("/foo", "1")], failure=[])[0]
+    succeeded, responses = etcd.transaction(compare=[t.version("/foo") == 0], success=[t.put("/foo", "2")],
+                                            failure=[t.get("/foo")])
+    assert not succeeded
+    assert responses[0][0][0] == "1"
+
+    # all the operations of a transaction share one revision
+    revision = etcd.revision
+    _, metadata = etcd.get("/foo")
+    assert etcd.transaction(compare=[t.mod("/foo") == metadata.mod_revision],
+                            success=[t.put("/foo", "3"), t.put("/bar", "3"), t.delete("/baz")])[0]
+    assert etcd.revision == revision + 1
+    assert etcd.get("/foo")[1].mod_revision == etcd.get("/bar")[1].mod_revision
+
+    assert etcd.replace("/foo", "3", "4")
+    assert not etcd.replace("/foo", "3", "5")
+    assert etcd.get("/foo")[0] == "4"
+
+# ----- leases and locks ----------------------------------------------------------------------------
+
+def test_lease_expiry():
+    etcd = MemoryEtcd()
+    lease = etcd.lease(1)
+    etcd.put("/foo", "bar", lease=lease)
+    assert etcd.get("/foo")[0] == "bar"
+
+    time.sleep(1.1)
+    assert etcd.get("/foo") == (None, None)
+
+def test_lock_is_exclusive():
+    etcd = MemoryEtcd()
+    counter = {"value": 0, "max": 0}
+
+    def worker():
+        for i in range(20):
+            with etcd.lock("test_lock"):
+                counter["value"] += 1
+                counter["max"] = max(counter["max"], counter["value"])
+                counter["value"] -= 1
+
+    threads = [threading.Thread(target=worker) for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert counter["max"] == 1
+    assert list(etcd.get_prefix(LOCK_PREFIX)) == []
+
+def test_lock_timeout():
+    etcd = MemoryEtcd()
+    held = etcd.lock("test_lock")
+    assert held.acquire()
+    assert held.is_acquired()
+
+    assert not etcd.lock("test_lock").acquire(timeout=0.2)
+
+    held.release()
+    assert etcd.lock("test_lock").acquire(timeout=0.2)
+
+# ----- watches -------------------------------------------------------------------------------------
+
+def test_watch():
+    etcd = MemoryEtcd()
+    events, cancel = etcd.watch_prefix("/foo")
+
+    etcd.put("/foo/1", "a")
+    etcd.put("/bar", "b")
+    etcd.delete("/foo/1")
+
+    put_event = next(events)
+    delete_event = next(events)
+    cancel()
+
+    assert put_event.key == "/foo/1"
+    assert put_event.value == "a"
+    assert not is_delete_event(put_event)
+    assert delete_event.key == "/foo/1"
+    assert is_delete_event(delete_event)
+
+def test_watch_once_timeout():
+    etcd = MemoryEtcd()
+
+    with pytest.raises(WatchTimedOut):
+        etcd.watch_once("/foo", timeout=0.1)
+
+def test_new_etcd_client_shares_memory_backend():
+    assert new_etcd_client(MEMORY_BACKEND) is new_etcd_client(MEMORY_BACKEND)
@@ -0,0 +1,56 @@
+import pytest
+
+from etcd_backend import MemoryEtcd
+from idempotency import *
+
+# ===== HELPER FUNCTIONS ============================================================================
+
+def setup_function(function):
+    print("running test function: %s" % function.__name__)
+
+# ===== TESTS =======================================================================================
+
+def test_request_hash():
+    assert request_hash("create", {"a": 1, "b": 2}) == request_hash("create", {"b": 2, "a": 1})
+    assert request_hash("create", {"a": 1}) != request_hash("delete", {"a": 1})
+    assert request_hash("create", {"a": 1}) != request_hash("create", {"a": 2})
+
+def test_replaying_response():
+    etcd = MemoryEtcd()
+    first = IdempotencyRecord(etcd, "key1")
+    assert first.reserve("create", "hash1") is None
+
+    # a concurrent duplicate sees the pending request
+    second = IdempotencyRecord(etcd, "key1")
+    assert second.reserve("create", "hash1")["state"] == "pending"
+    assert second.wait(timeout=0.3, poll_interval=0.1)["state"] == "pending"
+
+    first.complete(202, '{"job_id": "abc"}')
+    record = second.reserve("create", "hash1")
+    assert record["state"] == "completed"
+    assert record["status_code"] == 202
+    assert record["body"] == '{"job_id": "abc"}'
+
+    # other keys are independent
+    assert IdempotencyRecord(etcd, "key2").reserve("create", "hash1") is None
+
+def test_key_mismatch():
+    etcd = MemoryEtcd()
+    assert IdempotencyRecord(etcd, "key1").reserve("create", "hash1") is None
+    with pytest.raises(IdempotencyKeyMismatchError):
+        IdempotencyRecord(etcd, "key1").reserve("create", "hash2")
+    with pytest.raises(IdempotencyKeyMismatchError):
+        IdempotencyRecord(etcd, "key1").reserve("delete", "hash1")
+
+def test_discarding_key():
+    etcd = MemoryEtcd()
+    record = IdempotencyRecord(etcd, "key1")
+    assert record.reserve("create", "hash1") is None
+    record.discard()
+    assert IdempotencyRecord(etcd, "key1").reserve("create", "hash2") is None
+
+def test_key_expires():
+    etcd = MemoryEtcd()
+    assert IdempotencyRecord(etcd, "key1", ttl=1).reserve("create", "hash1") is None
+    time.sleep(1.2)
+    assert IdempotencyRecord(etcd, "key1").reserve("create", "hash2") is None
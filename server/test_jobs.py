@@ -0,0 +1,141 @@
+import pytest
+
+from certs import ENCRYPTION_KEY_ENV
+from etcd_backend import MemoryEtcd
+from jobs import *
+
+# ===== HELPER FUNCTIONS ============================================================================
+
+def setup_function(function):
+    print("running test function: %s" % function.__name__)
+
+# ===== TESTS =======================================================================================
+
+def test_journal():
+    etcd = MemoryEtcd()
+    journal = JobJournal(etcd, "foo")
+    assert journal.get() is None
+
+    journal.begin("create", {"ccp_cluster_name": "foo"})
+    journal.step("allocated")
+
+    job = journal.get()
+    assert job["operation"] == "create"
+    assert job["state"] == "running"
+    assert job["attempt"] == 1
+    assert job["last_step"] == "allocated"
+    assert job["owner"] == owner_id()
+    assert JobJournal.unfinished(etcd) == [job]
+
+    journal.finish()
+    assert journal.get() is None
+    assert JobJournal.unfinished(etcd) == []
+
+def test_resuming_job():
+    etcd = MemoryEtcd()
+    JobJournal(etcd, "foo").begin("delete", {"ccp_cluster_name": "foo"}, allocator_pool="pool1")
+    job = JobJournal.unfinished(etcd)[0]
+
+    resumed = JobJournal(etcd, "foo").begin("delete", {}, job)
+    assert resumed["attempt"] == 2
+    assert resumed["last_step"] == "accepted"
+    assert resumed["allocator_pool"] == "pool1"
+    assert resumed["http_request"] == {"ccp_cluster_name": "foo"}
+
+def test_password_not_in_journal(monkeypatch):
+    monkeypatch.delenv(ENCRYPTION_KEY_ENV, raising=False)
+    etcd = MemoryEtcd()
+    request = {"ccp_cluster_name": "foo", "aci_username": "admin", "aci_password": "s3cret"}
+    JobJournal(etcd, "foo").begin("create", request)
+
+    assert "s3cret" not in etcd.get(JOB_KEY_PREFIX + "foo")[0]
+    job = JobJournal.unfinished(etcd)[0]
+    assert job["http_request"] == {"ccp_cluster_name": "foo", "aci_username": "admin"}
+    assert JobJournal.resumable_request(job) is None
+    assert request["aci_password"] == "s3cret"
+
+def test_encrypted_password_in_journal(monkeypatch):
+    fernet = pytest.importorskip("cryptography.fernet")
+    monkeypatch.setenv(ENCRYPTION_KEY_ENV, fernet.Fernet.generate_key())
+    etcd = MemoryEtcd()
+    request = {"ccp_cluster_name": "foo", "aci_username": "admin", "aci_password": "s3cret"}
+    JobJournal(etcd, "foo").begin("create", request)
+
+    assert "s3cret" not in etcd.get(JOB_KEY_PREFIX + "foo")[0]
+    job = JobJournal.unfinished(etcd)[0]
+    assert JobJournal.resumable_request(job) == request
+    resumed = JobJournal(etcd, "foo").begin("create", request, job)
+    assert JobJournal.resumable_request(resumed) == request
+
+    # a job can't be resumed with other keys
+    monkeypatch.setenv(ENCRYPTION_KEY_ENV, fernet.Fernet.generate_key())
+    assert JobJournal.resumable_request(job) is None
+
+def test_claim():
+    etcd = MemoryEtcd()
+    claim = JobClaim(etcd, "foo")
+    assert claim.owner() is None
+    assert claim.acquire()
+    assert claim.owner() == owner_id()
+
+    # another replica can't claim the job while it runs
+    other = JobClaim(etcd, "foo")
+    other.owner_id = "otherhost:1:abcd1234"
+    assert not other.acquire()
+    assert not other.acquire(timeout=0.2, poll_interval=0.1)
+
+    claim.release()
+    assert claim.owner() is None
+    assert other.acquire()
+    assert claim.owner() == "otherhost:1:abcd1234"
+    other.release()
+
+def test_claim_expires():
+    etcd = MemoryEtcd()
+    claim = JobClaim(etcd, "foo", ttl=1)
+    assert claim.acquire()
+    # the replica holding the claim dies (no more refreshes)
+    claim._stop.set()
+
+    other = JobClaim(etcd, "foo")
+    other.owner_id = "otherhost:1:abcd1234"
+    assert other.acquire(timeout=3, poll_interval=0.2)
+    other.release()
+
+def test_taking_over_claim_of_dead_process():
+    etcd = MemoryEtcd()
+    # a claim of an earlier server process in this container
+    dead_owner = owner_id().rsplit(":", 1)[0] + ":00000000"
+    etcd.put(CLAIM_KEY_PREFIX + "foo", dead_owner, etcd.lease(30))
+    assert owner_is_dead(dead_owner)
+    assert not owner_is_dead(owner_id())
+    assert not owner_is_dead("otherhost:1:abcd1234")
+
+    claim = JobClaim(etcd, "foo")
+    assert claim.owner() is None
+    assert claim.acquire()
+    assert claim.owner() == owner_id()
+    claim.release()
+
+def test_fabric_semaphore():
+    etcd = MemoryEtcd()
+    first = FabricSemaphore(etcd, "fabric1", slots=2).acquire()
+    second = FabricSemaphore(etcd, "fabric1", slots=2).acquire()
+    assert first.lock.name != second.lock.name
+
+    # the other fabrics have their own slots
+    with FabricSemaphore(etcd, "fabric2", slots=1):
+        pass
+
+    acquired = []
+    third = FabricSemaphore(etcd, "fabric1", slots=2)
+    t = threading.Thread(target=lambda: acquired.append(third.acquire(poll_interval=0.1)))
+    t.start()
+    time.sleep(0.3)
+    assert acquired == []
+
+    first.release()
+    t.join(5)
+    assert acquired == [third]
+    second.release()
+    third.release()
@@ -0,0 +1,85 @@
+import threading
+import time
+
+import pytest
+
+from profiler import *
+
+# ===== HELPER FUNCTIONS ============================================================================
+
+def setup_function(function):
+    print("running test function: %s" % function.__name__)
+
+def busy_job(stop):
+    while not stop.is_set():
+        sum(range(100))
+
+def start_thread(name, target, *args):
+    t = threading.Thread(target=target, args=args, name=name)
+    t.daemon = True
+    t.start()
+    return t
+
+# ===== TESTS =======================================================================================
+
+def test_profile_threads():
+    stop = threading.Event()
+    lock = threading.Condition()
+    start_thread("create-foo", busy_job, stop)
+    with lock:
+        start_thread("delete-foo", lambda: lock.acquire() or lock.release())
+        sampler = profile(0.2, 0.01, ["create-", "delete-"])
+    stop.set()
+
+    assert sampler.samples >= 5
+    assert set(sampler.threads) == set(["create-foo", "delete-foo"])
+    assert sampler.threads["create-foo"]["samples"] == sampler.samples
+    assert sampler.threads["create-foo"]["waiting"] == 0
+
+    lines = sampler.folded().splitlines()
+    assert sum(int(l.rsplit(" ", 1)[1]) for l in lines) == 2 * sampler.samples
+    assert any(l.startswith("create-foo;") and "busy_job (test_profiler.py:" in l
+               for l in lines)
+
+    report = sampler.report()
+    assert report["folded"] == lines
+    assert report["seconds"] >= 0.2
+
+def test_lock_waiters():
+    cond = threading.Condition()
+    def waiter():
+        with cond:
+            cond.wait()
+    start_thread("update-foo", waiter)
+    time.sleep(0.05)
+
+    sampler = profile(0.05, 0.01, ["update-"])
+    with cond:
+        cond.notify_all()
+    assert sampler.threads["update-foo"]["waiting"] == sampler.samples
+    assert "wait (threading.py:" in sampler.folded()
+
+def test_lock_waiters_in_c():
+    # threading.Lock is acquired in C without a frame on Python 2
+    lock = threading.Lock()
+    def waiter():
+        with lock:
+            pass
+    with lock:
+        start_thread("delete-foo", waiter)
+        time.sleep(0.05)
+        sampler = profile(0.05, 0.01, ["delete-"])
+    assert sampler.threads["delete-foo"]["waiting"] == sampler.samples
+    assert "waiter (test_profiler.py:" in sampler.folded()
+
+def test_invalid_and_concurrent_profiles():
+    with pytest.raises(ValueError):
+        profile(MAX_PROFILE_SECONDS + 1)
+    with pytest.raises(ValueError):
+        profile(1, interval=0)
+
+    t = start_thread("profile", profile, 0.3)
+    time.sleep(0.05)
+    with pytest.raises(ProfilerBusyError):
+        profile(0.1)
+    t.join()
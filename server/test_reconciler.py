@@ -0,0 +1,189 @@
+import json
+import time
+
+from allocator import Allocator
+from etcd_backend import MemoryEtcd
+from jobs import JobJournal
+from reconciler import *
+from status import StatusStore
+
+# ===== HELPER FUNCTIONS ============================================================================
+
+def setup_function(function):
+    print("running test function: %s" % function.__name__)
+
+class FakeApicClient(object):
+    # managed object dns of every APIC host
+    objects = {}
+
+    def __init__(self, apic_host, username, password):
+        self.apic_host = apic_host
+
+    def login(self):
+        return self
+
+    def class_dns(self, class_name):
+        return set(self.objects.get(self.apic_host, []))
+
+# function to create a cluster like CcpAciAsyncCreate, returns its bundle
+def create_cluster(etcd, name, apic_host="10.0.0.1"):
+    bundle = Allocator(etcd).reserve(name)
+    input_json = {"aci_config": {"apic_hosts": [apic_host], "vmm_domain": {}}, "net_config": {}}
+    for k, v in bundle.items():
+        keys = k.split('.')
+        d = input_json
+        for key in keys[:-1]:
+            d = d.setdefault(key, {})
+        d[keys[-1]] = v
+    StatusStore(etcd, name).put({
+        "completed": True,
+        "creation_start_time": 0.0,
+        "allocator_pool": None
+    }, input_json, [])
+    FakeApicClient.objects.setdefault(apic_host, set()).update(apic_object_dns(name))
+    return bundle
+
+# ===== TESTS =======================================================================================
+
+def test_cluster_name_of_status_key():
+    assert cluster_name_of_status_key("/acc_provision_status__foo__ccp") == "foo"
+    assert cluster_name_of_status_key("/acc_provision_status__foo__bar__ccp") == "foo__bar"
+    assert cluster_name_of_status_key("/acc_provision_status__foo__old") is None
+    assert cluster_name_of_status_key("/acc_provision_status____ccp") is None
+
+def test_scan_without_drift():
+    etcd = MemoryEtcd()
+    for i in range(3):
+        create_cluster(etcd, "cluster%d" % i)
+    # a creation in progress without a bundle yet
+    etcd.put(STATUS_KEY_PREFIX + "new" + STATUS_KEY_SUFFIX, json.dumps({
+        "completed": False, "creation_start_time": time.time(), "allocator_pool": None
+    }))
+
+    report = Reconciler(etcd).scan()
+    assert report["clusters"] == 4
+    assert report["reservations"] == 3
+    assert not has_drift(report)
+
+def test_scan_and_repair():
+    etcd = MemoryEtcd()
+    for i in range(3):
+        create_cluster(etcd, "cluster%d" % i)
+    a = Allocator(etcd)
+
+    # a bundle without a status record, and one of a deletion in progress
+    a.reserve("orphan")
+    a.reserve("deleting")
+    JobJournal(etcd, "deleting").begin("delete", {"ccp_cluster_name": "deleting"})
+    # a stale key and a creation that failed long ago
+    etcd.put("/acc_provision_status__cluster0__old", "{}")
+    etcd.put(STATUS_KEY_PREFIX + "failed" + STATUS_KEY_SUFFIX, json.dumps({
+        "completed": False, "creation_start_time": time.time() - 2 * CREATION_EXPIRATION,
+        "allocator_pool": None
+    }))
+    a.reserve("failed")
+    # a created cluster whose bundle was lost
+    bundle = a.get("cluster1")
+    a.modify("test", lambda state: {"cluster1": None})
+    # the ACI input json and ACI CNI of a cluster without a status record
+    StatusStore(etcd, "gone").put({}, {}, [])
+    etcd.delete(StatusStore.key("gone"))
+
+    reconciler = Reconciler(etcd)
+    report = reconciler.scan()
+    assert report["orphaned_reservations"] == [
+        {"pool": None, "cluster": "failed"}, {"pool": None, "cluster": "orphan"}
+    ]
+    assert [k["key"] for k in report["orphaned_status_keys"]] == [
+        "/acc_provision_status__cluster0__old", STATUS_KEY_PREFIX + "failed" + STATUS_KEY_SUFFIX,
+        StatusStore.input_json_key("gone")
+    ]
+    assert report["missing_reservations"] == [
+        {"pool": None, "cluster": "cluster1", "importable": True}
+    ]
+    assert report["conflicts"] == []
+
+    assert reconciler.repair(report) == {
+        "status_keys_deleted": 3, "reservations_freed": 2, "reservations_imported": 1
+    }
+    assert etcd.get(StatusStore.manifests_key("gone"))[0] is None
+    assert a.get("cluster1") == bundle
+    assert a.get("orphan") == {}
+    assert a.get("deleting") != {}
+    assert not has_drift(reconciler.scan())
+
+def test_conflicts():
+    etcd = MemoryEtcd()
+    a = Allocator(etcd)
+    bundle = create_cluster(etcd, "cluster0")
+    a.modify("test", lambda state: {"cluster0": None})
+
+    # the bundle of cluster0 was handed out again
+    taken = dict(bundle)
+    taken["aci_config.system_id"] = "cluster1"
+    a.modify("test", lambda state: {"cluster1": taken})
+    etcd.put(STATUS_KEY_PREFIX + "cluster1" + STATUS_KEY_SUFFIX, json.dumps({
+        "completed": False, "creation_start_time": time.time(), "allocator_pool": None
+    }))
+
+    reconciler = Reconciler(etcd)
+    report = reconciler.scan()
+    assert report["missing_reservations"] == [{
+        "pool": None, "cluster": "cluster0", "importable": False,
+        "error": "bundle conflicts with other bundles"
+    }]
+    assert {"pool": None, "resource": "vlan", "value": bundle[Allocator.KUBEAPI_VLAN_KEY],
+            "owners": ["cluster0", "cluster1"]} in report["conflicts"]
+    assert len(report["conflicts"]) == 5
+
+    assert reconciler.repair(report)["reservations_imported"] == 0
+    assert a.get("cluster0") == {}
+
+def test_mismatched_reservations():
+    etcd = MemoryEtcd()
+    a = Allocator(etcd)
+    bundle = create_cluster(etcd, "cluster0")
+    bundle[Allocator.POD_SUBNET_KEY] = "10.99.0.1/16"
+    a.modify("test", lambda state: {"cluster0": bundle})
+
+    report = Reconciler(etcd).scan()
+    assert report["mismatched_reservations"] == [
+        {"pool": None, "cluster": "cluster0", "fields": [Allocator.POD_SUBNET_KEY]}
+    ]
+
+def test_legacy_status_records():
+    etcd = MemoryEtcd()
+    bundle = create_cluster(etcd, "cluster0")
+    # clusters created before have their ACI input json in the status record
+    store = StatusStore(etcd, "cluster0")
+    summary = store.get_summary()
+    summary["aci_input_json"] = store.get_input_json()
+    store.delete()
+    store.put_summary(summary)
+    Allocator(etcd).modify("test", lambda state: {"cluster0": None})
+
+    reconciler = Reconciler(etcd)
+    report = reconciler.scan()
+    assert report["missing_reservations"] == [
+        {"pool": None, "cluster": "cluster0", "importable": True}
+    ]
+    reconciler.repair(report)
+    assert Allocator(etcd).get("cluster0") == bundle
+
+def test_verifying_apics():
+    FakeApicClient.objects = {}
+    etcd = MemoryEtcd()
+    create_cluster(etcd, "cluster0", apic_host="10.0.0.1")
+    create_cluster(etcd, "cluster1", apic_host="10.0.0.1")
+    create_cluster(etcd, "cluster2", apic_host="10.0.0.2")
+    FakeApicClient.objects["10.0.0.1"].remove("uni/tn-cluster1")
+
+    report = Reconciler(etcd, apic_username="admin", apic_password="secret",
+                        apic_client_factory=FakeApicClient).scan()
+    assert report["missing_on_apic"] == [
+        {"cluster": "cluster1", "apic_host": "10.0.0.1", "dns": ["uni/tn-cluster1"]}
+    ]
+    assert report["apic_errors"] == []
+
+    # the APICs are not checked without an APIC user
+    assert Reconciler(etcd, apic_client_factory=FakeApicClient).scan()["missing_on_apic"] == []
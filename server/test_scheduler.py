@@ -0,0 +1,99 @@
+import threading
+import time
+
+import pytest
+
+from scheduler import *
+
+# ===== HELPER FUNCTIONS ============================================================================
+
+def setup_function(function):
+    print("running test function: %s" % function.__name__)
+
+# function to start a thread that runs in a slot of scheduler and appends
+# name to order when its turn comes
+def start_run(scheduler, order, name, caller, priority, key="fabric1", slots=1):
+    def run():
+        with scheduler.slot(key, caller, priority, slots):
+            order.append(name)
+
+    t = threading.Thread(target=run)
+    t.start()
+    return t
+
+# function to wait until scheduler has queued runs
+def wait_until_queued(scheduler, queued):
+    deadline = time.time() + 5
+    while scheduler.metrics()["queued"] < queued and time.time() < deadline:
+        time.sleep(0.01)
+    assert scheduler.metrics()["queued"] == queued
+
+# function to queue runs behind a running one, release it and return the
+# order the queued runs were started in
+def run_in_order(scheduler, runs):
+    order = []
+    with scheduler.slot("fabric1", "other", PRIORITY_CREATE):
+        threads = []
+        for i, (name, caller, priority) in enumerate(runs):
+            threads.append(start_run(scheduler, order, name, caller, priority))
+            # queue the runs in the given order
+            wait_until_queued(scheduler, i + 1)
+        # the queued runs wait long enough for their waits to be measured
+        time.sleep(0.01)
+    for t in threads:
+        t.join()
+    return order
+
+# ===== TESTS =======================================================================================
+
+def test_priority_classes():
+    order = run_in_order(FairScheduler(), [
+        ("create", "tenant1", PRIORITY_CREATE),
+        ("update", "tenant1", PRIORITY_UPDATE),
+        ("retry", "tenant1", PRIORITY_RETRY),
+        ("delete", "tenant1", PRIORITY_DELETE),
+    ])
+    assert order == ["delete", "retry", "update", "create"]
+
+def test_callers_take_turns():
+    runs = [("big%d" % i, "big", PRIORITY_CREATE) for i in range(5)]
+    runs += [("small1", "small1", PRIORITY_CREATE), ("small2", "small2", PRIORITY_CREATE)]
+    order = run_in_order(FairScheduler(), runs)
+    assert order == ["big0", "small1", "small2", "big1", "big2", "big3", "big4"]
+
+def test_slots_and_keys():
+    scheduler = FairScheduler()
+    order = []
+    with scheduler.slot("fabric1", "tenant1", PRIORITY_CREATE, slots=2):
+        # the second slot of the fabric is free, and other fabrics don't wait
+        start_run(scheduler, order, "fabric1", "tenant2", PRIORITY_CREATE, slots=2).join(5)
+        start_run(scheduler, order, "fabric2", "tenant2", PRIORITY_CREATE, key="fabric2").join(5)
+        assert order == ["fabric1", "fabric2"]
+
+        with scheduler.slot("fabric1", "tenant2", PRIORITY_CREATE, slots=2):
+            t = start_run(scheduler, order, "fabric1 queued", "tenant3", PRIORITY_CREATE, slots=2)
+            wait_until_queued(scheduler, 1)
+            assert scheduler.metrics()["running"] == 2
+            assert scheduler.metrics()["queued_by_caller"] == {"tenant3": 1}
+    t.join(5)
+    assert order == ["fabric1", "fabric2", "fabric1 queued"]
+
+def test_metrics():
+    scheduler = FairScheduler()
+    run_in_order(scheduler, [("delete", "tenant1", PRIORITY_DELETE)])
+
+    metrics = scheduler.metrics()
+    assert metrics["running"] == 0
+    assert metrics["queued"] == 0
+    assert metrics["queued_by_caller"] == {}
+    assert metrics["priority_classes"]["delete"]["started"] == 1
+    assert metrics["priority_classes"]["delete"]["wait_seconds"]["max"] > 0
+    assert metrics["priority_classes"]["create"]["started"] == 1
+    assert metrics["priority_classes"]["retry"]["wait_seconds"]["p99"] == 0.0
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == pytest.approx(50.5)
+    assert percentile(values, 99) == pytest.approx(99.01)
+    assert percentile(values, 100) == 100
+    assert percentile([], 99) == 0.0
@@ -0,0 +1,220 @@
+import pytest
+
+from certs import ENCRYPTION_KEY_ENV
+from etcd_backend import MemoryEtcd
+from server import *
+
+# ===== HELPER FUNCTIONS ============================================================================
+
+def setup_function(function):
+    print("running test function: %s" % function.__name__)
+
+def input_json():
+    return {
+        "aci_config": {"vrf": {"name": "vrf1", "tenant": "common"}, "apic_hosts": ["10.0.0.1"]},
+        "net_config": {"node_subnet": "1.10.58.1/24"},
+        "registry": {"image_prefix": "noiro"}
+    }
+
+# ===== TESTS =======================================================================================
+
+def test_diff_input_json():
+    old = input_json()
+    assert diff_input_json(old, input_json()) == []
+
+    new = input_json()
+    new["aci_config"]["vrf"]["name"] = "vrf2"
+    new["registry"]["image_prefix"] = "other"
+    new["kube_config"] = {"controller": "1.1.1.1"}
+    del new["net_config"]["node_subnet"]
+
+    assert diff_input_json(old, new) == [
+        "aci_config.vrf.name", "kube_config", "net_config.node_subnet", "registry.image_prefix"
+    ]
+
+def test_cache_key_is_canonical():
+    old = input_json()
+    new = dict(reversed(list(input_json().items())))
+
+    assert CcpAciServer._generate_cache_key(old, "kubernetes-1.9") == \
+        CcpAciServer._generate_cache_key(new, "kubernetes-1.9")
+    assert CcpAciServer._generate_cache_key(old, "kubernetes-1.9") != \
+        CcpAciServer._generate_cache_key(old, "kubernetes-1.8")
+
+def test_giving_up_resumed_jobs():
+    etcd = MemoryEtcd()
+    request = {"ccp_cluster_name": "foo", "aci_username": "admin", "aci_password": "secret"}
+    ccp_aci_server = CcpAciServer(request, etcd)
+    ccp_aci_server.put_into_etcd({"completed": False, "creation_start_time": 1.0})
+
+    job = ccp_aci_server.journal.begin("create", request)
+    job["attempt"] = MAX_JOB_ATTEMPTS
+    ccp_aci_server.journal.begin("create", request, job)
+
+    assert resume_unfinished_jobs(etcd) == []
+    assert ccp_aci_server.get_from_etcd()[0] is None
+    assert JobJournal.unfinished(etcd) == []
+
+def test_giving_up_jobs_without_password(monkeypatch):
+    monkeypatch.delenv(ENCRYPTION_KEY_ENV, raising=False)
+    etcd = MemoryEtcd()
+    request = {"ccp_cluster_name": "foo", "aci_username": "admin", "aci_password": "secret"}
+    ccp_aci_server = CcpAciServer(request, etcd)
+    ccp_aci_server.put_into_etcd({"completed": False, "creation_start_time": 1.0})
+    ccp_aci_server.journal.begin("create", request)
+
+    assert resume_unfinished_jobs(etcd) == []
+    assert ccp_aci_server.get_from_etcd()[0] is None
+    assert JobJournal.unfinished(etcd) == []
+
+def test_skipping_claimed_jobs():
+    etcd = MemoryEtcd()
+    request = {"ccp_cluster_name": "foo", "aci_username": "admin", "aci_password": "secret"}
+    ccp_aci_server = CcpAciServer(request, etcd)
+    ccp_aci_server.journal.begin("delete", request)
+
+    # the job is running on another replica
+    other = JobClaim(etcd, "foo")
+    other.owner_id = "otherhost:1:abcd1234"
+    assert other.acquire()
+    assert resume_unfinished_jobs(etcd) == []
+    assert len(JobJournal.unfinished(etcd)) == 1
+    other.release()
+
+def test_fabric_id():
+    request = {"ccp_cluster_name": "foo", "aci_input_json": input_json()}
+    ccp_aci_server = CcpAciServer(request, MemoryEtcd())
+    other = input_json()
+    other["aci_config"]["apic_hosts"] = ["10.0.0.2", "10.0.0.1"]
+    same = input_json()
+    same["aci_config"]["vrf"]["name"] = "vrf2"
+
+    assert ccp_aci_server.get_fabric_id() == \
+        CcpAciServer({"ccp_cluster_name": "bar", "aci_input_json": same}, MemoryEtcd()).get_fabric_id()
+    assert ccp_aci_server.get_fabric_id() != \
+        CcpAciServer({"ccp_cluster_name": "bar", "aci_input_json": other}, MemoryEtcd()).get_fabric_id()
+
+def test_begin_creation_in_etcd():
+    etcd = MemoryEtcd()
+    request = {"ccp_cluster_name": "foo", "aci_username": "admin", "aci_password": "secret"}
+    first = CcpAciServer(request, etcd)
+    first.job_id = "job1"
+    second = CcpAciServer(request, etcd)
+    second.job_id = "job2"
+
+    assert first.begin_creation_in_etcd()
+    assert not second.begin_creation_in_etcd()
+    status = json.loads(first.get_from_etcd()[0])
+    assert not status["completed"]
+    assert status["job_id"] == "job1"
+
+def test_waiting_for_job():
+    etcd = MemoryEtcd()
+    request = {"ccp_cluster_name": "foo", "aci_username": "admin", "aci_password": "secret"}
+    ccp_aci_server = CcpAciServer(request, etcd)
+    assert not ccp_aci_server.job_in_progress()
+    assert ccp_aci_server.wait_for_job(5)
+
+    ccp_aci_server.put_into_etcd({"completed": False, "creation_start_time": time.time()})
+    assert ccp_aci_server.job_in_progress()
+    started = time.time()
+    assert not ccp_aci_server.wait_for_job(0.5, poll_interval=0.1)
+    assert time.time() - started >= 0.5
+
+    def complete():
+        time.sleep(0.3)
+        ccp_aci_server.put_into_etcd({"completed": True, "creation_start_time": 0.0})
+    threading.Thread(target=complete).start()
+    started = time.time()
+    assert ccp_aci_server.wait_for_job(10)
+    assert time.time() - started < 5
+
+def test_priority_and_caller():
+    etcd = MemoryEtcd()
+    request = {"ccp_cluster_name": "foo", "aci_username": "admin", "aci_password": "secret"}
+    ccp_aci_server = CcpAciServer(request, etcd)
+    assert ccp_aci_server.caller == "admin"
+
+    assert ccp_aci_server.get_priority("delete") == PRIORITY_DELETE
+    assert ccp_aci_server.get_priority("create") == PRIORITY_CREATE
+    assert ccp_aci_server.get_priority("update") == PRIORITY_UPDATE
+    assert ccp_aci_server.get_priority("create", attempt=2) == PRIORITY_RETRY
+
+    # resumed jobs are scheduled as retries
+    ccp_aci_server.resumed = True
+    assert ccp_aci_server.get_priority("create") == PRIORITY_RETRY
+
+def test_credentials_not_in_command():
+    etcd = MemoryEtcd()
+    request = {"ccp_cluster_name": "foo", "aci_username": "admin", "aci_password": "secret",
+               "k8s_version": "1.9"}
+    ccp_aci_server = CcpAciServer(request, etcd)
+
+    for operation in ["create", "update", "generate", "delete"]:
+        cmd = ccp_aci_server._build_command(operation)
+        assert cmd[0] == "acc-provision"
+        assert "admin" not in cmd and "secret" not in cmd and "-p" not in cmd
+    assert "-d" in ccp_aci_server._build_command("delete")
+
+def test_aci_certs_in_etcd():
+    etcd = MemoryEtcd()
+    request = {"ccp_cluster_name": "foo", "aci_username": "admin", "aci_password": "secret"}
+    ccp_aci_server = CcpAciServer(request, etcd)
+    ccp_aci_server.put_into_etcd({"completed": True, "crt_file": "old crt", "key_file": "old key"})
+
+    try:
+        # clusters created before have the certificate and key in their status record
+        ccp_aci_server.get_aci_certs_from_etcd()
+        assert ccp_aci_server._read_aci_certs() == ("old crt", "old key")
+
+        ccp_aci_server._write_aci_certs("crt", "key")
+        ccp_aci_server.store_aci_certs_in_etcd()
+        ccp_aci_server.cleanup_files()
+        ccp_aci_server.get_aci_certs_from_etcd()
+        assert ccp_aci_server._read_aci_certs() == ("crt", "key")
+
+        ccp_aci_server.delete_aci_certs_from_etcd()
+        assert CertStore(etcd).get("foo") is None
+    finally:
+        ccp_aci_server.cleanup_files()
+
+def test_response_list():
+    request = {"ccp_cluster_name": "foo", "aci_username": "admin", "aci_password": "secret"}
+    ccp_aci_server = CcpAciServer(request, MemoryEtcd())
+    try:
+        ccp_aci_server.get_workdir().write(
+            ccp_aci_server.aci_cni_output_YAML,
+            "---\nkind: ConfigMap\ndata:\n  a: b\n---\nkind: DaemonSet\n")
+        assert ccp_aci_server.get_response_list() == [
+            json.dumps({"kind": "ConfigMap", "data": {"a": "b"}}), json.dumps({"kind": "DaemonSet"})
+        ]
+    finally:
+        ccp_aci_server.cleanup_files()
+
+def test_status_summary_and_manifests():
+    etcd = MemoryEtcd()
+    request = {"ccp_cluster_name": "foo", "aci_username": "admin", "aci_password": "secret"}
+    ccp_aci_server = CcpAciServer(request, etcd)
+    assert ccp_aci_server.get_aci_cni_for_cluster_from_etcd() == [False, False]
+
+    ccp_aci_server.job_id = "job1"
+    assert ccp_aci_server.begin_creation_in_etcd()
+    assert ccp_aci_server.get_aci_cni_for_cluster_from_etcd()[0] == ""
+
+    ccp_aci_server.http_request["aci_input_json"] = input_json()
+    ccp_aci_server.update_creation_status_in_etcd(['{"kind": "ConfigMap"}'])
+    state, aci_cni = ccp_aci_server.get_aci_cni_for_cluster_from_etcd()
+    assert aci_cni == [{"kind": "ConfigMap"}]
+    assert list(ccp_aci_server.get_aci_cni_for_cluster_from_etcd(as_json=True)[1]) == \
+        ['{"kind": "ConfigMap"}']
+    summary = ccp_aci_server.get_aci_cni_for_cluster_from_etcd(manifests=False)[1]
+    assert summary["completed"] and summary["manifests"] == 1
+    assert "aci_input_json" not in summary and "output_aci_cni_yaml" not in summary
+
+    # delete and status requests read the ACI input json from etcd
+    del request["aci_input_json"]
+    assert CcpAciServer(request, etcd)._get_input_json() == input_json()
+
+    ccp_aci_server.delete_from_etcd()
+    for key in StatusStore.keys("foo"):
+        assert etcd.get(key)[0] is None
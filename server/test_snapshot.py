@@ -0,0 +1,152 @@
+import json
+from StringIO import StringIO
+
+import pytest
+
+from allocator import Allocator
+from certs import CertStore
+from etcd_backend import MemoryEtcd
+from snapshot import *
+from status import StatusStore
+
+# ===== HELPER FUNCTIONS ============================================================================
+
+def setup_function(function):
+    print("running test function: %s" % function.__name__)
+
+def write_pool_config(tmpdir):
+    config_file = tmpdir.join("aci.conf")
+    config_file.write("""
+[DEFAULT]
+DEFAULT_VLAN_MIN = 2120
+DEFAULT_VLAN_MAX = 4000
+DEFAULT_MULTICAST_RANGE = 225.32.0.0/16
+DEFAULT_SERVICE_SUBNET = 10.5.0.0/24
+DEFAULT_POD_SUBNET = 10.50.0.1/16
+WARM_POOL_SIZE = 2
+
+[pool:fabric1]
+DEFAULT_VLAN_MIN = 100
+DEFAULT_VLAN_MAX = 200
+""")
+    return str(config_file)
+
+# function to create clusters in the pools of config_file, returns the etcd
+# client
+def populated_etcd(config_file, clusters=40):
+    etcd = MemoryEtcd()
+    default = Allocator(etcd, config_file)
+    fabric1 = Allocator(etcd, config_file, pool="fabric1")
+    for i in range(clusters):
+        name = "cluster%d" % i
+        (fabric1 if i % 4 == 0 else default).reserve(name)
+        StatusStore(etcd, name).put({"completed": True, "allocator_pool": None},
+                                    {"aci_config": {"system_id": name}},
+                                    ['{"kind": "ConfigMap"}', '{"kind": "Secret"}'])
+        if i % 2 == 0:
+            CertStore(etcd).put(name, "crt of " + name, "key of " + name)
+    default.fill_warm_pool()
+    # a bundle that doesn't fit in the columns
+    state = fabric1.load_from_db()
+    fabric1.store_in_db(dict(state, odd=dict(state["cluster0"], **{"aci_config.system_id": "other"})))
+    return etcd
+
+def dump(etcd, config_file):
+    pools = dict((pool, Allocator(etcd, config_file, pool=pool).load_from_db())
+                 for pool in [None, "fabric1"])
+    keys = dict((meta.key, value) for value, meta in etcd.get_prefix("/acc_provision_"))
+    return pools, keys
+
+def export(etcd, config_file, blobs=True):
+    out = StringIO()
+    counts = export_snapshot(etcd, out, config_file, blobs)
+    return out.getvalue(), counts
+
+# ===== TESTS =======================================================================================
+
+def test_export_and_import(tmpdir):
+    config_file = write_pool_config(tmpdir)
+    etcd = populated_etcd(config_file)
+    data, counts = export(etcd, config_file)
+    assert counts == {"pools": 2, "clusters": 40}
+    # the names are interned: every name is in the snapshot once
+    assert len(data) < len(json.dumps(dump(etcd, config_file)))
+
+    target = MemoryEtcd()
+    report = import_snapshot(target, StringIO(data), config_file)
+    assert report["pools"] == 2
+    assert report["clusters"] == 40
+    assert report["bundles"] == 40 + 2 + 1
+    assert report["deleted"] == 0
+    assert report["transactions"] >= 2
+    assert dump(target, config_file) == dump(etcd, config_file)
+    assert CertStore(target).get("cluster2") == ("crt of cluster2", "key of cluster2")
+
+    # the imported state is compacted and can be allocated from
+    a = Allocator(target, config_file)
+    assert a.history() == []
+    a.claim("new")
+    assert a.warm_pool_count() == 1
+
+def test_export_without_blobs(tmpdir):
+    config_file = write_pool_config(tmpdir)
+    etcd = populated_etcd(config_file, clusters=4)
+    data, _ = export(etcd, config_file, blobs=False)
+
+    target = MemoryEtcd()
+    import_snapshot(target, StringIO(data), config_file)
+    pools, keys = dump(target, config_file)
+    assert pools == dump(etcd, config_file)[0]
+    assert sorted(keys) == sorted(StatusStore.key("cluster%d" % i) for i in range(4))
+
+def test_import_conflicts_and_replace(tmpdir):
+    config_file = write_pool_config(tmpdir)
+    etcd = populated_etcd(config_file, clusters=8)
+    data, _ = export(etcd, config_file)
+
+    target = populated_etcd(config_file, clusters=12)
+    with pytest.raises(SnapshotConflictError):
+        import_snapshot(target, StringIO(data), config_file)
+    target = MemoryEtcd()
+    Allocator(target, config_file, pool="fabric1").reserve("foo")
+    with pytest.raises(SnapshotConflictError):
+        import_snapshot(target, StringIO(data), config_file)
+
+    target = populated_etcd(config_file, clusters=12)
+    report = import_snapshot(target, StringIO(data), config_file, replace=True)
+    assert report["deleted"] == 4
+    assert dump(target, config_file) == dump(etcd, config_file)
+
+def test_invalid_snapshots(tmpdir):
+    config_file = write_pool_config(tmpdir)
+    etcd = populated_etcd(config_file, clusters=4)
+    data, _ = export(etcd, config_file)
+
+    for invalid in ["", "not a snapshot", data[:8] + "\x00\x02" + data[10:],
+                    data[:40] + chr(ord(data[40]) ^ 1) + data[41:]]:
+        target = MemoryEtcd()
+        with pytest.raises(SnapshotError):
+            import_snapshot(target, StringIO(invalid), config_file)
+        assert dump(target, config_file) == ({None: {}, "fabric1": {}}, {})
+
+    # the sections read before the end are imported, a re-try replaces them
+    target = MemoryEtcd()
+    with pytest.raises(SnapshotError):
+        import_snapshot(target, StringIO(data[:-3]), config_file)
+    import_snapshot(target, StringIO(data), config_file, replace=True)
+    assert dump(target, config_file) == dump(etcd, config_file)
+
+    # the bundles must be in the ranges of the pools
+    narrow = tmpdir.join("narrow.conf")
+    narrow.write(open(config_file).read().replace("= 100", "= 150"))
+    with pytest.raises(SnapshotError):
+        import_snapshot(MemoryEtcd(), StringIO(data), str(narrow))
+
+def test_uncompressed_sections(tmpdir):
+    config_file = write_pool_config(tmpdir)
+    etcd = populated_etcd(config_file, clusters=4)
+    writer = SnapshotWriter(compress=False)
+    data = "".join(iter_snapshot(etcd, config_file, writer=writer, batch_size=3))
+    items = list(read_snapshot(StringIO(data)))
+    assert [i[0] for i in items] == ["pool", "pool", "clusters", "clusters", "end"]
+    assert items[-1][1] == {"pools": 2, "clusters": 4}
@@ -0,0 +1,49 @@
+import time
+
+from startup import *
+
+# ===== HELPER FUNCTIONS ============================================================================
+
+def setup_function(function):
+    print("running test function: %s" % function.__name__)
+
+def failing_check():
+    raise Exception("etcd server not up")
+
+# ===== TESTS =======================================================================================
+
+def test_checks_run_concurrently():
+    def slow_check():
+        time.sleep(0.3)
+        return "1.9.0"
+
+    started = time.time()
+    results = run_checks([("etcd", slow_check), ("acc-provision", slow_check)], timeout=5)
+    assert time.time() - started < 0.55
+    assert list(results) == ["etcd", "acc-provision"]
+    assert results["acc-provision"]["ok"]
+    assert results["acc-provision"]["detail"] == "1.9.0"
+    assert results["acc-provision"]["seconds"] >= 0.3
+
+def test_failing_and_hanging_checks():
+    started = time.time()
+    results = run_checks([("etcd", failing_check), ("acc-provision", lambda: time.sleep(5))],
+                         timeout=0.2)
+    assert time.time() - started < 1
+    assert not results["etcd"]["ok"]
+    assert results["etcd"]["error"] == "etcd server not up"
+    assert not results["acc-provision"]["ok"]
+    assert results["acc-provision"]["error"] == "did not finish in 0.2 seconds"
+
+def test_startup_timer():
+    timer = StartupTimer(time.time() - 1)
+    timer.mark("imports")
+    time.sleep(0.1)
+    timer.mark("preflight")
+
+    report = timer.report()
+    assert not report["ready"]
+    assert list(report["phases"]) == ["imports", "preflight"]
+    assert report["phases"]["imports"] >= 1
+    assert report["phases"]["preflight"] >= 0.1
+    assert report["seconds"] >= 1.1
@@ -0,0 +1,66 @@
+import json
+
+from etcd_backend import MemoryEtcd
+from status import *
+
+# ===== HELPER FUNCTIONS ============================================================================
+
+def setup_function(function):
+    print("running test function: %s" % function.__name__)
+
+def manifests():
+    return [{"kind": "ConfigMap", "data": {"opflex": "x\ny" * 1000}}, {"kind": "DaemonSet"}]
+
+def manifest_texts():
+    return [json.dumps(m) for m in manifests()]
+
+# ===== TESTS =======================================================================================
+
+def test_cluster_name_of_key():
+    assert cluster_name_of_key("/acc_provision_status__foo__ccp") == "foo"
+    assert cluster_name_of_key("/acc_provision_input_json__foo__bar__ccp") == "foo__bar"
+    assert cluster_name_of_key("/acc_provision_manifests__foo__ccp") == "foo"
+    assert cluster_name_of_key("/acc_provision_status__foo__old") is None
+    assert cluster_name_of_key("/acc_provision_certs__foo__ccp") is None
+
+def test_store():
+    etcd = MemoryEtcd()
+    store = StatusStore(etcd, "foo")
+    assert store.get_summary() is None
+    assert store.get_input_json() == {}
+    assert store.get_manifests() is None
+
+    store.put({"completed": True, "manifests": 2}, {"aci_config": {}}, manifest_texts())
+    assert store.get_summary() == {"completed": True, "manifests": 2}
+    assert store.get_input_json() == {"aci_config": {}}
+    assert store.get_manifests() == manifests()
+    assert list(store.get_manifest_texts()) == manifest_texts()
+
+    # the summary is small and does not have the ACI input json or manifests
+    assert len(etcd.get(StatusStore.key("foo"))[0]) < 100
+
+    store.put_summary({"completed": True, "update_in_progress": True})
+    assert store.get_manifests() == manifests()
+
+    store.delete()
+    for key in StatusStore.keys("foo"):
+        assert etcd.get(key)[0] is None
+
+def test_iter_manifest_texts():
+    assert list(iter_manifest_texts('\n'.join(manifest_texts()))) == manifest_texts()
+    assert list(iter_manifest_texts('{"a": 1}\n\n{"b": 2}\n')) == ['{"a": 1}', '{"b": 2}']
+    assert list(iter_manifest_texts("")) == []
+    # manifests keys written as a json list before
+    assert list(iter_manifest_texts(json.dumps(manifests()))) == manifest_texts()
+
+def test_legacy_record():
+    etcd = MemoryEtcd()
+    etcd.put("/acc_provision_status__foo__ccp", json.dumps({
+        "completed": True, "aci_input_json": {"aci_config": {}}, "output_aci_cni_yaml": manifests()
+    }))
+
+    store = StatusStore(etcd, "foo")
+    assert store.get_input_json() == {"aci_config": {}}
+    assert store.get_manifests() == manifests()
+    summary = store.get_summary()
+    assert store.get_manifests(summary) == manifests()
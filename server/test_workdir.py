@@ -0,0 +1,45 @@
+import os
+import tempfile
+
+from workdir import *
+
+# ===== HELPER FUNCTIONS ============================================================================
+
+def setup_function(function):
+    print("running test function: %s" % function.__name__)
+
+# ===== TESTS =======================================================================================
+
+def test_jobs_get_their_own_directories(tmpdir):
+    a = JobWorkDir(base_dir=str(tmpdir))
+    b = JobWorkDir(base_dir=str(tmpdir))
+    assert a.path != b.path
+
+    a.write("user-foo.crt", "a")
+    b.write("user-foo.crt", "b")
+    assert a.read("user-foo.crt") == "a"
+    assert b.read("user-foo.crt") == "b"
+
+def test_atomic_write(tmpdir):
+    w = JobWorkDir(base_dir=str(tmpdir))
+    w.write("input.yaml", "old")
+    w.write("input.yaml", u"new")
+
+    assert w.read("input.yaml") == "new"
+    # no temporary files are left behind
+    assert os.listdir(w.path) == ["input.yaml"]
+    assert os.stat(w.join("input.yaml")).st_mode & 0o777 == 0o600
+
+def test_cleanup(tmpdir):
+    with JobWorkDir(base_dir=str(tmpdir)) as w:
+        w.write("input.yaml", "foo")
+        assert w.exists("input.yaml")
+
+    assert not os.path.exists(w.path)
+
+def test_default_base_dir(monkeypatch):
+    monkeypatch.setenv(WORK_DIR_ENV, "/foo")
+    assert default_base_dir() == "/foo"
+
+    monkeypatch.delenv(WORK_DIR_ENV)
+    assert default_base_dir() in (SHM_DIR, tempfile.gettempdir())
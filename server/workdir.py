@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+# Copyright 2018 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+# environment variable to set the directory the work directories of the
+# jobs are created in
+WORK_DIR_ENV = "CCP_ACI_WORK_DIR"
+
+# tmpfs that is available on most Linux systems (and in containers)
+SHM_DIR = "/dev/shm"
+
+
+# function that returns the directory the work directories of the jobs are
+# created in: $CCP_ACI_WORK_DIR if it is set, /dev/shm if it is writable
+# (so that scratch files stay in memory), or the system's temp directory
+def default_base_dir():
+    if os.environ.get(WORK_DIR_ENV):
+        return os.environ[WORK_DIR_ENV]
+    if os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK | os.X_OK):
+        return SHM_DIR
+    return tempfile.gettempdir()
+
+
+class JobWorkDir(object):
+    """
+    JobWorkDir is a private work directory for the scratch files of one
+    job (the input YAML, output YAML and ACI certificate and key of an
+    acc-provision run). Every job gets a new directory, so concurrent jobs
+    never share files. The directory and everything in it is deleted by
+    cleanup() or when it is used as a context manager.
+    """
+
+    def __init__(self, prefix="ccp-aci-job-", base_dir=None):
+        if base_dir is None:
+            base_dir = default_base_dir()
+        self.path = tempfile.mkdtemp(prefix=prefix, dir=base_dir)
+
+    def join(self, filename):
+        return os.path.join(self.path, filename)
+
+    def exists(self, filename):
+        return os.path.exists(self.join(filename))
+
+    def read(self, filename):
+        f = open(self.join(filename), "r")
+        content = f.read()
+        f.close()
+        return content
+
+    # function to write content to filename atomically: readers see either
+    # the old or the new content, never a partially written file (the file
+    # is only readable by the owner like all the files of mkstemp)
+    def write(self, filename, content):
+        if isinstance(content, unicode):
+            content = content.encode("utf-8")
+        fd, tmp_path = tempfile.mkstemp(prefix="." + filename, dir=self.path)
+        f = os.fdopen(fd, "w")
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        os.rename(tmp_path, self.join(filename))
+
+    def remove(self, filename):
+        if self.exists(filename):
+            os.remove(self.join(filename))
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.cleanup()